@@ -33,6 +33,12 @@ with warnings.catch_warnings():
     warnings.simplefilter("ignore")
     gevent.monkey.patch_all()
 
+# psycopg2 is not reached by the monkey-patch, see `iam.green`. It imports ssl,
+# so it is only imported now.
+from iam.green import patch_psycopg  # noqa: E402 isort:skip
+
+patch_psycopg()
+
 _config = os.environ["ENVIRONMENT"]
 
 bind = "0.0.0.0:8000"
@@ -42,6 +48,14 @@ accesslog = "-"
 access_log_format = '''%(t)s "%(r)s" %(s)s %(b)s %(L)s "%(f)s"'''
 
 
+def when_ready(server):
+    # Refresh the entity counts in the master for all workers, see
+    # `iam.counts`. Workers forked from it do not refresh them themselves.
+    from iam.wsgi import app
+
+    app.extensions["entity_counts"].start()
+
+
 def child_exit(server, worker):
     multiprocess.mark_process_dead(worker.pid)
 
@@ -0,0 +1,24 @@
+"""Add user authorization version
+
+Revision ID: 0dc5694de776
+Revises: 6fe1139ca1af
+Create Date: 2026-10-18 11:40:02.318841
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0dc5694de776'
+down_revision = '6fe1139ca1af'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('authorization_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('user', 'authorization_version')
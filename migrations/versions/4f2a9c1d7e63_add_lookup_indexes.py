@@ -0,0 +1,52 @@
+"""Add indexes for lookup columns
+
+Revision ID: 4f2a9c1d7e63
+Revises: 0dc5694de776
+Create Date: 2026-10-18 16:05:41.208913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f2a9c1d7e63'
+down_revision = '0dc5694de776'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_refresh_token_token', 'refresh_token', ['token']),
+    ('ix_refresh_token_user_id', 'refresh_token', ['user_id']),
+    ('ix_user_firebase_uid', 'user', ['firebase_uid']),
+    ('ix_team_organization_id', 'team', ['organization_id']),
+    ('ix_consent_user_id_type_category_timestamp', 'consent',
+     ['user_id', 'type', 'category', 'timestamp']),
+    # The composite primary keys of the association tables only serve lookups
+    # by their first column.
+    ('ix_organization_user_user_id', 'organization_user', ['user_id']),
+    ('ix_team_user_user_id', 'team_user', ['user_id']),
+    ('ix_organization_project_project_id', 'organization_project',
+     ['project_id']),
+    ('ix_team_project_project_id', 'team_project', ['project_id']),
+    ('ix_user_project_project_id', 'user_project', ['project_id']),
+    ('ix_user_project_claim_project_id', 'user_project_claim',
+     ['project_id']),
+]
+
+
+def upgrade():
+    # Build the indexes without locking the tables against writes. This is not
+    # possible within a transaction. If the migration is interrupted, drop any
+    # invalid index left behind before running it again.
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(
+                name, table, columns, postgresql_concurrently=True
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table, postgresql_concurrently=True)
@@ -0,0 +1,74 @@
+"""Add materialized user project claims
+
+Revision ID: 6fe1139ca1af
+Revises: 1bfd70fc475a
+Create Date: 2026-10-18 09:12:31.504122
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '6fe1139ca1af'
+down_revision = '1bfd70fc475a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_project_claim',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('role', postgresql.ENUM('admin', 'write', 'read', name='project_roles', create_type=False), nullable=False),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'project_id')
+    )
+    # Populate the table from the existing access rules. Keep in sync with
+    # `iam.claims._highest_roles`; `flask check-claims` verifies the result.
+    op.execute("""
+        INSERT INTO user_project_claim (user_id, project_id, role)
+        SELECT user_id, project_id,
+               CAST(CASE max(rank) WHEN 3 THEN 'admin'
+                                   WHEN 2 THEN 'write'
+                                   ELSE 'read' END AS project_roles)
+        FROM (
+            SELECT ou.user_id, op.project_id, 3 AS rank
+            FROM organization_user ou
+            JOIN organization_project op
+              ON op.organization_id = ou.organization_id
+            WHERE ou.role = 'owner'
+            UNION ALL
+            SELECT ou.user_id, tp.project_id, 3
+            FROM organization_user ou
+            JOIN team t ON t.organization_id = ou.organization_id
+            JOIN team_project tp ON tp.team_id = t.id
+            WHERE ou.role = 'owner'
+            UNION ALL
+            SELECT ou.user_id, op.project_id,
+                   CASE op.role WHEN 'admin' THEN 3 WHEN 'write' THEN 2
+                                ELSE 1 END
+            FROM organization_user ou
+            JOIN organization_project op
+              ON op.organization_id = ou.organization_id
+            WHERE ou.role != 'owner'
+            UNION ALL
+            SELECT tu.user_id, tp.project_id,
+                   CASE tp.role WHEN 'admin' THEN 3 WHEN 'write' THEN 2
+                                ELSE 1 END
+            FROM team_user tu
+            JOIN team_project tp ON tp.team_id = tu.team_id
+            UNION ALL
+            SELECT up.user_id, up.project_id,
+                   CASE up.role WHEN 'admin' THEN 3 WHEN 'write' THEN 2
+                                ELSE 1 END
+            FROM user_project up
+        ) AS granted_roles
+        GROUP BY user_id, project_id
+    """)
+
+
+def downgrade():
+    op.drop_table('user_project_claim')
@@ -0,0 +1,44 @@
+"""Index latest consents per user
+
+Revision ID: 8b1e5f0c3a92
+Revises: 4f2a9c1d7e63
+Create Date: 2026-10-18 17:21:09.733504
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b1e5f0c3a92'
+down_revision = '4f2a9c1d7e63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Replace the index with one in the order of the `DISTINCT ON` query for the
+    # latest consents, see `iam.consents.latest_consents`.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_consent_latest', 'consent',
+            ['user_id', 'type', 'category', sa.text('timestamp DESC'),
+             sa.text('id DESC')],
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            'ix_consent_user_id_type_category_timestamp', 'consent',
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_consent_user_id_type_category_timestamp', 'consent',
+            ['user_id', 'type', 'category', 'timestamp'],
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            'ix_consent_latest', 'consent', postgresql_concurrently=True
+        )
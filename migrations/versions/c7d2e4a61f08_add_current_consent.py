@@ -0,0 +1,42 @@
+"""Add current consents
+
+Revision ID: c7d2e4a61f08
+Revises: 8b1e5f0c3a92
+Create Date: 2026-10-18 18:02:47.916255
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d2e4a61f08'
+down_revision = '8b1e5f0c3a92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('current_consent',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('type', postgresql.ENUM('gdpr', 'cookie', name='consenttype', create_type=False), nullable=False),
+    sa.Column('category', sa.Text(), nullable=False),
+    sa.Column('consent_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['consent_id'], ['consent.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'type', 'category')
+    )
+    # Populate the table from the consent log. Keep in sync with
+    # `iam.consents.latest_consents`; `flask rebuild-consents` does the same.
+    op.execute("""
+        INSERT INTO current_consent (user_id, type, category, consent_id)
+        SELECT DISTINCT ON (user_id, type, category)
+               user_id, type, category, id
+        FROM consent
+        ORDER BY user_id, type, category, timestamp DESC, id DESC
+    """)
+
+
+def downgrade():
+    op.drop_table('current_consent')
@@ -16,6 +16,7 @@
 """Expose the main Flask application."""
 
 import getpass
+import json
 import logging
 import logging.config
 
@@ -41,7 +42,19 @@ def init_app(application, db):
     """Initialize the main app with config information and routes."""
     # Import local modules in this method, to allow circular imports for modules
     # that need to import the flaskk app.
-    from . import errorhandlers, jwt, resources
+    from . import (
+        claims,
+        consents,
+        counts,
+        errorhandlers,
+        firebase,
+        green,
+        hasher,
+        jwt,
+        replica,
+        resources,
+        throttle,
+    )
     from .models import (
         Organization,
         OrganizationProject,
@@ -64,8 +77,10 @@ def init_app(application, db):
     logger.info("Logging configured")
 
     logger.debug("Initializing database")
+    green.check()
     Migrate(application, db)
     db.init_app(application)
+    replica.init_app(application)
 
     logger.debug("Initializing sentry")
     if application.config["SENTRY_DSN"]:
@@ -79,7 +94,10 @@ def init_app(application, db):
     logger.debug("Initializing CORS")
     CORS(application)
 
-    if application.config["FEAT_TOGGLE_FIREBASE"]:
+    if (
+        application.config["FEAT_TOGGLE_FIREBASE"]
+        and not application.config["FIREBASE_TEST_KEY"]
+    ):
         logger.info("Initializing Firebase")
         cred = credentials.Certificate(
             {
@@ -101,6 +119,21 @@ def init_app(application, db):
     else:
         logger.info("Firebase feature toggle is off")
 
+    logger.debug("Initializing Firebase ID token verification")
+    firebase.init_app(application)
+
+    logger.debug("Initializing claims cache")
+    claims.init_app(application)
+
+    logger.debug("Initializing entity counts")
+    counts.init_app(application)
+
+    logger.debug("Initializing password hasher")
+    hasher.init_app(application)
+
+    logger.debug("Initializing login throttle")
+    throttle.init_app(application)
+
     # Add JWT middleware
     ############################################################################
     jwt.init_app(application)
@@ -159,6 +192,85 @@ def init_app(application, db):
         except NoResultFound:
             print(f"No user has id {id} (try `flask users`)")
 
+    @application.cli.command()
+    def rebuild_claims():
+        """Recompute the materialized project claims of all users."""
+        claims.rebuild()
+        db.session.commit()
+        print("Materialized project claims rebuilt")
+
+    @application.cli.command()
+    def check_claims():
+        """Verify that the materialized project claims are up to date."""
+        user_ids = claims.find_inconsistencies()
+        if user_ids:
+            raise click.ClickException(
+                f"Materialized claims are out of date for users {user_ids} "
+                f"(run `flask rebuild-claims`)"
+            )
+        print("Materialized project claims are consistent")
+
+    @application.cli.command()
+    def rebuild_consents():
+        """Recompute the current consents of all users."""
+        consents.rebuild()
+        db.session.commit()
+        print("Current consents rebuilt")
+
+    @application.cli.command()
+    @click.option(
+        "--algorithm",
+        default=None,
+        help="The hasher to calibrate (default: PASSWORD_HASHER).",
+    )
+    @click.option(
+        "--budget",
+        default=250.0,
+        help="Target time to hash a password in milliseconds (default: 250).",
+    )
+    @click.option(
+        "--rounds", default=5, help="Passwords to hash for each setting."
+    )
+    def calibrate_hasher(algorithm, budget, rounds):
+        """Find the password hasher cost fitting a time budget."""
+        algorithm = algorithm or application.config["PASSWORD_HASHER"]
+        if algorithm not in hasher.HASHERS:
+            raise click.BadParameter(f"Unknown hasher '{algorithm}'")
+        timings = hasher.calibrate(algorithm, budget / 1000, rounds)
+        for parameters, seconds in timings:
+            print(f"{algorithm} {parameters}: {seconds * 1000:.1f} ms")
+        within_budget = [
+            (parameters, seconds)
+            for parameters, seconds in timings
+            if seconds <= budget / 1000
+        ]
+        if not within_budget:
+            raise click.ClickException(
+                f"No {algorithm} setting hashes within {budget} ms"
+            )
+        parameters, seconds = within_budget[-1]
+        threads = application.config["HASHER_POOL_SIZE"] or 1
+        logins = hasher.throughput(algorithm, parameters, threads)
+        print(
+            f"Recommended: PASSWORD_HASHER={algorithm} "
+            f"PASSWORD_HASHER_PARAMETERS='{json.dumps(parameters)}' "
+            f"({seconds * 1000:.1f} ms per hash)"
+        )
+        print(
+            f"Throughput with {threads} hashing thread(s): {logins:.1f} logins "
+            f"per second per worker"
+        )
+
+    @application.cli.command()
+    @click.argument("uid")
+    @click.argument("email")
+    def firebase_token(uid, email):
+        """Create a Firebase ID token signed with FIREBASE_TEST_KEY."""
+        if not application.config["FIREBASE_TEST_KEY"]:
+            raise click.ClickException("FIREBASE_TEST_KEY is not set")
+        verifier = application.extensions["firebase_verifier"]
+        print(verifier.create_token(uid, email))
+
     # Please keep in mind that it is a security issue to use such a middleware
     # in a non-proxy setup because it will blindly trust the incoming headers
     # which might be forged by malicious clients.
@@ -0,0 +1,112 @@
+# Copyright (c) 2018, Novo Nordisk Foundation Center for Biosustainability,
+# Technical University of Denmark.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Key/value cache backends.
+
+All backends expose the same `get`, `set` and `delete` methods, so that
+callers can be configured with either a per-process cache or one shared by
+all gunicorn workers.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+
+def create_cache(url=None, maxsize=1024, prefix="iam:"):
+    """Return a shared cache if a Redis URL is given, a local one otherwise."""
+    if url:
+        return RedisCache.from_url(url, prefix)
+    return LRUCache(maxsize)
+
+
+class LRUCache:
+    """A bounded in-process cache evicting the least recently used entries."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the value for the given key, or None if missing or expired."""
+        with self._lock:
+            try:
+                value, expires = self._entries[key]
+            except KeyError:
+                return None
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store the value for the given key, expiring after `ttl` seconds."""
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove the given key, if present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """
+    A cache shared between processes through Redis.
+
+    Values are stored as JSON, so they must be serializable and mappings come
+    back with string keys.
+    """
+
+    def __init__(self, client, prefix="iam:"):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, prefix="iam:"):
+        """Connect to the Redis server at the given URL."""
+        return cls(redis.Redis.from_url(url), prefix)
+
+    def get(self, key):
+        """Return the value for the given key, or None if missing or expired."""
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        """Store the value for the given key, expiring after `ttl` seconds."""
+        ttl = None if ttl is None else max(1, int(ttl))
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl)
+
+    def delete(self, key):
+        """Remove the given key, if present."""
+        self.client.delete(self.prefix + key)
@@ -0,0 +1,461 @@
+# Copyright (c) 2018, Novo Nordisk Foundation Center for Biosustainability,
+# Technical University of Denmark.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Project claims of users.
+
+The project claims of a user are derived from organization, team and direct
+project access rules, where the highest role granted through any of them
+wins. Rather than walking all those relationships whenever a token is signed,
+the result is kept in the `user_project_claim` table, which is refreshed for
+the affected users on every flush that touches an access rule.
+
+The same flush increments the `authorization_version` of the affected users,
+which allows caching their claims until the version changes.
+
+Optionally, claims can be issued in a hierarchical format, granting access
+through organizations and teams instead of listing all their projects. These
+grants are resolved against a locally cached mapping of organization and
+team projects, see `resolve_grants`.
+"""
+
+import logging
+from itertools import chain
+
+from sqlalchemy import (
+    and_,
+    case,
+    cast,
+    event,
+    inspect,
+    literal,
+    select,
+    union_all,
+)
+from sqlalchemy.orm import Session
+
+from .app import app
+from .cache import LRUCache, create_cache
+from .models import (
+    OrganizationProject,
+    OrganizationUser,
+    Team,
+    TeamProject,
+    TeamUser,
+    User,
+    UserProject,
+    UserProjectClaim,
+    db,
+)
+
+
+logger = logging.getLogger(__name__)
+
+ROLE_RANKS = {"read": 1, "write": 2, "admin": 3}
+
+
+def init_app(app):
+    """Create the claims and grants caches configured for the app."""
+    app.extensions["claims_cache"] = create_cache(
+        app.config["REDIS_URL"], app.config["CLAIMS_CACHE_SIZE"]
+    )
+    app.extensions["grants_cache"] = LRUCache(app.config["GRANTS_CACHE_SIZE"])
+
+
+def cached_user_claims(user_id, version):
+    """
+    Return the claims of the given user, cached per authorization version.
+
+    The claims are hierarchical if `FEAT_TOGGLE_HIERARCHICAL_CLAIMS` is set.
+
+    :param user_id: The id of the user
+    :param version: The current `authorization_version` of the user
+    """
+    cache = app.extensions["claims_cache"]
+    if app.config["FEAT_TOGGLE_HIERARCHICAL_CLAIMS"]:
+        key = f"hierarchical-claims:{user_id}"
+        compute_claims = hierarchical_user_claims
+    else:
+        key = f"claims:{user_id}"
+        compute_claims = user_claims
+
+    entry = cache.get(key)
+    if entry is not None and entry["version"] == version:
+        # Shared caches return JSON objects with string keys.
+        claims = {"usr": user_id}
+        for name in ("org", "team", "prj"):
+            if name in entry["claims"]:
+                claims[name] = {
+                    int(id): role for id, role in entry["claims"][name].items()
+                }
+        return claims
+
+    claims = compute_claims(user_id)
+    cache.set(
+        key,
+        {"version": version, "claims": claims},
+        app.config["CLAIMS_CACHE_TTL"].total_seconds(),
+    )
+    return claims
+
+
+def user_claims(user_id):
+    """Return the claims of the given user for use in a JWT."""
+    roles = db.session.query(
+        UserProjectClaim.project_id, UserProjectClaim.role
+    ).filter(UserProjectClaim.user_id == user_id)
+    return {"usr": user_id, "prj": dict(roles)}
+
+
+def resolve_claims(user_id):
+    """
+    Compute the claims of the given user directly from the access rules.
+
+    Unlike `user_claims`, this does not depend on the materialized table, but
+    still resolves all projects in a single query.
+    """
+    highest = _highest_roles([user_id]).alias("highest_roles")
+    roles = db.session.query(highest.c.project_id, highest.c.role)
+    return {"usr": user_id, "prj": dict(roles)}
+
+
+def hierarchical_user_claims(user_id):
+    """
+    Return the claims of the given user with organization and team grants.
+
+    Rather than listing every project of the users' organizations and teams,
+    `org` and `team` map their ids to the users' role in them. Only projects
+    the user has been given access to directly are listed in `prj`.
+    """
+    organizations = db.session.query(
+        OrganizationUser.organization_id, OrganizationUser.role
+    ).filter(OrganizationUser.user_id == user_id)
+    teams = db.session.query(TeamUser.team_id, TeamUser.role).filter(
+        TeamUser.user_id == user_id
+    )
+    projects = db.session.query(
+        UserProject.project_id, UserProject.role
+    ).filter(UserProject.user_id == user_id)
+    return {
+        "usr": user_id,
+        "org": dict(organizations),
+        "team": dict(teams),
+        "prj": dict(projects),
+    }
+
+
+def resolve_grants(claims):
+    """Return the project roles of the given JWT claims, expanding grants."""
+    project_roles = dict(claims["prj"])
+    for organization_id, role in claims.get("org", {}).items():
+        _merge_roles(
+            project_roles, organization_project_roles(organization_id, role)
+        )
+    for team_id in claims.get("team", {}):
+        _merge_roles(project_roles, team_project_roles(team_id))
+    return project_roles
+
+
+def organization_project_roles(organization_id, role):
+    """Return the project roles of users with `role` in an organization."""
+    cache = app.extensions["grants_cache"]
+    key = f"organization:{organization_id}:{role}"
+    project_roles = cache.get(key)
+    if project_roles is None:
+        if role == "owner":
+            # Owners have admin access to all projects in the organization and
+            # its teams.
+            project_ids = union_all(
+                select([OrganizationProject.project_id]).where(
+                    OrganizationProject.organization_id == organization_id
+                ),
+                select([TeamProject.project_id]).where(
+                    and_(
+                        TeamProject.team_id == Team.id,
+                        Team.organization_id == organization_id,
+                    )
+                ),
+            )
+            project_roles = {
+                project_id: "admin"
+                for project_id, in db.session.execute(project_ids)
+            }
+        else:
+            project_roles = dict(
+                db.session.query(
+                    OrganizationProject.project_id, OrganizationProject.role
+                ).filter(OrganizationProject.organization_id == organization_id)
+            )
+        cache.set(
+            key, project_roles, app.config["GRANTS_CACHE_TTL"].total_seconds()
+        )
+    return project_roles
+
+
+def team_project_roles(team_id):
+    """Return the project roles of members of a team."""
+    cache = app.extensions["grants_cache"]
+    key = f"team:{team_id}"
+    project_roles = cache.get(key)
+    if project_roles is None:
+        project_roles = dict(
+            db.session.query(TeamProject.project_id, TeamProject.role).filter(
+                TeamProject.team_id == team_id
+            )
+        )
+        cache.set(
+            key, project_roles, app.config["GRANTS_CACHE_TTL"].total_seconds()
+        )
+    return project_roles
+
+
+def _merge_roles(project_roles, other):
+    """Merge roles into `project_roles`, keeping the highest of each."""
+    for project_id, role in other.items():
+        current = project_roles.get(project_id)
+        if current is None or ROLE_RANKS[role] > ROLE_RANKS[current]:
+            project_roles[project_id] = role
+
+
+def rebuild():
+    """Recompute the materialized claims of all users."""
+    _refresh(db.session.connection(), None)
+
+
+def find_inconsistencies():
+    """Return ids of users whose materialized claims are out of date."""
+    expected = _highest_roles(None)
+    actual = select(
+        [
+            UserProjectClaim.user_id,
+            UserProjectClaim.project_id,
+            UserProjectClaim.role,
+        ]
+    )
+    # Compare both ways to find missing as well as superfluous rows.
+    differences = union_all(expected.except_(actual), actual.except_(expected))
+    differences = differences.alias("differences")
+    query = select([differences.c.user_id]).distinct()
+    return sorted(user_id for user_id, in db.session.execute(query))
+
+
+def _rank(role):
+    """Return an SQL expression ranking the given project role column."""
+    return case([(role == "admin", 3), (role == "write", 2)], else_=1)
+
+
+def _granted_roles():
+    """Return a selectable of every granted (user_id, project_id, rank)."""
+    owner = OrganizationUser.role == "owner"
+    return union_all(
+        # Organization owners have admin access to all projects in the
+        # organization...
+        select(
+            [
+                OrganizationUser.user_id,
+                OrganizationProject.project_id,
+                literal(3).label("rank"),
+            ]
+        ).where(
+            and_(
+                owner,
+                OrganizationUser.organization_id
+                == OrganizationProject.organization_id,
+            )
+        ),
+        # ...and to all projects of the teams in the organization.
+        select(
+            [OrganizationUser.user_id, TeamProject.project_id, literal(3)]
+        ).where(
+            and_(
+                owner,
+                OrganizationUser.organization_id == Team.organization_id,
+                TeamProject.team_id == Team.id,
+            )
+        ),
+        # Other organization members have the role assigned to the
+        # organization.
+        select(
+            [
+                OrganizationUser.user_id,
+                OrganizationProject.project_id,
+                _rank(OrganizationProject.role),
+            ]
+        ).where(
+            and_(
+                ~owner,
+                OrganizationUser.organization_id
+                == OrganizationProject.organization_id,
+            )
+        ),
+        # Team members have the role assigned to the team.
+        select(
+            [TeamUser.user_id, TeamProject.project_id, _rank(TeamProject.role)]
+        ).where(TeamUser.team_id == TeamProject.team_id),
+        # Users have the role assigned to them directly.
+        select(
+            [
+                UserProject.user_id,
+                UserProject.project_id,
+                _rank(UserProject.role),
+            ]
+        ),
+    ).alias("granted_roles")
+
+
+def _highest_roles(user_ids):
+    """Return a select of the highest role per user and project."""
+    granted = _granted_roles()
+    rank = db.func.max(granted.c.rank)
+    role = case([(rank == 3, "admin"), (rank == 2, "write")], else_="read")
+    query = select(
+        [
+            granted.c.user_id,
+            granted.c.project_id,
+            cast(role, UserProjectClaim.role.type).label("role"),
+        ]
+    ).group_by(granted.c.user_id, granted.c.project_id)
+    if user_ids is not None:
+        query = query.where(granted.c.user_id.in_(user_ids))
+    return query
+
+
+def _refresh(connection, user_ids):
+    """Replace the materialized claims of the given users (None for all)."""
+    table = UserProjectClaim.__table__
+    delete = table.delete()
+    if user_ids is not None:
+        delete = delete.where(table.c.user_id.in_(user_ids))
+    connection.execute(delete)
+    connection.execute(
+        table.insert().from_select(
+            ["user_id", "project_id", "role"], _highest_roles(user_ids)
+        )
+    )
+
+
+def _primary_keys(instance, deleted):
+    """Return the persisted and, unless deleted, current primary keys."""
+    # Deleted rows can not be reloaded, so only rely on their identity.
+    state = inspect(instance)
+    names = [column.key for column in state.mapper.primary_key]
+    keys = []
+    if state.identity is not None:
+        keys.append(dict(zip(names, state.identity)))
+    if not deleted:
+        keys.append({name: getattr(instance, name) for name in names})
+    return keys
+
+
+@event.listens_for(Session, "after_flush")
+def _update_claims(session, flush_context):
+    """Refresh the materialized claims of users affected by a flush."""
+    user_ids = set()
+    organization_ids = set()
+    owner_organization_ids = set()
+    team_ids = set()
+    changes = chain(
+        ((instance, False) for instance in session.new),
+        ((instance, False) for instance in session.dirty),
+        ((instance, True) for instance in session.deleted),
+    )
+    for instance, deleted in changes:
+        if isinstance(instance, Team):
+            # Owners of the previous and the current organization of a team
+            # lose or gain admin on its projects, as do its members.
+            history = inspect(instance).attrs.organization_id.history
+            if instance in session.dirty and not history.has_changes():
+                continue
+            owner_organization_ids.update(history.sum())
+            if not deleted:
+                owner_organization_ids.add(instance.organization_id)
+            ids, key = team_ids, "id"
+        elif isinstance(instance, (OrganizationUser, TeamUser, UserProject)):
+            ids, key = user_ids, "user_id"
+        elif isinstance(instance, OrganizationProject):
+            ids, key = organization_ids, "organization_id"
+        elif isinstance(instance, TeamProject):
+            ids, key = team_ids, "team_id"
+        else:
+            continue
+        ids.update(keys[key] for keys in _primary_keys(instance, deleted))
+
+    if not (user_ids or organization_ids or owner_organization_ids or team_ids):
+        return
+
+    connection = session.connection()
+    if organization_ids:
+        user_ids.update(
+            user_id
+            for user_id, in connection.execute(
+                select([OrganizationUser.user_id]).where(
+                    OrganizationUser.organization_id.in_(organization_ids)
+                )
+            )
+        )
+    if team_ids:
+        user_ids.update(
+            user_id
+            for user_id, in connection.execute(
+                union_all(
+                    select([TeamUser.user_id]).where(
+                        TeamUser.team_id.in_(team_ids)
+                    ),
+                    select([OrganizationUser.user_id]).where(
+                        and_(
+                            OrganizationUser.role == "owner",
+                            OrganizationUser.organization_id
+                            == Team.organization_id,
+                            Team.id.in_(team_ids),
+                        )
+                    ),
+                )
+            )
+        )
+    owner_organization_ids.discard(None)
+    if owner_organization_ids:
+        user_ids.update(
+            user_id
+            for user_id, in connection.execute(
+                select([OrganizationUser.user_id]).where(
+                    and_(
+                        OrganizationUser.role == "owner",
+                        OrganizationUser.organization_id.in_(
+                            owner_organization_ids
+                        ),
+                    )
+                )
+            )
+        )
+    user_ids.discard(None)
+    if not user_ids:
+        return
+    logger.debug(f"Refreshing materialized claims for users {user_ids}")
+    # Lock the users in a consistent order before refreshing their claims, so
+    # that concurrent transactions refresh them one after the other. Otherwise
+    # both may delete the claims before either inserts them.
+    users = User.__table__
+    locked = (
+        select([users.c.id])
+        .where(users.c.id.in_(user_ids))
+        .order_by(users.c.id)
+        .with_for_update()
+    )
+    connection.execute(
+        users.update()
+        .where(users.c.id.in_(locked))
+        .values(authorization_version=users.c.authorization_version + 1)
+    )
+    _refresh(connection, user_ids)
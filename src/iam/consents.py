@@ -0,0 +1,164 @@
+# Copyright (c) 2018, Novo Nordisk Foundation Center for Biosustainability,
+# Technical University of Denmark.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Current consents of users.
+
+The `consent` table is an append-only log of the consents given by users. The
+latest consent of each user for every type and category is kept in the
+`current_consent` table, which is updated on every flush that adds consents,
+in the same transaction.
+
+Of consents with the same timestamp, the one with the greatest id is the
+latest. Consents may be given with a timestamp in the past, so the latest
+consent is not necessarily the last one added.
+"""
+
+import logging
+from datetime import datetime
+
+from sqlalchemy import event, func, literal_column, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from .models import Consent, CurrentConsent, db
+
+
+logger = logging.getLogger(__name__)
+
+
+def current_consents(user_id):
+    """Return the current consents of the given user from `current_consent`."""
+    return (
+        Consent.query.join(
+            CurrentConsent, CurrentConsent.consent_id == Consent.id
+        )
+        .filter(CurrentConsent.user_id == user_id)
+        .order_by(CurrentConsent.type, CurrentConsent.category)
+    )
+
+
+def latest_consents(user_id):
+    """
+    Return the latest consents of the given user from the consent log.
+
+    The query is served by the `ix_consent_latest` index.
+    """
+    return (
+        Consent.query.filter(Consent.user_id == user_id)
+        .distinct(Consent.type, Consent.category)
+        .order_by(
+            Consent.type,
+            Consent.category,
+            Consent.timestamp.desc(),
+            Consent.id.desc(),
+        )
+    )
+
+
+def add_consents(user_id, consents):
+    """
+    Add the given consents of a user and return their ids in the same order.
+
+    The consents are inserted in a single statement, with their ids taken
+    from the sequence beforehand. The caller commits.
+    """
+    now = datetime.now()
+    rows = [
+        {
+            "type": consent["type"],
+            "category": consent["category"],
+            "status": consent["status"],
+            "timestamp": consent.get("timestamp") or now,
+            "valid_until": consent.get("valid_until"),
+            "message": consent.get("message"),
+            "source": consent.get("source"),
+            "user_id": user_id,
+        }
+        for consent in consents
+    ]
+    connection = db.session.connection()
+    # The rows returned by `INSERT ... RETURNING` are in no guaranteed order,
+    # so the ids are assigned to the consents explicitly. Ascending ids keep
+    # later consents of the batch later, see `_position`.
+    sequence = func.pg_get_serial_sequence(Consent.__tablename__, "id")
+    result = connection.execute(
+        select([func.nextval(sequence)]).select_from(
+            func.generate_series(1, len(rows))
+        )
+    )
+    consent_ids = sorted(consent_id for consent_id, in result)
+    for row, consent_id in zip(rows, consent_ids):
+        row["id"] = consent_id
+    connection.execute(insert(Consent.__table__).values(rows))
+    # Core statements bypass the session's flush listener.
+    _update(connection, consent_ids)
+    return consent_ids
+
+
+def rebuild():
+    """Recompute the current consents of all users from the consent log."""
+    connection = db.session.connection()
+    connection.execute(CurrentConsent.__table__.delete())
+    _update(connection, None)
+
+
+def _update(connection, consent_ids):
+    """Make the given consents current, unless later ones exist (None: all)."""
+    table = CurrentConsent.__table__
+    keys = (Consent.user_id, Consent.type, Consent.category)
+    latest = (
+        select(keys + (Consent.id,))
+        .distinct(*keys)
+        .order_by(*keys, Consent.timestamp.desc(), Consent.id.desc())
+    )
+    if consent_ids is not None:
+        latest = latest.where(Consent.id.in_(consent_ids))
+    statement = insert(table).from_select(
+        ["user_id", "type", "category", "consent_id"], latest
+    )
+    connection.execute(
+        statement.on_conflict_do_update(
+            index_elements=[table.c.user_id, table.c.type, table.c.category],
+            set_={"consent_id": statement.excluded.consent_id},
+            # Replace the current consent only with a later one. The columns
+            # are given as literals, as SQLAlchemy does not correlate the
+            # subqueries with the conflicting and the excluded row.
+            where=_position(literal_column("current_consent.consent_id"))
+            < _position(literal_column("excluded.consent_id")),
+        )
+    )
+
+
+def _position(consent_id):
+    """Return an SQL expression ordering consents from earliest to latest."""
+    consent = Consent.__table__.alias()
+    return (
+        select([func.row(consent.c.timestamp, consent.c.id)])
+        .where(consent.c.id == consent_id)
+        .as_scalar()
+    )
+
+
+@event.listens_for(Session, "after_flush")
+def _update_current_consents(session, flush_context):
+    """Make the consents added by a flush current."""
+    consent_ids = [
+        instance.id for instance in session.new if isinstance(instance, Consent)
+    ]
+    if not consent_ids:
+        return
+    logger.debug(f"Updating current consents for consents {consent_ids}")
+    _update(session.connection(), consent_ids)
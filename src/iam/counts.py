@@ -0,0 +1,119 @@
+# Copyright (c) 2018, Novo Nordisk Foundation Center for Biosustainability,
+# Technical University of Denmark.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Counts of entities in the database, exposed as metrics.
+
+Counting the rows of a table scans it on Postgres, so the counts are not taken
+on scrapes. Instead, a single process refreshes the gauges in the background
+every `METRICS_COUNTS_INTERVAL`. Under gunicorn, this is the master, which
+starts refreshing when it is ready, see `gunicorn.py`. Otherwise the process
+starts refreshing on its first scrape, which returns without waiting for the
+counts. With `METRICS_COUNTS_ESTIMATE`, the planner's estimates from `pg_class`
+are used instead of counting the rows.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, func, select, text
+from sqlalchemy.pool import NullPool
+
+from .metrics import ORGANIZATION_COUNT, PROJECT_COUNT, USER_COUNT
+from .models import Organization, Project, User
+
+
+logger = logging.getLogger(__name__)
+
+GAUGES = [
+    (User, USER_COUNT),
+    (Organization, ORGANIZATION_COUNT),
+    (Project, PROJECT_COUNT),
+]
+
+
+def init_app(app):
+    """Create the entity counts configured for the app."""
+    app.extensions["entity_counts"] = EntityCounts(
+        app,
+        app.config["METRICS_COUNTS_INTERVAL"].total_seconds(),
+        app.config["METRICS_COUNTS_ESTIMATE"],
+    )
+
+
+class EntityCounts:
+    """Entity count gauges, refreshed in the background."""
+
+    def __init__(self, app, interval, estimate=False):
+        self.app = app
+        self.interval = interval
+        self.estimate = estimate
+        # Processes forked after starting, like gunicorn workers, inherit this
+        # and leave the refresh to their parent.
+        self._started = False
+        self._lock = threading.Lock()
+        # Connections are not pooled, so that forked processes do not inherit
+        # a connection in use by the refresh.
+        self._engine = create_engine(
+            app.config["SQLALCHEMY_DATABASE_URI"], poolclass=NullPool
+        )
+
+    def start(self):
+        """Start refreshing the gauges in the background, once."""
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def refresh(self):
+        """Set the gauges to the current counts."""
+        labels = ("iam", os.environ["ENVIRONMENT"])
+        with self._engine.connect() as connection:
+            for model, gauge in GAUGES:
+                gauge.labels(*labels).set(self.count(connection, model))
+
+    def count(self, connection, model):
+        """Return the number of rows of the given model, or its estimate."""
+        table = model.__table__
+        if self.estimate:
+            reltuples = connection.execute(
+                text(
+                    "SELECT reltuples FROM pg_class "
+                    "WHERE oid = CAST(:table AS regclass)"
+                ),
+                table=connection.dialect.identifier_preparer.format_table(
+                    table
+                ),
+            ).scalar()
+            # Tables which were never vacuumed or analyzed have no estimate.
+            if reltuples >= 0:
+                return int(reltuples)
+        return connection.execute(
+            select([func.count()]).select_from(table)
+        ).scalar()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                # The gauges keep their last values until the next refresh.
+                logger.exception("Failed to refresh the entity counts")
+            time.sleep(self.interval)
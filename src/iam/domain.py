@@ -15,34 +15,46 @@
 
 """Implement domain logic."""
 
+import logging
 import secrets
 from datetime import datetime
 
-from jose import jwt
+from sqlalchemy import or_, select
+from sqlalchemy.dialects.postgresql import insert
 
 from .app import app
+from .claims import cached_user_claims
+from .jwt import encode_project_claims
 from .models import RefreshToken, User, db
 
 
+logger = logging.getLogger(__name__)
+
+
 def sign_claims(user):
     """Return signed jwt and refresh token for the given authenticated user."""
+    return sign_user_claims(user.id, user.authorization_version)
+
+
+def sign_user_claims(user_id, version):
+    """
+    Return signed jwt and refresh token for the given authenticated user.
+
+    Commits the refresh token, along with any pending changes of the session.
+
+    :param user_id: The id of the user
+    :param version: The current `authorization_version` of the user
+    """
     refresh_token = RefreshToken(
-        user=user,
-        user_id=user.id,
+        user_id=user_id,
         token=secrets.token_hex(32),
         expiry=(datetime.now() + app.config["REFRESH_TOKEN_VALIDITY"]),
     )
     db.session.add(refresh_token)
     db.session.commit()
-    claims = {
-        "exp": int((datetime.now() + app.config["JWT_VALIDITY"]).strftime("%s"))
-    }
-    claims.update(user.claims)
-    signed_token = jwt.encode(
-        claims, app.config["RSA_PRIVATE_KEY"], app.config["ALGORITHM"]
-    )
+    claims = user_jwt_claims(user_id, version)
     return {
-        "jwt": signed_token,
+        "jwt": app.extensions["jwt_signer"].sign(claims),
         "refresh_token": {
             "val": refresh_token.token,
             "exp": int(refresh_token.expiry.strftime("%s")),
@@ -50,20 +62,76 @@ def sign_claims(user):
     }
 
 
-def create_firebase_user(uid, decoded_token):
-    """Create a Firebase user from the provided uid and decoded token."""
+def user_jwt_claims(user_id, version):
+    """
+    Return the claims to sign in a JWT for the given user.
+
+    :param user_id: The id of the user
+    :param version: The current `authorization_version` of the user
+    """
+    claims = {
+        "exp": int((datetime.now() + app.config["JWT_VALIDITY"]).strftime("%s"))
+    }
+    claims.update(cached_user_claims(user_id, version))
+    if app.config["FEAT_TOGGLE_COMPACT_CLAIMS"]:
+        claims["prjc"] = encode_project_claims(claims.pop("prj"))
+    return claims
+
+
+def rehash_password(user_id, password, encoded):
+    """
+    Encode the password of the given user with the current hasher settings.
+
+    The password is only replaced if it is still the given encoded password, so
+    that concurrent password changes are kept.
+    """
+    try:
+        User.query.filter(User.id == user_id, User.password == encoded).update(
+            {"password": User.encode_password(password)}
+        )
+        db.session.commit()
+    except Exception:
+        logger.exception(f"Failed to rehash the password of user {user_id}")
+        db.session.rollback()
+
+
+def resolve_firebase_user(uid, decoded_token):
+    """
+    Return the id and authorization version of the user of a Firebase login.
+
+    The user is looked up by Firebase uid, or by email if they signed up with a
+    different provider, in a single query. Unknown users are created without
+    committing, so that the caller can commit them along with their refresh
+    token.
+    """
+    email = decoded_token["email"]
+    row = db.session.execute(
+        select([User.id, User.authorization_version])
+        .where(or_(User.firebase_uid == uid, User.email == email))
+        # Prefer the user with the given uid over one with the same email.
+        .order_by((User.firebase_uid == uid).desc().nullslast())
+        .limit(1)
+    ).first()
+    if row is not None:
+        return row.id, row.authorization_version
+
     name = decoded_token.get("name", "")
     if " " in name:
         first_name, last_name = name.split(None, 1)
     else:
         first_name, last_name = name, ""
-
-    user = User(
+    statement = insert(User.__table__).values(
         firebase_uid=uid,
         first_name=first_name,
         last_name=last_name,
-        email=decoded_token["email"],
+        email=email,
     )
-    db.session.add(user)
-    db.session.commit()
-    return user
+    # A concurrent first login may have created the user in the meantime. The
+    # no-op update makes the existing row available to `RETURNING`.
+    row = db.session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[User.email],
+            set_={"email": statement.excluded.email},
+        ).returning(User.id, User.authorization_version)
+    ).first()
+    return row.id, row.authorization_version
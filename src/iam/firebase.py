@@ -0,0 +1,249 @@
+# Copyright (c) 2018, Novo Nordisk Foundation Center for Biosustainability,
+# Technical University of Denmark.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Verification of Firebase ID tokens.
+
+ID tokens are verified locally against Google's public certificates, as
+described in https://firebase.google.com/docs/auth/admin/verify-id-tokens. The
+certificates are cached for the max-age given by Google and refreshed in the
+background before they expire, so that logins do not wait for them.
+"""
+
+import base64
+import logging
+import pathlib
+import re
+import threading
+import time
+
+import requests
+from jose import jwk, jwt
+from pyasn1.codec.der import decoder, encoder
+from pyasn1_modules import rfc2459
+
+from .jwt import Signer, Verifier
+from .keys import public_jwk
+
+
+logger = logging.getLogger(__name__)
+
+CERTIFICATES_URL = (
+    "https://www.googleapis.com/robot/v1/metadata/x509/"
+    "securetoken@system.gserviceaccount.com"
+)
+
+
+def init_app(app):
+    """Add the Firebase ID token verifier to the app."""
+    if app.config["FIREBASE_TEST_KEY"]:
+        logger.warning("Verifying Firebase ID tokens with a local test key")
+        private_key = pathlib.Path(
+            "keys", app.config["FIREBASE_TEST_KEY"]
+        ).read_text()
+        certificates = LocalKeyPair(private_key)
+    else:
+        certificates = GoogleCertificates()
+    app.extensions["firebase_verifier"] = FirebaseVerifier(
+        app.config["FIREBASE_PROJECT_ID"], certificates
+    )
+
+
+def certificate_public_key(certificate):
+    """Return the PEM encoded public key of a PEM encoded X.509 certificate."""
+    body = "".join(
+        line
+        for line in certificate.strip().splitlines()
+        if not line.startswith("-----")
+    )
+    asn1_certificate, _ = decoder.decode(
+        base64.b64decode(body), asn1Spec=rfc2459.Certificate()
+    )
+    public_key_info = encoder.encode(
+        asn1_certificate["tbsCertificate"]["subjectPublicKeyInfo"]
+    )
+    return (
+        "-----BEGIN PUBLIC KEY-----\n"
+        f"{base64.encodebytes(public_key_info).decode()}"
+        "-----END PUBLIC KEY-----\n"
+    )
+
+
+class FirebaseVerifier:
+    """Verify Firebase ID tokens issued for the given Firebase project."""
+
+    # The clock skew allowed between Google and us, in seconds.
+    leeway = 30
+
+    def __init__(self, project_id, certificates):
+        self.project_id = project_id
+        self.issuer = f"https://securetoken.google.com/{project_id}"
+        self.certificates = certificates
+
+    def verify(self, token):
+        """
+        Return the claims of the given ID token.
+
+        :raises jose.JWTError: If the token is invalid or expired
+        :raises requests.RequestException: If the certificates could not be
+            fetched
+        """
+        claims = self.certificates.verifier().verify(
+            token,
+            audience=self.project_id,
+            issuer=self.issuer,
+            leeway=self.leeway,
+        )
+        # Tokens must have been issued, and the user authenticated, in the
+        # past.
+        now = time.time()
+        for claim in ("iat", "auth_time"):
+            issued = claims.get(claim)
+            if not isinstance(issued, (int, float)):
+                raise jwt.JWTClaimsError(f"Invalid {claim}")
+            if issued > now + self.leeway:
+                raise jwt.JWTClaimsError(
+                    f"The token is not yet valid ({claim})"
+                )
+        subject = claims.get("sub")
+        if not isinstance(subject, str) or not 0 < len(subject) <= 128:
+            raise jwt.JWTClaimsError("Invalid subject")
+        return claims
+
+    def create_token(self, uid, email, expires_in=3600):
+        """Return an ID token signed with the local test key."""
+        now = int(time.time())
+        claims = {
+            "iss": self.issuer,
+            "aud": self.project_id,
+            "auth_time": now,
+            "iat": now,
+            "exp": now + expires_in,
+            "sub": uid,
+            "user_id": uid,
+            "email": email,
+            "firebase": {"sign_in_provider": "password"},
+        }
+        # Only a `LocalKeyPair` can sign tokens.
+        return self.certificates.sign(claims)
+
+
+class GoogleCertificates:
+    """Google's public certificates for Firebase ID tokens."""
+
+    # Refresh the certificates in the background this many seconds before they
+    # expire. Without a max-age, the certificates are fetched again after the
+    # default.
+    refresh_margin = 300
+    default_max_age = 60
+    # After failing to fetch the certificates, wait this many seconds before
+    # trying again.
+    retry_delay = 10
+
+    def __init__(self, url=CERTIFICATES_URL, timeout=10):
+        self.url = url
+        self.timeout = timeout
+        self._verifier = None
+        self._expires = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._retry = 0
+
+    def verifier(self):
+        """
+        Return a `Verifier` for the current certificates.
+
+        Once expired, the certificates are used until they can be fetched
+        again.
+
+        :raises requests.RequestException: If no certificates could be fetched
+        """
+        remaining = self._expires - time.monotonic()
+        if self._verifier is None or remaining <= 0:
+            with self._lock:
+                # Another thread may have refreshed them in the meantime.
+                if self._expires <= time.monotonic():
+                    self._refresh_expired()
+        elif remaining <= self.refresh_margin and not self._refreshing:
+            self._refreshing = True
+            threading.Thread(
+                target=self._refresh_in_background, daemon=True
+            ).start()
+        return self._verifier
+
+    def refresh(self):
+        """Fetch the certificates, and cache them for their max-age."""
+        response = requests.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        match = re.search(
+            r"max-age=(\d+)", response.headers.get("Cache-Control", "")
+        )
+        max_age = int(match.group(1)) if match else self.default_max_age
+        self._verifier = Verifier(
+            [
+                {
+                    **jwk.construct(
+                        certificate_public_key(certificate), "RS256"
+                    ).to_dict(),
+                    "kid": kid,
+                }
+                for kid, certificate in response.json().items()
+            ]
+        )
+        self._expires = time.monotonic() + max_age
+        logger.debug(f"Fetched Firebase certificates, max-age {max_age}")
+
+    def _refresh_expired(self):
+        if self._verifier is not None and time.monotonic() < self._retry:
+            return
+        try:
+            self.refresh()
+        except requests.RequestException:
+            self._retry = time.monotonic() + self.retry_delay
+            if self._verifier is None:
+                raise
+            logger.exception(
+                "Failed to fetch the Firebase certificates, using the expired "
+                "ones"
+            )
+
+    def _refresh_in_background(self):
+        try:
+            with self._lock:
+                self.refresh()
+        except Exception:
+            # The current certificates are used until they expire, after
+            # which the next login fetches them again.
+            logger.exception("Failed to refresh the Firebase certificates")
+        finally:
+            self._refreshing = False
+
+
+class LocalKeyPair:
+    """A local key pair in place of Google's certificates, for offline tests."""
+
+    def __init__(self, private_key, kid="test"):
+        self.signer = Signer(private_key, "RS256", kid)
+        self._verifier = Verifier(
+            [public_jwk({"kid": kid, "alg": "RS256", "key": private_key})]
+        )
+
+    def verifier(self):
+        """Return a `Verifier` for the public key."""
+        return self._verifier
+
+    def sign(self, claims):
+        """Return the given claims as a signed JWT."""
+        return self.signer.sign(claims)
@@ -0,0 +1,58 @@
+# Copyright (c) 2018, Novo Nordisk Foundation Center for Biosustainability,
+# Technical University of Denmark.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cooperative database I/O for gevent workers.
+
+psycopg2 waits for the database in C, which gevent's monkey-patching does not
+reach, so a slow query would block all requests of a worker. With the wait
+callback installed, psycopg2 hands the waits to gevent instead, like
+`psycogreen.gevent`.
+"""
+
+import gevent.monkey
+from gevent.socket import wait_read, wait_write
+from psycopg2 import OperationalError, extensions
+
+
+def patch_psycopg():
+    """Make psycopg2 yield to other greenlets while waiting for the database."""
+    extensions.set_wait_callback(wait_callback)
+
+
+def wait_callback(connection, timeout=None):
+    """Wait for the given connection without blocking other greenlets."""
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(connection.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(connection.fileno(), timeout=timeout)
+        else:
+            raise OperationalError(f"Bad result from poll: {state}")
+
+
+def check():
+    """Raise an error if gevent is patched in, but psycopg2 is not."""
+    if (
+        gevent.monkey.is_module_patched("socket")
+        and extensions.get_wait_callback() is None
+    ):
+        raise RuntimeError(
+            "gevent is patched in, but psycopg2 would block the worker on "
+            "database queries. Call `iam.green.patch_psycopg` at startup."
+        )
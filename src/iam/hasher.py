@@ -18,8 +18,117 @@
 import base64
 import hashlib
 import hmac
+import os
 import secrets
+import statistics
 import string
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import HASHER_QUEUE_DEPTH, HASHER_WAIT_TIME
+
+
+def init_app(app):
+    """Add the executor for password hashing to the app."""
+    app.extensions["hasher_executor"] = Executor(app.config["HASHER_POOL_SIZE"])
+
+
+class Executor:
+    """
+    Run password hashing in a pool of native threads.
+
+    Hashing releases the GIL, so gevent workers can keep serving other
+    greenlets while a password is hashed. With a pool size of 0, hashing is run
+    inline in the calling greenlet.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._pool = None
+
+    def run(self, function, *args, **kwargs):
+        """Call the given function in the pool and wait for its result."""
+        if self.size == 0:
+            return function(*args, **kwargs)
+        if self._pool is None:
+            # Created on first use, so that gunicorn workers do not inherit a
+            # pool without threads from the master process.
+            from gevent.threadpool import ThreadPool
+
+            self._pool = ThreadPool(self.size)
+        labels = ("iam", os.environ["ENVIRONMENT"])
+        submitted = time.monotonic()
+        HASHER_QUEUE_DEPTH.labels(*labels).inc()
+        try:
+            # Metrics are only updated here in the greenlet, as their locks are
+            # not safe to use from the native threads.
+            started, result = self._pool.apply(
+                _timed, (function, *args), kwargs
+            )
+        finally:
+            HASHER_QUEUE_DEPTH.labels(*labels).dec()
+        HASHER_WAIT_TIME.labels(*labels).observe(started - submitted)
+        return result
+
+    def spawn(self, function, *args):
+        """
+        Call the given function in a new greenlet, without waiting for it.
+
+        With a pool size of 0, the function is called inline instead.
+        """
+        if self.size == 0:
+            function(*args)
+        else:
+            import gevent
+
+            gevent.spawn(function, *args)
+
+
+def _timed(function, *args, **kwargs):
+    """Return the start time and the result of calling the given function."""
+    return time.monotonic(), function(*args, **kwargs)
+
+
+class PBKDF2Hasher:
+    """PBKDF2 with HMAC-SHA256."""
+
+    algorithm = "pbkdf2_sha256"
+    parameters = ("iterations",)
+    defaults = {"iterations": 100000}
+    # Settings of the cost parameter tried by `calibrate`
+    costs = {"iterations": [12500 * 2 ** i for i in range(8)]}
+
+    def hash(self, password, salt, iterations):
+        return hashlib.pbkdf2_hmac(
+            "sha256", password, salt.encode(), iterations
+        )
+
+
+class ScryptHasher:
+    """The scrypt memory-hard key derivation function."""
+
+    algorithm = "scrypt"
+    parameters = ("n", "r", "p")
+    defaults = {"n": 2 ** 14, "r": 8, "p": 1}
+    # Settings of the cost parameter tried by `calibrate`
+    costs = {"n": [2 ** i for i in range(10, 18)]}
+
+    def hash(self, password, salt, n, r, p):
+        # scrypt requires 128 * n * r bytes of memory; allow twice that.
+        return hashlib.scrypt(
+            password,
+            salt=salt.encode(),
+            n=n,
+            r=r,
+            p=p,
+            maxmem=256 * n * r,
+            dklen=32,
+        )
+
+
+HASHERS = {
+    hasher.algorithm: hasher for hasher in (PBKDF2Hasher(), ScryptHasher())
+}
 
 
 def new_salt(n=12):
@@ -29,23 +138,116 @@ def new_salt(n=12):
     return "".join(salt)
 
 
-def encode(password, salt=None, iterations=100000):
-    """Encode the given password."""
+def encode(password, salt=None, algorithm="pbkdf2_sha256", **parameters):
+    """
+    Encode the given password.
+
+    The encoded password is `<algorithm>$<parameters>$<salt>$<hash>`, with the
+    cost parameters of the algorithm separated by `$`. Parameters which are not
+    given default to those in the `defaults` of the hasher.
+    """
+    hasher = HASHERS[algorithm]
+    parameters = {**hasher.defaults, **parameters}
     if salt is None:
         salt = new_salt()
     if not isinstance(password, bytes):
         password = password.encode()
-    hash = hashlib.pbkdf2_hmac(
-        hashlib.sha256().name, password, salt.encode(), iterations, None
-    )
+    hash = hasher.hash(password, salt, **parameters)
     hash = base64.b64encode(hash).decode("ascii").strip()
-    return "{:d}${}${}".format(iterations, salt, hash)
+    values = [str(parameters[name]) for name in hasher.parameters]
+    return "$".join([algorithm, *values, salt, hash])
+
+
+def decode(encoded):
+    """
+    Return the algorithm, parameters, salt and hash of an encoded password.
+
+    Passwords encoded as `<iterations>$<salt>$<hash>`, before the algorithm was
+    included, are PBKDF2-SHA256.
+
+    :raises ValueError: If the encoding or algorithm is unknown
+    """
+    algorithm = encoded.split("$", 1)[0]
+    if algorithm.isdigit():
+        iterations, salt, hash = encoded.split("$", 2)
+        return "pbkdf2_sha256", {"iterations": int(iterations)}, salt, hash
+    try:
+        hasher = HASHERS[algorithm]
+    except KeyError:
+        raise ValueError(f"Unknown password hasher '{algorithm}'")
+    *values, salt, hash = encoded.split("$")[1:]
+    if len(values) != len(hasher.parameters):
+        raise ValueError(f"Invalid {algorithm} encoded password")
+    parameters = dict(zip(hasher.parameters, map(int, values)))
+    return algorithm, parameters, salt, hash
 
 
 def verify(password, encoded):
     """Return True if the given password matches the given encoded password."""
     if not isinstance(password, bytes):
         password = password.encode()
-    iterations, salt, hash = encoded.split("$", 2)
-    encoded_new = encode(password, salt, int(iterations))
-    return hmac.compare_digest(encoded.encode(), encoded_new.encode())
+    algorithm, parameters, salt, hash = decode(encoded)
+    hash_new = HASHERS[algorithm].hash(password, salt, **parameters)
+    hash_new = base64.b64encode(hash_new).decode("ascii").strip()
+    return hmac.compare_digest(hash.encode(), hash_new.encode())
+
+
+def needs_rehash(encoded, algorithm="pbkdf2_sha256", **parameters):
+    """
+    Return True if the encoded password differs from the given settings.
+
+    Passwords encoded without the algorithm always need to be rehashed.
+    """
+    if not encoded.startswith(f"{algorithm}$"):
+        return True
+    parameters = {**HASHERS[algorithm].defaults, **parameters}
+    return decode(encoded)[1] != parameters
+
+
+def measure(algorithm, parameters, rounds=5):
+    """Return the median wall time in seconds to encode a password."""
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        encode("calibration", algorithm=algorithm, **parameters)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def calibrate(algorithm, budget, rounds=5):
+    """
+    Measure the time to encode a password with increasing cost parameters.
+
+    Costs are tried in increasing order until one exceeds the budget.
+
+    :param algorithm: The name of the hasher to calibrate
+    :param budget: The time budget for encoding a password, in seconds
+    :param rounds: The number of passwords to encode for each setting
+    :return: A list of `(parameters, seconds)` tuples
+    """
+    hasher = HASHERS[algorithm]
+    ((name, costs),) = hasher.costs.items()
+    timings = []
+    for cost in costs:
+        parameters = {name: cost}
+        seconds = measure(algorithm, parameters, rounds)
+        timings.append((parameters, seconds))
+        if seconds > budget:
+            break
+    return timings
+
+
+def throughput(algorithm, parameters, threads, count=None):
+    """
+    Return the number of passwords per second verified with the given threads.
+
+    This is an estimate of the logins per second one worker can sustain with
+    a hashing pool of the given size.
+    """
+    if count is None:
+        count = 4 * threads
+    encoded = encode("calibration", algorithm=algorithm, **parameters)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(verify, ["calibration"] * count, [encoded] * count))
+    return count / (time.perf_counter() - start)
@@ -15,56 +15,299 @@
 
 """Handling and verification of JWT claims."""
 
+import base64
+import hashlib
 import logging
+import os
+import time
 from functools import wraps
+from itertools import accumulate
 
 from flask import abort, g, request
-from jose import jwt
+from jose import jwk, jwt
+from werkzeug.local import LocalProxy
+
+from .cache import LRUCache
+from .claims import resolve_grants
+from .keys import prepared_key, public_jwk
+from .metrics import JWT_CACHE_HITS, JWT_CACHE_MISSES
 
 
 logger = logging.getLogger(__name__)
 
+ACCESS_LEVELS = {
+    "admin": 3,
+    "write": 2,
+    "read": 1,
+}
+
+# Roles in the order their project ids are listed in compact project claims.
+COMPACT_ROLES = ("admin", "write", "read")
+
+
+class Signer:
+    """Sign JWT claims with a private key which is parsed only once."""
+
+    def __init__(self, private_key, algorithm, kid=None):
+        self.algorithm = algorithm
+        self.headers = {"kid": kid} if kid else None
+        # python-jose accepts the backend's native key object in place of a
+        # PEM string or JWK dict, which would otherwise be parsed per call.
+        self._key = prepared_key(jwk.construct(private_key, algorithm))
+
+    def sign(self, claims):
+        """Return the given claims as a signed JWT."""
+        return jwt.encode(claims, self._key, self.algorithm, self.headers)
+
+
+class Verifier:
+    """
+    Verify JWTs with any of the given public keys.
+
+    The public keys are given as JWK dicts including their `kid` and `alg`.
+    The key is selected by the `kid` header of the token. Tokens without a key
+    id are verified with all keys for their algorithm.
+    """
+
+    def __init__(self, public_keys):
+        self.public_keys = public_keys
+        self.algorithms = sorted({key["alg"] for key in public_keys})
+        self._keys = {
+            public_key["kid"]: (
+                public_key["alg"],
+                prepared_key(jwk.construct(public_key, public_key["alg"])),
+            )
+            for public_key in public_keys
+        }
+
+    def verify(self, token, audience=None, issuer=None, leeway=0):
+        """
+        Return the claims of the given JWT.
+
+        :param audience: The required `aud` claim, if any
+        :param issuer: The required `iss` claim, if any
+        :param leeway: The clock skew allowed for the expiry, in seconds
+        :raises jose.JWTError: If the token is invalid or expired
+        """
+        options = {"leeway": leeway}
+        header = jwt.get_unverified_header(token)
+        if "kid" in header:
+            try:
+                algorithm, key = self._keys[header["kid"]]
+            except KeyError:
+                raise jwt.JWTError(f"Unknown key id '{header['kid']}'")
+            return jwt.decode(
+                token,
+                [key],
+                [algorithm],
+                options=options,
+                audience=audience,
+                issuer=issuer,
+            )
+        keys = [
+            key
+            for algorithm, key in self._keys.values()
+            if algorithm == header.get("alg")
+        ]
+        return jwt.decode(
+            token,
+            keys,
+            self.algorithms,
+            options=options,
+            audience=audience,
+            issuer=issuer,
+        )
+
 
 def init_app(app):
-    """Add the jwt decoding middleware to the app."""
+    """Add JWT signing, verification and the decoding middleware to the app."""
+    # The first key of the key ring signs new tokens. All keys are published
+    # and accepted, to allow for key rotation.
+    signing_key = app.config["JWT_KEYS"][0]
+    app.extensions["jwt_signer"] = Signer(
+        signing_key["key"], signing_key["alg"], signing_key["kid"]
+    )
+    app.extensions["jwt_verifier"] = verifier = Verifier(
+        [public_jwk(key) for key in app.config["JWT_KEYS"]]
+    )
+    app.extensions["jwt_cache"] = cache = LRUCache(app.config["JWT_CACHE_SIZE"])
 
     @app.before_request
+    def lazy_jwt():
+        # Claims are only decoded if the endpoint uses them. Note that `g` may
+        # outlive the request, e.g. in tests, so reset any decoded claims.
+        g.pop("jwt", None)
+        g.pop("jwt_project_claims", None)
+        g.jwt_valid = LocalProxy(lambda: decode_jwt()[0])
+        g.jwt_claims = LocalProxy(lambda: decode_jwt()[1])
+
     def decode_jwt():
-        if "Authorization" not in request.headers:
-            logger.debug("No JWT provided")
-            g.jwt_valid = False
-            g.jwt_claims = {"prj": {}}
-            return
-
-        auth = request.headers["Authorization"]
-        if not auth.startswith("Bearer "):
-            logger.debug(
-                f"No JWT provided, unknown Authorization header: {auth}"
-            )
-            g.jwt_valid = False
-            g.jwt_claims = {"prj": {}}
-            return
+        """Return whether the request has a valid JWT, and its claims."""
+        if "jwt" not in g:
+            g.jwt = _decode_jwt(verifier, cache)
+        return g.jwt
+
+
+def _decode_jwt(verifier, cache):
+    """Verify the JWT of the current request, aborting if it is invalid."""
+    if "Authorization" not in request.headers:
+        logger.debug("No JWT provided")
+        return False, {"prj": {}}
 
+    auth = request.headers["Authorization"]
+    if not auth.startswith("Bearer "):
+        logger.debug(f"No JWT provided, unknown Authorization header: {auth}")
+        return False, {"prj": {}}
+
+    # Note: `auth` is guaranteed to contain a space due to the above check for
+    # `auth.startswith('Bearer ')`.
+    token = auth.split(" ", 1)[1]
+    # Tokens are cached by their hash until they expire, to skip the signature
+    # verification for repeated requests with the same token.
+    key = hashlib.sha256(token.encode()).hexdigest()
+    labels = ("iam", os.environ["ENVIRONMENT"])
+    claims = cache.get(key)
+    if claims is not None:
+        JWT_CACHE_HITS.labels(*labels).inc()
+    else:
+        JWT_CACHE_MISSES.labels(*labels).inc()
         try:
-            # Note: `auth` is guaranteed to contain a space due to the above
-            # check for `auth.startswith('Bearer ')`.
-            token = auth.split(" ", 1)[1]
-            g.jwt_claims = jwt.decode(
-                token, app.config["RSA_PUBLIC_KEY"], app.config["ALGORITHM"]
-            )
-            # JSON object names can only be strings. Map project ids to ints for
-            # easier handling
-            g.jwt_claims["prj"] = {
-                int(key): value for key, value in g.jwt_claims["prj"].items()
-            }
-            g.jwt_valid = True
-            logger.debug(f"JWT claims accepted: {g.jwt_claims}")
+            claims = decode_claims(verifier.verify(token))
         except (
             jwt.JWTError,
             jwt.ExpiredSignatureError,
             jwt.JWTClaimsError,
         ) as e:
             abort(401, f"JWT authentication failed: {e}")
+        except ValueError as e:
+            abort(401, f"JWT authentication failed: Invalid claims: {e}")
+        if "exp" in claims:
+            cache.set(key, claims, claims["exp"] - time.time())
+        else:
+            cache.set(key, claims)
+    logger.debug(f"JWT claims accepted: {claims}")
+    return True, claims
+
+
+def decode_claims(claims):
+    """
+    Return the given verified JWT claims for use in `g.jwt_claims`.
+
+    :raises ValueError: If the project, organization or team claims are invalid
+    """
+    names = ("prj", "org", "team")
+    if "prjc" in claims:
+        claims["prj"] = decode_project_claims(claims.pop("prjc"))
+        names = ("org", "team")
+    # JSON object names can only be strings. Map project, organization and team
+    # ids to ints for easier handling
+    for name in names:
+        if name in claims:
+            claims[name] = {
+                int(key): value for key, value in claims[name].items()
+            }
+    return claims
+
+
+def encode_project_claims(project_claims):
+    """
+    Encode project claims as a compact string, for use in the `prjc` claim.
+
+    For each role in `COMPACT_ROLES`, the number of projects with that role is
+    followed by the differences between their sorted ids. All numbers are
+    written as unsigned LEB128 varints and the result is base64url encoded
+    without padding.
+    """
+    buffer = bytearray()
+    for role in COMPACT_ROLES:
+        project_ids = sorted(
+            project_id
+            for project_id, claim_level in project_claims.items()
+            if claim_level == role
+        )
+        _write_varint(buffer, len(project_ids))
+        previous = 0
+        for project_id in project_ids:
+            _write_varint(buffer, project_id - previous)
+            previous = project_id
+    return base64.urlsafe_b64encode(bytes(buffer)).rstrip(b"=").decode()
+
+
+def decode_project_claims(encoded):
+    """
+    Decode project claims encoded by `encode_project_claims`.
+
+    :raises ValueError: If the encoded claims are malformed
+    """
+    padding = "=" * (-len(encoded) % 4)
+    values = _read_varints(base64.urlsafe_b64decode(encoded + padding))
+    project_claims = {}
+    position = 0
+    for role in COMPACT_ROLES:
+        if position >= len(values):
+            raise ValueError("Truncated project claims")
+        count = values[position]
+        deltas = values[position + 1 : position + 1 + count]
+        if len(deltas) < count:
+            raise ValueError("Truncated project claims")
+        project_claims.update(dict.fromkeys(accumulate(deltas), role))
+        position += 1 + count
+    return project_claims
+
+
+def _write_varint(buffer, value):
+    """Append the given unsigned integer to the buffer as a LEB128 varint."""
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varints(data):
+    """Return all LEB128 varints in the given bytes."""
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    if shift:
+        raise ValueError("Truncated varint")
+    return values
+
+
+def project_claims():
+    """
+    Return the project roles claimed by the current JWT.
+
+    Hierarchical claims are expanded to include all projects of the claimed
+    organizations and teams.
+    """
+    if "org" not in g.jwt_claims and "team" not in g.jwt_claims:
+        return g.jwt_claims["prj"]
+    if "jwt_project_claims" not in g:
+        g.jwt_project_claims = resolve_grants(g.jwt_claims)
+    return g.jwt_project_claims
+
+
+def has_access(project_claims, project_id, required_level):
+    """
+    Return true if the project claims grant the required access level.
+
+    :param project_claims: Mapping of project ids to claimed access levels
+    :param project_id: The project ID to verify access for
+    :param required_level: The required access level (admin, write or read)
+    """
+    if required_level not in ACCESS_LEVELS:
+        raise ValueError(f"Invalid claim level '{required_level}'")
+    claim_level = project_claims.get(project_id)
+    return (
+        claim_level is not None
+        and ACCESS_LEVELS[claim_level] >= ACCESS_LEVELS[required_level]
+    )
 
 
 def jwt_required(function):
@@ -95,12 +338,6 @@ def jwt_require_claim(project_id, required_level):
     :param required_level: The required access level (admin, write or read)
     :return: None
     """
-    ACCESS_LEVELS = {
-        "admin": 3,
-        "write": 2,
-        "read": 1,
-    }
-
     if required_level not in ACCESS_LEVELS:
         raise ValueError(f"Invalid claim level '{required_level}'")
 
@@ -114,7 +351,7 @@ def jwt_require_claim(project_id, required_level):
         abort(403, "Public data can not be modified")
 
     try:
-        claim_level = g.jwt_claims["prj"][project_id]
+        claim_level = project_claims()[project_id]
     except KeyError:
         # The given project id is not included in the users claims
         abort(403, "You do not have access to the requested resource")
@@ -0,0 +1,140 @@
+# Copyright (c) 2018, Novo Nordisk Foundation Center for Biosustainability,
+# Technical University of Denmark.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Keys for signing JWTs.
+
+python-jose supports the RSA and ECDSA algorithms out of the box. Ed25519 keys
+for the `EdDSA` algorithm (RFC 8037) are registered here and require the
+`cryptography` package.
+"""
+
+import pathlib
+
+from jose import jwk
+from jose.backends.base import Key
+from jose.exceptions import JWKError
+from jose.utils import base64url_decode, base64url_encode
+
+
+def read_keys(spec, directory="keys"):
+    """
+    Read the keys of the given key ring specification.
+
+    :param spec: Comma-separated `<file name>:<algorithm>` entries. The file
+        name is used as the key id.
+    :param directory: The directory containing the private key files
+    :return: A list of dicts with the `kid`, `alg` and PEM encoded `key`
+    """
+    keys = []
+    for entry in spec.split(","):
+        kid, algorithm = entry.strip().split(":")
+        private_key = pathlib.Path(directory, kid).read_text()
+        keys.append({"kid": kid, "alg": algorithm, "key": private_key})
+    return keys
+
+
+def public_jwk(key):
+    """Return the public JWK of the given key, as read by `read_keys`."""
+    public_key = jwk.construct(key["key"], key["alg"]).public_key()
+    return {**public_key.to_dict(), "kid": key["kid"], "use": "sig"}
+
+
+def prepared_key(key):
+    """Return the native key object of the python-jose backend."""
+    # The attribute is private in some of the python-jose backends.
+    try:
+        return key.prepared_key
+    except AttributeError:
+        return key._prepared_key
+
+
+class Ed25519Key(Key):
+    """An Ed25519 key for the `EdDSA` algorithm."""
+
+    def __init__(self, key, algorithm):
+        # Only required when an EdDSA key is configured.
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+
+        if algorithm != "EdDSA":
+            raise JWKError(f"Invalid algorithm for an Ed25519 key: {algorithm}")
+        self._algorithm = algorithm
+
+        if isinstance(
+            key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)
+        ):
+            self.prepared_key = key
+            return
+
+        if isinstance(key, dict):
+            if key.get("kty") != "OKP" or key.get("crv") != "Ed25519":
+                raise JWKError("Expected an OKP key on the Ed25519 curve")
+            public_bytes = base64url_decode(key["x"].encode())
+            self.prepared_key = ed25519.Ed25519PublicKey.from_public_bytes(
+                public_bytes
+            )
+            return
+
+        if isinstance(key, str):
+            key = key.encode()
+        try:
+            if b"PRIVATE KEY" in key:
+                key = serialization.load_pem_private_key(key, password=None)
+            else:
+                key = serialization.load_pem_public_key(key)
+        except ValueError as e:
+            raise JWKError(e)
+        if not isinstance(
+            key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)
+        ):
+            raise JWKError("Expected an Ed25519 key")
+        self.prepared_key = key
+
+    def is_public(self):
+        return not hasattr(self.prepared_key, "sign")
+
+    def sign(self, msg):
+        return self.prepared_key.sign(msg)
+
+    def verify(self, msg, sig):
+        from cryptography.exceptions import InvalidSignature
+
+        try:
+            self.public_key().prepared_key.verify(sig, msg)
+            return True
+        except InvalidSignature:
+            return False
+
+    def public_key(self):
+        if self.is_public():
+            return self
+        return self.__class__(self.prepared_key.public_key(), self._algorithm)
+
+    def to_dict(self):
+        from cryptography.hazmat.primitives import serialization
+
+        public_bytes = self.public_key().prepared_key.public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw
+        )
+        return {
+            "alg": self._algorithm,
+            "kty": "OKP",
+            "crv": "Ed25519",
+            "x": base64url_encode(public_bytes).decode(),
+        }
+
+
+jwk.register_key("EdDSA", Ed25519Key)
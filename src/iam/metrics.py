@@ -12,7 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Define the metrics used throughout the application."""
+"""
+Define the metrics used throughout the application.
+
+Under gunicorn, the metrics of all workers are collected from
+`prometheus_multiproc_dir`. The entity counts are only set by the gunicorn
+master, see `iam.counts`.
+"""
 
 import prometheus_client
 
@@ -25,6 +31,7 @@ USER_COUNT = prometheus_client.Gauge(
     "decaf_user_count",
     "The current number of users in the database",
     ["service", "environment"],
+    multiprocess_mode="max",
 )
 
 
@@ -36,6 +43,7 @@ ORGANIZATION_COUNT = prometheus_client.Gauge(
     "decaf_organization_count",
     "The current number of users in the database",
     ["service", "environment"],
+    multiprocess_mode="max",
 )
 
 
@@ -47,4 +55,104 @@ PROJECT_COUNT = prometheus_client.Gauge(
     "decaf_project_count",
     "The current number of projects in the database",
     ["service", "environment"],
+    multiprocess_mode="max",
+)
+
+
+# JWT_CACHE_HITS: The number of requests with a JWT found in the cache of
+# verified tokens
+# labels:
+#   service: The current service (always 'iam')
+#   environment: The current runtime environment ('production' or 'staging')
+JWT_CACHE_HITS = prometheus_client.Counter(
+    "decaf_jwt_cache_hits",
+    "The number of requests with a JWT found in the cache of verified tokens",
+    ["service", "environment"],
+)
+
+
+# JWT_CACHE_MISSES: The number of requests with a JWT which had to be verified
+# labels:
+#   service: The current service (always 'iam')
+#   environment: The current runtime environment ('production' or 'staging')
+JWT_CACHE_MISSES = prometheus_client.Counter(
+    "decaf_jwt_cache_misses",
+    "The number of requests with a JWT which had to be verified",
+    ["service", "environment"],
+)
+
+
+# HASHER_QUEUE_DEPTH: The number of password hashing tasks submitted to the pool
+# of the current worker and not yet completed
+# labels:
+#   service: The current service (always 'iam')
+#   environment: The current runtime environment ('production' or 'staging')
+HASHER_QUEUE_DEPTH = prometheus_client.Gauge(
+    "decaf_hasher_queue_depth",
+    "The number of password hashing tasks waiting or running in the pool",
+    ["service", "environment"],
+)
+
+
+# HASHER_WAIT_TIME: The time password hashing tasks waited for a thread
+# labels:
+#   service: The current service (always 'iam')
+#   environment: The current runtime environment ('production' or 'staging')
+HASHER_WAIT_TIME = prometheus_client.Histogram(
+    "decaf_hasher_wait_seconds",
+    "The time password hashing tasks waited for a thread in the pool",
+    ["service", "environment"],
+)
+
+
+# LOGIN_THROTTLED: The number of login attempts rejected by the throttle
+# labels:
+#   service: The current service (always 'iam')
+#   environment: The current runtime environment ('production' or 'staging')
+#   bucket: The bucket which was empty ('ip' or 'email')
+LOGIN_THROTTLED = prometheus_client.Counter(
+    "decaf_login_throttled",
+    "The number of login attempts rejected by the throttle",
+    ["service", "environment", "bucket"],
+)
+
+
+# DB_POOL_CHECKED_OUT: The number of database connections checked out from the
+# pool of a worker
+# labels:
+#   service: The current service (always 'iam')
+#   environment: The current runtime environment ('production' or 'staging')
+#   pool: The database of the pool ('primary' or 'replica')
+DB_POOL_CHECKED_OUT = prometheus_client.Gauge(
+    "decaf_db_pool_checked_out",
+    "The number of database connections checked out from the pool",
+    ["service", "environment", "pool"],
+    multiprocess_mode="livesum",
+)
+
+
+# DB_POOL_OVERFLOW: The number of database connections open beyond the pool
+# size, up to its maximum overflow
+# labels:
+#   service: The current service (always 'iam')
+#   environment: The current runtime environment ('production' or 'staging')
+#   pool: The database of the pool ('primary' or 'replica')
+DB_POOL_OVERFLOW = prometheus_client.Gauge(
+    "decaf_db_pool_overflow",
+    "The number of database connections open beyond the pool size",
+    ["service", "environment", "pool"],
+    multiprocess_mode="livesum",
+)
+
+
+# DB_POOL_WAIT_TIME: The time taken to check out a database connection from the
+# pool, including waiting for a connection and opening new ones
+# labels:
+#   service: The current service (always 'iam')
+#   environment: The current runtime environment ('production' or 'staging')
+#   pool: The database of the pool ('primary' or 'replica')
+DB_POOL_WAIT_TIME = prometheus_client.Histogram(
+    "decaf_db_pool_wait_seconds",
+    "The time taken to check out a database connection from the pool",
+    ["service", "environment", "pool"],
 )
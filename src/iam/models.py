@@ -18,17 +18,16 @@
 import logging
 from datetime import datetime, timedelta, timezone
 
-from flask_sqlalchemy import SQLAlchemy
-from jose import jwt
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Email, Mail, Personalization
 
 from . import hasher
 from .app import app
 from .enums import ConsentStatus, ConsentType
+from .replica import RoutingSQLAlchemy
 
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 logger = logging.getLogger(__name__)
 
@@ -56,7 +55,10 @@ class Team(db.Model):
     name = db.Column(db.String(256), nullable=False)
 
     organization_id = db.Column(
-        db.Integer, db.ForeignKey("organization.id"), nullable=False
+        db.Integer,
+        db.ForeignKey("organization.id"),
+        nullable=False,
+        index=True,
     )
     organization = db.relationship("Organization", back_populates="teams")
 
@@ -77,12 +79,18 @@ class User(db.Model):
     # Firebase users will have NULL in the password column.
     password = db.Column(db.String(128))
 
-    firebase_uid = db.Column(db.String(256))
+    firebase_uid = db.Column(db.String(256), index=True)
 
     first_name = db.Column(db.String(256))
     last_name = db.Column(db.String(256))
     email = db.Column(db.String(256), unique=True, nullable=False)
 
+    # Incremented whenever the project claims of the user may have changed.
+    # Used to invalidate cached claims, see `iam.claims`.
+    authorization_version = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+
     organizations = db.relationship(
         "OrganizationUser",
         back_populates="user",
@@ -124,62 +132,45 @@ class User(db.Model):
         """Encode and set the given password."""
         if not password:
             raise ValueError("Password cannot be empty")
-        self.password = hasher.encode(password)
+        self.password = self.encode_password(password)
+
+    @staticmethod
+    def encode_password(password):
+        """Encode the given password with the configured hasher."""
+        return app.extensions["hasher_executor"].run(
+            hasher.encode,
+            password,
+            algorithm=app.config["PASSWORD_HASHER"],
+            **app.config["PASSWORD_HASHER_PARAMETERS"],
+        )
 
     def check_password(self, password):
         """Return true if the given password matches the users' password."""
-        return hasher.verify(password, self.password)
+        executor = app.extensions["hasher_executor"]
+        return executor.run(hasher.verify, password, self.password)
+
+    def password_needs_rehash(self):
+        """Return true if the password is not encoded as configured."""
+        return hasher.needs_rehash(
+            self.password,
+            app.config["PASSWORD_HASHER"],
+            **app.config["PASSWORD_HASHER_PARAMETERS"],
+        )
 
     @property
     def claims(self):
         """Return this users' claims for use in a JWT."""
+        # Imported here to avoid a circular import with the models module.
+        from .claims import resolve_claims
 
-        def add_claim(id, role):
-            """Add claims, if there is no existing higher claim."""
-            if id in project_claims:
-                if role == "read" and project_claims[id] in ("admin", "write"):
-                    return
-                if role == "write" and project_claims[id] == "admin":
-                    return
-
-            project_claims[id] = role
-
-        project_claims = {}
-
-        for user_role in self.organizations:
-            if user_role.role == "owner":
-                # Add admin role for all projects in the organization
-                for project_role in user_role.organization.projects:
-                    add_claim(project_role.project.id, "admin")
-
-                # Add admin role for all projects in organization teams
-                for team in user_role.organization.teams:
-                    for team_role in team.projects:
-                        add_claim(team_role.project.id, "admin")
-            else:
-                # Add the assigned role for all projects in the organization
-                for org_role in user_role.organization.projects:
-                    add_claim(org_role.project.id, org_role.role)
-
-        # Add the assigned role for all projects in the users' team
-        for user_role in self.teams:
-            for team_role in user_role.team.projects:
-                add_claim(team_role.project.id, team_role.role)
-
-        # Add projects owned by user
-        for user_role in self.projects:
-            add_claim(user_role.project.id, user_role.role)
-
-        return {"usr": self.id, "prj": project_claims}
+        return resolve_claims(self.id)
 
     def get_reset_token(self):
         claims = {
             "exp": int(datetime.timestamp(datetime.now() + timedelta(hours=1))),
             "usr": self.id,
         }
-        return jwt.encode(
-            claims, app.config["RSA_PRIVATE_KEY"], app.config["ALGORITHM"]
-        )
+        return app.extensions["jwt_signer"].sign(claims)
 
     def send_reset_email(self):
         token = self.get_reset_token()
@@ -215,9 +206,9 @@ class RefreshToken(db.Model):
     """A grouping of tokens within an user."""
 
     id = db.Column(db.Integer, primary_key=True)
-    token = db.Column(db.String(64))
+    token = db.Column(db.String(64), index=True)
     expiry = db.Column(db.DateTime)
-    user_id = db.Column(db.Integer, db.ForeignKey(User.id))
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), index=True)
     user = db.relationship(User)
 
     def __repr__(self):
@@ -276,6 +267,46 @@ class Consent(db.Model):
         )
 
 
+# Serves `iam.consents.latest_consents`, in the order of its `DISTINCT ON`.
+db.Index(
+    "ix_consent_latest",
+    Consent.user_id,
+    Consent.type,
+    Consent.category,
+    Consent.timestamp.desc(),
+    Consent.id.desc(),
+)
+
+
+class CurrentConsent(db.Model):
+    """
+    The latest consent of a user for a type and category.
+
+    Rows are maintained by `iam.consents` whenever consents are added and
+    should not be modified directly.
+    """
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("user.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    type = db.Column(db.Enum(ConsentType), primary_key=True)
+    category = db.Column(db.Text, primary_key=True)
+    consent_id = db.Column(
+        db.Integer,
+        db.ForeignKey("consent.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+
+    def __repr__(self):
+        """Return a printable representation."""
+        return (
+            f"<{self.__class__.__name__} user {self.user_id}: {self.type} "
+            f"({self.category}) is consent {self.consent_id}>"
+        )
+
+
 #
 # Association tables
 #
@@ -288,7 +319,9 @@ class OrganizationUser(db.Model):
         db.Integer, db.ForeignKey("organization.id"), primary_key=True
     )
     organization = db.relationship("Organization", back_populates="users")
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), primary_key=True, index=True
+    )
     user = db.relationship("User", back_populates="organizations")
     role = db.Column(
         db.Enum("owner", "member", name="organization_user_roles"),
@@ -308,7 +341,9 @@ class TeamUser(db.Model):
 
     team_id = db.Column(db.Integer, db.ForeignKey("team.id"), primary_key=True)
     team = db.relationship("Team", back_populates="users")
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), primary_key=True, index=True
+    )
     user = db.relationship("User", back_populates="teams")
     role = db.Column(
         db.Enum("maintainer", "member", name="team_user_roles"), nullable=False
@@ -330,7 +365,7 @@ class OrganizationProject(db.Model):
     )
     organization = db.relationship("Organization", back_populates="projects")
     project_id = db.Column(
-        db.Integer, db.ForeignKey("project.id"), primary_key=True
+        db.Integer, db.ForeignKey("project.id"), primary_key=True, index=True
     )
     project = db.relationship("Project", back_populates="organizations")
     role = db.Column(
@@ -351,7 +386,7 @@ class TeamProject(db.Model):
     team_id = db.Column(db.Integer, db.ForeignKey("team.id"), primary_key=True)
     team = db.relationship("Team", back_populates="projects")
     project_id = db.Column(
-        db.Integer, db.ForeignKey("project.id"), primary_key=True
+        db.Integer, db.ForeignKey("project.id"), primary_key=True, index=True
     )
     project = db.relationship("Project", back_populates="teams")
     role = db.Column(
@@ -372,7 +407,7 @@ class UserProject(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
     user = db.relationship("User", back_populates="projects")
     project_id = db.Column(
-        db.Integer, db.ForeignKey("project.id"), primary_key=True
+        db.Integer, db.ForeignKey("project.id"), primary_key=True, index=True
     )
     project = db.relationship("Project", back_populates="users")
     role = db.Column(
@@ -385,3 +420,35 @@ class UserProject(db.Model):
             f"<{self.__class__.__name__} {self.user} has role "
             f"{self.role} in {self.project}>"
         )
+
+
+class UserProjectClaim(db.Model):
+    """
+    Materialized access role for a user to a project.
+
+    Holds the highest role granted to the user through any of the association
+    tables above. Rows are maintained by `iam.claims` whenever memberships or
+    project access rules change and should not be modified directly.
+    """
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("user.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    project_id = db.Column(
+        db.Integer,
+        db.ForeignKey("project.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    )
+    role = db.Column(
+        db.Enum("admin", "write", "read", name="project_roles"), nullable=False
+    )
+
+    def __repr__(self):
+        """Return a printable representation."""
+        return (
+            f"<{self.__class__.__name__} user {self.user_id} has role "
+            f"{self.role} in project {self.project_id}>"
+        )
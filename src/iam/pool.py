@@ -0,0 +1,59 @@
+# Copyright (c) 2018, Novo Nordisk Foundation Center for Biosustainability,
+# Technical University of Denmark.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Database connection pool with metrics."""
+
+import os
+import time
+
+from sqlalchemy.pool import QueuePool
+
+from .metrics import DB_POOL_CHECKED_OUT, DB_POOL_OVERFLOW, DB_POOL_WAIT_TIME
+
+
+class MeteredQueuePool(QueuePool):
+    """A `QueuePool` exporting its usage to the metrics."""
+
+    # Label of the pool in the metrics.
+    name = "primary"
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT_TIME.labels(*self._labels()).observe(
+                time.monotonic() - start
+            )
+            self._update_metrics()
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        self._update_metrics()
+
+    def _update_metrics(self):
+        labels = self._labels()
+        DB_POOL_CHECKED_OUT.labels(*labels).set(self.checkedout())
+        # The overflow counts up from -pool_size while the pool is filled.
+        DB_POOL_OVERFLOW.labels(*labels).set(max(self.overflow(), 0))
+
+    def _labels(self):
+        return ("iam", os.environ["ENVIRONMENT"], self.name)
+
+
+class ReplicaQueuePool(MeteredQueuePool):
+    """The pool of the read replica, see `iam.replica`."""
+
+    name = "replica"
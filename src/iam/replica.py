@@ -0,0 +1,194 @@
+# Copyright (c) 2018, Novo Nordisk Foundation Center for Biosustainability,
+# Technical University of Denmark.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Routing of read-only requests to a read replica.
+
+Resources marked with `use_replica` read from the replica configured with
+`REPLICA_DATABASE_URI`. All other requests, flushes and the CLI use the
+primary. Requests are routed to the primary while the replica lags more than
+`REPLICA_MAX_LAG` behind it, or cannot be reached. Requests failing on the
+replica are retried on the primary.
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, orm
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+
+from .pool import ReplicaQueuePool
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds since the last transaction replayed on the replica, or 0 on a primary.
+# A replica streaming from the primary which has replayed all WAL it received
+# has no lag, even if nothing was written on the primary for a while. Without
+# `pg_read_all_stats`, the status of the stream is hidden, and the lag grows
+# until the next write. Requires Postgres 10 or later.
+LAG_QUERY = """SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+        AND EXISTS (
+            SELECT FROM pg_stat_wal_receiver WHERE status = 'streaming'
+        ) THEN 0
+    ELSE COALESCE(
+        EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()),
+        'Infinity'
+    )
+END"""
+
+
+def init_app(app):
+    """Create the read replica configured for the app, if any."""
+
+    @app.before_request
+    def reset_replica():
+        # Note that `g` may outlive the request, e.g. in tests.
+        g.pop("db_replica", None)
+        g.pop("db_replica_engine", None)
+
+    if app.config["REPLICA_DATABASE_URI"] is None:
+        return
+    options = {
+        **app.config["SQLALCHEMY_ENGINE_OPTIONS"],
+        "poolclass": ReplicaQueuePool,
+    }
+    app.extensions["db_replica"] = Replica(
+        create_engine(app.config["REPLICA_DATABASE_URI"], **options),
+        app.config["REPLICA_MAX_LAG"].total_seconds(),
+    )
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with sessions routing reads to the read replica."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class RoutingSession(SignallingSession):
+    """A session reading from the replica in requests using it."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_app_context() and g.get("db_replica"):
+            engine = _replica_engine(self.app)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class Replica:
+    """A read replica, used while its lag is acceptable."""
+
+    # Check the lag of the replica at most this often, in seconds.
+    check_interval = 1
+    # Give up connecting for the check after this many seconds, as requests
+    # wait for it.
+    check_timeout = 1
+
+    def __init__(self, engine, max_lag):
+        self.engine = engine
+        self.max_lag = max_lag
+        self._available = False
+        self._checked = None
+        # The check uses a connection of its own, with a short connect timeout.
+        self._check_engine = create_engine(
+            engine.url,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=self.check_timeout,
+            connect_args={"connect_timeout": self.check_timeout},
+        )
+
+    def available(self):
+        """Return true if the replica can be used."""
+        now = time.monotonic()
+        if self._checked is None or now - self._checked >= self.check_interval:
+            self._checked = now
+            self._available = self._check()
+        return self._available
+
+    def fail(self):
+        """Route reads to the primary until the next check."""
+        self._available = False
+        self._checked = time.monotonic()
+
+    def dispose(self):
+        """Close the connections to the replica."""
+        self.engine.dispose()
+        self._check_engine.dispose()
+
+    def _check(self):
+        try:
+            with self._check_engine.connect() as connection:
+                lag = connection.execute(LAG_QUERY).scalar()
+        except SQLAlchemyError:
+            logger.exception("Failed to check the lag of the read replica")
+            return False
+        if lag > self.max_lag:
+            logger.warning(f"Read replica lags {lag:.1f}s behind the primary")
+            return False
+        return True
+
+
+def use_replica(function):
+    """Route the reads of the decorated resource method to the replica."""
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        g.db_replica = True
+        try:
+            return function(*args, **kwargs)
+        except OperationalError:
+            if g.get("db_replica_engine") is None:
+                raise
+            logger.exception("Failed to read from the replica, retrying")
+        # The resource only reads, so it is safe to run again on the primary.
+        current_app.extensions["db_replica"].fail()
+        current_app.extensions["sqlalchemy"].db.session.rollback()
+        g.db_replica_engine = None
+        return function(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def primary():
+    """Read from the primary within the block, e.g. to read recent writes."""
+    replica = g.get("db_replica", False)
+    g.db_replica = False
+    try:
+        yield
+    finally:
+        g.db_replica = replica
+
+
+def _replica_engine(app):
+    """Return the replica engine for the current request, or None."""
+    # The decision is kept for the request, so that it reads consistently from
+    # one database.
+    if "db_replica_engine" not in g:
+        replica = app.extensions.get("db_replica")
+        if replica is not None and replica.available():
+            g.db_replica_engine = replica.engine
+        else:
+            g.db_replica_engine = None
+    return g.db_replica_engine
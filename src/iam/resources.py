@@ -15,33 +15,42 @@
 
 """Implement RESTful API endpoints using resources."""
 
+import hmac
+import math
 import os
 import warnings
 from datetime import datetime
+from urllib.parse import urlencode
 
 import prometheus_client
-from firebase_admin import auth
-from flask import Response, g, jsonify
+import requests
+from flask import Response, copy_current_request_context, g, jsonify, request
 from flask_apispec import MethodResource, doc, marshal_with, use_kwargs
 from flask_apispec.extension import FlaskApiSpec
 from jose import jwt
-from sqlalchemy import and_, func
+from prometheus_client import multiprocess
+from sqlalchemy import Integer, any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm.exc import NoResultFound
 
 from .app import app
-from .domain import create_firebase_user, sign_claims
-from .jwt import jwt_require_claim, jwt_required
-from .metrics import ORGANIZATION_COUNT, PROJECT_COUNT, USER_COUNT
-from .models import (
-    Consent,
-    Organization,
-    Project,
-    RefreshToken,
-    User,
-    UserProject,
-    db,
+from .claims import cached_user_claims, resolve_grants
+from .consents import add_consents, current_consents
+from .domain import (
+    rehash_password,
+    resolve_firebase_user,
+    sign_claims,
+    sign_user_claims,
+    user_jwt_claims,
 )
+from .jwt import has_access, jwt_require_claim, jwt_required, project_claims
+from .models import Consent, Project, RefreshToken, User, UserProject, db
+from .replica import primary, use_replica
 from .schemas import (
+    AuthorizeBatchRequestSchema,
+    AuthorizeBatchResponseSchema,
+    ConsentBatchRequestSchema,
+    ConsentBatchResponseSchema,
     ConsentRegisterSchema,
     ConsentResponseSchema,
     FirebaseCredentialsSchema,
@@ -49,6 +58,7 @@ from .schemas import (
     JWTSchema,
     LocalCredentialsSchema,
     PasswordResetSchema,
+    ProjectListRequestSchema,
     ProjectRequestSchema,
     ProjectResponseSchema,
     RefreshRequestSchema,
@@ -57,6 +67,7 @@ from .schemas import (
     UserRegisterSchema,
     UserResponseSchema,
 )
+from .throttle import throttle_login
 
 
 def init_app(app):
@@ -75,11 +86,13 @@ def init_app(app):
     register("/authenticate/firebase", FirebaseAuthResource)
     register("/refresh", RefreshResource)
     register("/keys", PublicKeysResource)
+    register("/authorize/batch", AuthorizeBatchResource)
     register("/projects", ProjectsResource)
     register("/projects/<project_id>", ProjectResource)
     register("/user", UserResource)
     register("/user", UserRegisterResource)
     register("/consent", ConsentResource)
+    register("/consent/batch", ConsentBatchResource)
     register("/password/reset-request", ResetRequestResource)
     register("/password/reset/<token>", PasswordResetResource)
 
@@ -101,14 +114,18 @@ def healthz():
 
 def metrics():
     """Expose metrics to prometheus."""
-    # Update persistent metrics like database counts
-    labels = ("iam", os.environ["ENVIRONMENT"])
-    USER_COUNT.labels(*labels).set(User.query.count())
-    ORGANIZATION_COUNT.labels(*labels).set(Organization.query.count())
-    PROJECT_COUNT.labels(*labels).set(Project.query.count())
-
+    # Database counts are refreshed in the background, see `iam.counts`. Under
+    # gunicorn, the master has started refreshing them already.
+    app.extensions["entity_counts"].start()
+
+    if "prometheus_multiproc_dir" in os.environ:
+        # Collect the metrics of all gunicorn workers.
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
     return Response(
-        prometheus_client.generate_latest(),
+        prometheus_client.generate_latest(registry),
         mimetype=prometheus_client.CONTENT_TYPE_LATEST,
     )
 
@@ -124,11 +141,28 @@ class LocalAuthResource(MethodResource):
         if not app.config["FEAT_TOGGLE_LOCAL_AUTH"]:
             return "Local user authentication is disabled", 501
 
+        # Reject bursts of attempts before any password hashing work.
+        wait = throttle_login(email)
+        if wait:
+            return (
+                "Too many login attempts, please try again later",
+                429,
+                {"Retry-After": str(math.ceil(wait))},
+            )
+
         try:
             user = User.query.filter(
                 User.email == email, User.password.isnot(None),
             ).one()
             if user.check_password(password):
+                if user.password_needs_rehash():
+                    # Rehash in the background, not delaying the response.
+                    app.extensions["hasher_executor"].spawn(
+                        copy_current_request_context(rehash_password),
+                        user.id,
+                        password,
+                        user.password,
+                    )
                 return sign_claims(user)
             else:
                 return "Invalid credentials", 401
@@ -148,25 +182,19 @@ class FirebaseAuthResource(MethodResource):
             return "Firebase authentication is disabled", 501
 
         try:
-            decoded_token = auth.verify_id_token(token)
-        except ValueError:
+            decoded_token = app.extensions["firebase_verifier"].verify(token)
+        except (jwt.JWTError, jwt.ExpiredSignatureError, jwt.JWTClaimsError):
             return "Invalid firebase credentials", 401
+        except requests.RequestException:
+            return "Firebase certificates are unavailable", 503
 
+        # The uid is given by the client, but only the token is verified.
+        if decoded_token["sub"] != uid:
+            return "Invalid firebase credentials", 401
         if "email" not in decoded_token:
-            decoded_token["email"] = auth.get_user(uid).provider_data[0].email
-        try:
-            user = User.query.filter_by(firebase_uid=uid).one()
-
-        except NoResultFound:
-            try:
-                # no firebase user for this provider, but they may have
-                # signed up with a different provider but the same email
-                user = User.query.filter_by(email=decoded_token["email"]).one()
-            except NoResultFound:
-                # no such user - create a new one
-                user = create_firebase_user(uid, decoded_token)
-
-        return sign_claims(user)
+            return "The Firebase account has no email address", 401
+        user_id, version = resolve_firebase_user(uid, decoded_token)
+        return sign_user_claims(user_id, version)
 
 
 @doc(description="Refresh an expired JWT with a refresh token")
@@ -175,32 +203,36 @@ class RefreshResource(MethodResource):
 
     @use_kwargs(RefreshRequestSchema)
     @marshal_with(JWTSchema, code=200)
+    @use_replica
     def post(self, refresh_token):
         """Receive a fresh JWT by providing a valid refresh token."""
         try:
-            token = RefreshToken.query.filter_by(token=refresh_token).one()
-            user = User.query.filter_by(id=token.user_id).one()
-            if datetime.now() >= token.expiry:
-                return (
-                    "The refresh token has expired, please re-authenticate",
-                    401,
-                )
-
-            claims = {
-                "exp": int(
-                    (datetime.now() + app.config["JWT_VALIDITY"]).strftime("%s")
-                )
-            }
-            claims.update(user.claims)
-            return {
-                "jwt": jwt.encode(
-                    claims,
-                    app.config["RSA_PRIVATE_KEY"],
-                    app.config["ALGORITHM"],
-                )
-            }
+            return self._refresh(refresh_token)
         except NoResultFound:
-            return "Invalid refresh token", 401
+            pass
+        # The token may have been issued too recently to have reached the
+        # replica. Its claims are then read from the primary as well.
+        with primary():
+            try:
+                return self._refresh(refresh_token)
+            except NoResultFound:
+                return "Invalid refresh token", 401
+
+    def _refresh(self, refresh_token):
+        token, version = (
+            db.session.query(RefreshToken, User.authorization_version)
+            .join(User, RefreshToken.user_id == User.id)
+            .filter(RefreshToken.token == refresh_token)
+            .one()
+        )
+        if datetime.now() >= token.expiry:
+            return (
+                "The refresh token has expired, please re-authenticate",
+                401,
+            )
+
+        claims = user_jwt_claims(token.user_id, version)
+        return {"jwt": app.extensions["jwt_signer"].sign(claims)}
 
 
 @doc(
@@ -211,14 +243,92 @@ implementation](https://connect2id.com/products/server/docs/api/jwk-set#keys)"""
 class PublicKeysResource(MethodResource):
     @marshal_with(JWKKeysSchema, code=200)
     def get(self):
-        return {"keys": [app.config["RSA_PUBLIC_KEY"]]}
+        return {"keys": app.extensions["jwt_verifier"].public_keys}
 
 
-@doc(description="List projects")
+@doc(
+    description="""Check access of a user to multiple projects at once.
+The user is identified by the provided JWT, or by `user_id` for trusted callers
+authenticating with basic authentication."""
+)
+class AuthorizeBatchResource(MethodResource):
+    @use_kwargs(AuthorizeBatchRequestSchema)
+    @marshal_with(AuthorizeBatchResponseSchema, code=200)
+    def post(self, checks, user_id=None):
+        if user_id is not None:
+            if not _trusted_caller():
+                return "Basic authentication required for user_id", 401
+            try:
+                version = (
+                    db.session.query(User.authorization_version)
+                    .filter(User.id == user_id)
+                    .one()
+                    .authorization_version
+                )
+            except NoResultFound:
+                return f"No user with id {user_id}", 404
+            roles = resolve_grants(cached_user_claims(user_id, version))
+        elif g.jwt_valid:
+            roles = project_claims()
+        else:
+            return "JWT authentication required", 401
+
+        results = [
+            {
+                "project_id": check["project_id"],
+                "level": check["level"],
+                "allowed": has_access(
+                    roles, check["project_id"], check["level"]
+                ),
+            }
+            for check in checks
+        ]
+        return {"results": results}, 200
+
+
+def _trusted_caller():
+    """Return true if the request has the admin basic auth credentials."""
+    auth = request.authorization
+    if auth is None or auth.username is None or auth.password is None:
+        return False
+    username = app.config["BASIC_AUTH_USERNAME"].encode()
+    password = app.config["BASIC_AUTH_PASSWORD"].encode()
+    # Compare both to not reveal whether the username was correct.
+    return hmac.compare_digest(
+        auth.username.encode(), username
+    ) & hmac.compare_digest(auth.password.encode(), password)
+
+
+@doc(description="List projects, ordered by id")
 class ProjectsResource(MethodResource):
+    @use_kwargs(ProjectListRequestSchema, locations=("query",))
     @marshal_with(ProjectResponseSchema(many=True), code=200)
-    def get(self):
-        return Project.query.filter(Project.id.in_(g.jwt_claims["prj"])), 200
+    @use_replica
+    def get(self, after=None, limit=None, name=None, count=False):
+        # Bind the claimed ids as a single array parameter, rather than one
+        # parameter per id, to keep the statement the same for all users.
+        ids = bindparam("ids", list(project_claims()), type_=ARRAY(Integer))
+        query = Project.query.filter(Project.id == any_(ids))
+        if name:
+            query = query.filter(Project.name.startswith(name, autoescape=True))
+        headers = {}
+        if count:
+            headers["X-Total-Count"] = str(query.count())
+        if after is not None:
+            query = query.filter(Project.id > after)
+        query = query.order_by(Project.id)
+        if limit is None:
+            return query.all(), 200, headers
+
+        # Fetch one more project to tell whether there is a next page.
+        projects = query.limit(limit + 1).all()
+        if len(projects) > limit:
+            projects = projects[:limit]
+            args = {**request.args, "after": projects[-1].id}
+            headers[
+                "Link"
+            ] = f'<{request.base_url}?{urlencode(args)}>; rel="next"'
+        return projects, 200, headers
 
     @use_kwargs(ProjectRequestSchema)
     @jwt_required
@@ -235,12 +345,12 @@ class ProjectsResource(MethodResource):
 @doc(description="List projects")
 class ProjectResource(MethodResource):
     @marshal_with(ProjectResponseSchema(), code=200)
+    @use_replica
     def get(self, project_id):
         try:
             return (
                 Project.query.filter(
-                    Project.id == project_id,
-                    Project.id.in_(g.jwt_claims["prj"]),
+                    Project.id == project_id, Project.id.in_(project_claims()),
                 ).one(),
                 200,
             )
@@ -252,7 +362,7 @@ class ProjectResource(MethodResource):
     def put(self, project_id, name):
         try:
             project = Project.query.filter(
-                Project.id == project_id, Project.id.in_(g.jwt_claims["prj"])
+                Project.id == project_id, Project.id.in_(project_claims())
             ).one()
         except NoResultFound:
             return f"No project with id {project_id}", 404
@@ -266,7 +376,7 @@ class ProjectResource(MethodResource):
     def delete(self, project_id):
         try:
             project = Project.query.filter(
-                Project.id == project_id, Project.id.in_(g.jwt_claims["prj"])
+                Project.id == project_id, Project.id.in_(project_claims())
             ).one()
         except NoResultFound:
             return f"No project with id {project_id}", 404
@@ -281,6 +391,7 @@ class ProjectResource(MethodResource):
 class UserResource(MethodResource):
     @marshal_with(UserResponseSchema(), code=200)
     @jwt_required
+    @use_replica
     def get(self):
         try:
             return User.query.filter(User.id == g.jwt_claims["usr"]).one(), 200
@@ -312,41 +423,9 @@ class UserRegisterResource(MethodResource):
 class ConsentResource(MethodResource):
     @marshal_with(ConsentResponseSchema(many=True), code=200)
     @jwt_required
+    @use_replica
     def get(self):
-        try:
-            # Select the latest user's consents for all unique combinations
-            # of consent.type and consent.category.
-            # Query adapted from https://stackoverflow.com/questions/40537934
-            # NOTE: If multiple consents with same type, category and timestamp
-            #       are found, returns the one with greatest ID
-            subquery = (
-                db.session.query(
-                    Consent.user_id.label("user_id"),
-                    Consent.type.label("type"),
-                    Consent.category.label("category"),
-                    func.max(Consent.timestamp).label("latest_timestamp"),
-                    func.max(Consent.id).label("greatest_id"),
-                )
-                .group_by(Consent.user_id, Consent.type, Consent.category,)
-                .subquery()
-            )
-            query = (
-                db.session.query(Consent)
-                .join(
-                    subquery,
-                    and_(
-                        Consent.user_id == g.jwt_claims["usr"],
-                        Consent.type == subquery.c.type,
-                        Consent.category == subquery.c.category,
-                        Consent.timestamp == subquery.c.latest_timestamp,
-                        Consent.id == subquery.c.greatest_id,
-                    ),
-                )
-                .order_by(Consent.type, Consent.category)
-            )
-            return query, 200
-        except NoResultFound:
-            return f"No user with id {g.jwt_claims['usr']}", 404
+        return current_consents(g.jwt_claims["usr"]), 200
 
     @use_kwargs(ConsentRegisterSchema)
     @jwt_required
@@ -375,6 +454,20 @@ class ConsentResource(MethodResource):
         return {"id": consent.id}, 201
 
 
+@doc(
+    description="Submit several consents at once for the user claim in the "
+    "provided JWT, e.g. one for each cookie category"
+)
+class ConsentBatchResource(MethodResource):
+    @use_kwargs(ConsentBatchRequestSchema)
+    @marshal_with(ConsentBatchResponseSchema, code=201)
+    @jwt_required
+    def post(self, consents):
+        ids = add_consents(g.jwt_claims["usr"], consents)
+        db.session.commit()
+        return {"ids": ids}, 201
+
+
 @doc(description="Request password reset link")
 class ResetRequestResource(MethodResource):
     @use_kwargs(ResetRequestSchema)
@@ -398,9 +491,7 @@ class ResetRequestResource(MethodResource):
 class PasswordResetResource(MethodResource):
     def get(self, token):
         try:
-            jwt.decode(
-                token, app.config["RSA_PRIVATE_KEY"], app.config["ALGORITHM"]
-            )
+            app.extensions["jwt_verifier"].verify(token)
             return "", 200
         except (jwt.JWTError, jwt.ExpiredSignatureError, jwt.JWTClaimsError):
             return "The token is invalid or expired.", 400
@@ -408,9 +499,7 @@ class PasswordResetResource(MethodResource):
     @use_kwargs(PasswordResetSchema)
     def post(self, token, password):
         try:
-            decoded_token = jwt.decode(
-                token, app.config["RSA_PRIVATE_KEY"], app.config["ALGORITHM"]
-            )
+            decoded_token = app.extensions["jwt_verifier"].verify(token)
         except (jwt.JWTError, jwt.ExpiredSignatureError, jwt.JWTClaimsError):
             return "The token is invalid or expired.", 400
         else:
@@ -19,6 +19,7 @@ from marshmallow import (
     Schema,
     ValidationError,
     fields,
+    validate,
     validates,
     validates_schema,
 )
@@ -61,6 +62,45 @@ class ProjectRequestSchema(StrictSchema):
     # users = fields.List(fields.Integer())
 
 
+class ProjectListRequestSchema(StrictSchema):
+    after = fields.Integer(
+        description="Cursor: list the projects with a greater id than this"
+    )
+    limit = fields.Integer(
+        validate=validate.Range(min=1, max=1000),
+        description="Maximum number of projects to list. All projects are "
+        "listed if not given. The next page is linked in the `Link` header.",
+    )
+    name = fields.String(description="List projects with names starting with")
+    count = fields.Boolean(
+        missing=False,
+        description="Return the number of matching projects in the "
+        "`X-Total-Count` header",
+    )
+
+
+class AuthorizationCheckSchema(StrictSchema):
+    project_id = fields.Integer(required=True, description="Project ID")
+    level = fields.String(
+        required=True,
+        validate=validate.OneOf(["admin", "write", "read"]),
+        description="Required access level",
+    )
+
+
+class AuthorizeBatchRequestSchema(StrictSchema):
+    user_id = fields.Integer(
+        description="User to check access for instead of the JWT user. Only "
+        "accepted from trusted callers with basic authentication."
+    )
+    checks = fields.List(
+        fields.Nested(AuthorizationCheckSchema),
+        required=True,
+        validate=validate.Length(max=1000),
+        description="Access checks to evaluate",
+    )
+
+
 class ConsentRegisterSchema(StrictSchema):
     type = fields.String(
         required=True,
@@ -131,6 +171,15 @@ class ConsentRegisterSchema(StrictSchema):
         return value
 
 
+class ConsentBatchRequestSchema(StrictSchema):
+    consents = fields.List(
+        fields.Nested(ConsentRegisterSchema),
+        required=True,
+        validate=validate.Length(min=1, max=100),
+        description="Consents to submit, e.g. one per cookie category",
+    )
+
+
 # Response schemas
 ################################################################################
 
@@ -153,10 +202,17 @@ class TokenSchema(StrictSchema):
 
 class JWKKeysSchema(StrictSchema):
     class JWKSchema(StrictSchema):
+        kid = fields.String()
+        use = fields.String()
         alg = fields.String()
+        kty = fields.String()
+        # RSA keys
         e = fields.String()
         n = fields.String()
-        kty = fields.String()
+        # Elliptic curve (EC and OKP) keys
+        crv = fields.String()
+        x = fields.String()
+        y = fields.String()
 
     keys = fields.List(
         fields.Nested(JWKSchema),
@@ -164,6 +220,16 @@ class JWKKeysSchema(StrictSchema):
     )
 
 
+class AuthorizeBatchResponseSchema(StrictSchema):
+    class AuthorizationResultSchema(AuthorizationCheckSchema):
+        allowed = fields.Boolean(required=True)
+
+    results = fields.List(
+        fields.Nested(AuthorizationResultSchema),
+        description="Results in the order of the requested checks",
+    )
+
+
 class ProjectResponseSchema(StrictSchema):
     id = fields.Integer()
     name = fields.String()
@@ -196,6 +262,12 @@ class PasswordResetSchema(StrictSchema):
     password = fields.String(location="json")
 
 
+class ConsentBatchResponseSchema(StrictSchema):
+    ids = fields.List(
+        fields.Integer(), description="Ids in the order of the given consents"
+    )
+
+
 class ConsentResponseSchema(StrictSchema):
     type = fields.String(required=True)
     category = fields.String(required=True)
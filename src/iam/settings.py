@@ -15,11 +15,12 @@
 
 """Provide settings for different deployment scenarios."""
 
+import json
 import os
-import pathlib
 from datetime import timedelta
 
-from jose import jwk
+from .keys import read_keys
+from .pool import MeteredQueuePool
 
 
 def current_config():
@@ -42,20 +43,60 @@ class Default:
     def __init__(self):
         """Initialize the default configuration."""
         self.CORS_ORIGINS = os.environ["ALLOWED_ORIGINS"].split(",")
-        self.RSA_PRIVATE_KEY = pathlib.Path("keys/rsa").read_text()
-        self.ALGORITHM = "RS512"
-        self.RSA_PUBLIC_KEY = (
-            jwk.get_key(self.ALGORITHM)(self.RSA_PRIVATE_KEY, self.ALGORITHM,)
-            .public_key()
-            .to_dict()
-        )
+        # Key ring for signing JWTs, see `iam.keys.read_keys`. The first key
+        # signs new tokens, all of them are published at `/keys`.
+        self.JWT_KEYS = read_keys(os.environ.get("JWT_KEYS", "rsa:RS512"))
         self.JWT_VALIDITY = timedelta(minutes=10)
+        # Verified tokens are cached per worker until they expire.
+        self.JWT_CACHE_SIZE = 1000
         self.REFRESH_TOKEN_VALIDITY = timedelta(days=30)
         self.SENTRY_DSN = os.environ.get("SENTRY_DSN")
+        # Optional Redis server for caches shared by all workers. Caches are
+        # kept in-process per worker when this is not set.
+        self.REDIS_URL = os.environ.get("REDIS_URL")
+        self.CLAIMS_CACHE_SIZE = 10000
+        self.CLAIMS_CACHE_TTL = timedelta(hours=1)
+        self.FEAT_TOGGLE_HIERARCHICAL_CLAIMS = bool(
+            os.environ.get("FEAT_TOGGLE_HIERARCHICAL_CLAIMS")
+        )
+        self.FEAT_TOGGLE_COMPACT_CLAIMS = bool(
+            os.environ.get("FEAT_TOGGLE_COMPACT_CLAIMS")
+        )
+        # Organization and team grants in hierarchical claims are resolved
+        # with a per-worker cache of their projects.
+        self.GRANTS_CACHE_SIZE = 10000
+        self.GRANTS_CACHE_TTL = timedelta(minutes=1)
+        # Entity counts in the metrics are refreshed in the background this
+        # often, from the planner's estimates instead of counting the rows if
+        # `METRICS_COUNTS_ESTIMATE` is set.
+        self.METRICS_COUNTS_INTERVAL = timedelta(
+            seconds=int(os.environ.get("METRICS_COUNTS_INTERVAL", 60))
+        )
+        self.METRICS_COUNTS_ESTIMATE = bool(
+            os.environ.get("METRICS_COUNTS_ESTIMATE")
+        )
 
         self.APISPEC_TITLE = "iam"
         self.APISPEC_SWAGGER_UI_URL = "/"
 
+        # Number of native threads per worker for hashing passwords, or 0 to
+        # hash passwords inline.
+        self.HASHER_POOL_SIZE = int(os.environ.get("HASHER_POOL_SIZE", 2))
+        # Algorithm and cost parameters for new password hashes, see
+        # `iam.hasher.HASHERS`. Existing passwords are rehashed on login.
+        self.PASSWORD_HASHER = (
+            os.environ.get("PASSWORD_HASHER") or "pbkdf2_sha256"
+        )
+        self.PASSWORD_HASHER_PARAMETERS = json.loads(
+            os.environ.get("PASSWORD_HASHER_PARAMETERS") or "{}"
+        )
+
+        # Login attempts are throttled per client IP and per email, allowing
+        # bursts of up to N attempts and N attempts per period on average.
+        self.LOGIN_THROTTLE_IP = (100, timedelta(minutes=1))
+        self.LOGIN_THROTTLE_EMAIL = (10, timedelta(minutes=5))
+        self.LOGIN_THROTTLE_SIZE = 100000
+
         self.BASIC_AUTH_USERNAME = os.environ["BASIC_AUTH_USERNAME"]
         self.BASIC_AUTH_PASSWORD = os.environ["BASIC_AUTH_PASSWORD"]
 
@@ -67,6 +108,31 @@ class Default:
             f"?connect_timeout=10"
         )
         self.SQLALCHEMY_TRACK_MODIFICATIONS = False
+        # Optional read replica for read-only resources, see `iam.replica`.
+        # Reads go to the primary while the replica lags further behind.
+        self.REPLICA_DATABASE_URI = None
+        if os.environ.get("DB_REPLICA_HOST"):
+            self.REPLICA_DATABASE_URI = (
+                f"postgresql://{os.environ['DB_USERNAME']}:"
+                f"{os.environ['DB_PASSWORD']}@{os.environ['DB_REPLICA_HOST']}:"
+                f"{os.environ['DB_PORT']}/{os.environ['DB_NAME']}"
+                f"?connect_timeout=10"
+            )
+        self.REPLICA_MAX_LAG = timedelta(
+            seconds=float(os.environ.get("DB_REPLICA_MAX_LAG", 5))
+        )
+        # Connection pool of each worker. A gevent worker serves many requests
+        # at once, which wait up to `pool_timeout` seconds for a connection
+        # when all of them are checked out. Connections are replaced after
+        # `pool_recycle` seconds, and tested before use with `pool_pre_ping`.
+        self.SQLALCHEMY_ENGINE_OPTIONS = {
+            "poolclass": MeteredQueuePool,
+            "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+            "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+            "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 10)),
+            "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+            "pool_pre_ping": bool(os.environ.get("DB_POOL_PRE_PING")),
+        }
 
         self.FEAT_TOGGLE_FIREBASE = bool(os.environ["FEAT_TOGGLE_FIREBASE"])
         self.FIREBASE_CLIENT_CERT_URL = os.environ.get(
@@ -77,6 +143,10 @@ class Default:
         self.FIREBASE_PRIVATE_KEY = os.environ.get("FIREBASE_PRIVATE_KEY")
         self.FIREBASE_PRIVATE_KEY_ID = os.environ.get("FIREBASE_PRIVATE_KEY_ID")
         self.FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID")
+        # File name of a private RSA key in `keys` to verify Firebase ID tokens
+        # with, instead of Google's certificates. Allows load testing the
+        # Firebase login offline, with tokens from `flask firebase-token`.
+        self.FIREBASE_TEST_KEY = os.environ.get("FIREBASE_TEST_KEY")
         self.SENDGRID_API_KEY = os.environ.get("SENDGRID_API_KEY")
 
         self.LOGGING = {
@@ -130,8 +200,10 @@ class Testing(Default):
         self.DEBUG = True
         self.SECRET_KEY = os.urandom(24)
         self.TESTING = True
+        self.HASHER_POOL_SIZE = 0
         self.SQLALCHEMY_DATABASE_URI = (
-            "postgresql://postgres:@postgres:5432/iam_test"
+            f"postgresql://postgres:{os.environ['DB_PASSWORD']}@"
+            f"{os.environ['DB_HOST']}:{os.environ['DB_PORT']}/iam_test"
         )
         self.ROOT_URL = "http://localhost:4200"
 
@@ -158,3 +230,5 @@ class Production(Default):
         self.SECRET_KEY = os.environ["SECRET_KEY"]
         self.LOGGING["root"]["level"] = "INFO"
         self.ROOT_URL = "https://caffeine.dd-decaf.eu"
+        # Never accept locally signed Firebase ID tokens in production.
+        self.FIREBASE_TEST_KEY = None
@@ -0,0 +1,146 @@
+# Copyright (c) 2018, Novo Nordisk Foundation Center for Biosustainability,
+# Technical University of Denmark.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Throttling with token buckets.
+
+A bucket holds up to `capacity` tokens and is refilled at a rate of `capacity`
+tokens per `period` seconds. Every attempt takes a token, and attempts are
+rejected while the bucket is empty. This allows bursts of up to `capacity`
+attempts, and `capacity` attempts per `period` on average.
+"""
+
+import os
+import threading
+import time
+
+import redis
+from flask import request
+
+from .app import app
+from .cache import LRUCache
+from .metrics import LOGIN_THROTTLED
+
+
+def init_app(app):
+    """Add the token buckets for throttling login attempts to the app."""
+    app.extensions["login_throttle"] = create_throttle(
+        app.config["REDIS_URL"], app.config["LOGIN_THROTTLE_SIZE"]
+    )
+
+
+def throttle_login(email):
+    """
+    Take a token for a login attempt from the client IP and email buckets.
+
+    The client IP is the one forwarded by the proxy, see `ProxyFix`.
+
+    :return: 0 if the attempt is allowed, otherwise the number of seconds until
+        the client may try again
+    """
+    buckets = app.extensions["login_throttle"]
+    labels = ("iam", os.environ["ENVIRONMENT"])
+    for name, key in (("ip", request.remote_addr), ("email", email.lower())):
+        capacity, period = app.config[f"LOGIN_THROTTLE_{name.upper()}"]
+        wait = buckets.take(
+            f"login:{name}:{key}", capacity, period.total_seconds()
+        )
+        if wait:
+            LOGIN_THROTTLED.labels(*labels, name).inc()
+            return wait
+    return 0
+
+
+def create_throttle(url=None, maxsize=10000, prefix="iam:throttle:"):
+    """Return a Redis throttle if a URL is given, a local one otherwise."""
+    if url:
+        return RedisTokenBuckets.from_url(url, prefix)
+    return MemoryTokenBuckets(maxsize)
+
+
+class MemoryTokenBuckets:
+    """Token buckets kept in-process, evicting the least recently used."""
+
+    def __init__(self, maxsize=10000):
+        self._buckets = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, period):
+        """
+        Take a token from the bucket with the given key.
+
+        :return: 0 if a token was taken, otherwise the number of seconds until
+            the next token is available
+        """
+        rate = capacity / period
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key) or (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens < 1:
+                return (1 - tokens) / rate
+            # An untouched bucket is full again after `period` seconds.
+            self._buckets.set(key, (tokens - 1, now), period)
+            return 0
+
+    def clear(self):
+        """Fill all buckets."""
+        self._buckets.clear()
+
+
+class RedisTokenBuckets:
+    """Token buckets shared between processes through Redis."""
+
+    # Same algorithm as `MemoryTokenBuckets.take`, run atomically in Redis.
+    # The current time is passed in rather than read with `TIME`, which would
+    # not allow writes in scripts before Redis 5.
+    SCRIPT = """
+        local capacity = tonumber(ARGV[1])
+        local period = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local rate = capacity / period
+        local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+        local tokens = tonumber(bucket[1]) or capacity
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+        if tokens < 1 then
+            return tostring((1 - tokens) / rate)
+        end
+        redis.call("HMSET", KEYS[1], "tokens", tokens - 1, "updated", now)
+        redis.call("EXPIRE", KEYS[1], math.ceil(period))
+        return "0"
+    """
+
+    def __init__(self, client, prefix="iam:throttle:"):
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(self.SCRIPT)
+
+    @classmethod
+    def from_url(cls, url, prefix="iam:throttle:"):
+        """Connect to the Redis server at the given URL."""
+        return cls(redis.Redis.from_url(url), prefix)
+
+    def take(self, key, capacity, period):
+        """
+        Take a token from the bucket with the given key.
+
+        :return: 0 if a token was taken, otherwise the number of seconds until
+            the next token is available
+        """
+        wait = self._take(
+            keys=[self.prefix + key], args=[capacity, period, time.time()]
+        )
+        return float(wait)
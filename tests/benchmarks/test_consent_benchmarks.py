@@ -0,0 +1,107 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for listing the latest consents of a user among 1M consents.
+
+`current` reads the `current_consent` table, `distinct_on` the consent log.
+`grouped` is an earlier query, which aggregated the consents of all users
+before selecting those of the given user.
+"""
+
+import pytest
+from sqlalchemy import and_, func
+
+from iam import consents
+from iam.models import Consent, db
+
+
+pytest.importorskip("pytest_benchmark")
+
+
+def grouped_latest_consents(user_id):
+    subquery = (
+        db.session.query(
+            Consent.user_id.label("user_id"),
+            Consent.type.label("type"),
+            Consent.category.label("category"),
+            func.max(Consent.timestamp).label("latest_timestamp"),
+            func.max(Consent.id).label("greatest_id"),
+        )
+        .group_by(Consent.user_id, Consent.type, Consent.category)
+        .subquery()
+    )
+    return (
+        db.session.query(Consent)
+        .join(
+            subquery,
+            and_(
+                Consent.user_id == user_id,
+                Consent.type == subquery.c.type,
+                Consent.category == subquery.c.category,
+                Consent.timestamp == subquery.c.latest_timestamp,
+                Consent.id == subquery.c.greatest_id,
+            ),
+        )
+        .order_by(Consent.type, Consent.category)
+    )
+
+
+@pytest.fixture
+def user_id(db_fixtures, session, benchmark):
+    """Seed 100k users with 10 consents each, and return one of them."""
+    # The fixtures are created first, as the seeded users advance the sequence
+    # of user ids even though they are rolled back.
+    if benchmark.disabled:
+        pytest.skip("Seeding 1M consents is only worthwhile when benchmarking")
+    session.execute(
+        """INSERT INTO "user" (email, first_name, last_name)
+        SELECT 'consent' || i || '@example.com', 'Consent', 'User'
+        FROM generate_series(1, 100000) AS i"""
+    )
+    # Two consents for each of the cookie categories and one for GDPR. Later
+    # consents have greater ids, which the `grouped` query relies on.
+    session.execute(
+        """INSERT INTO consent (type, category, status, timestamp, user_id)
+        SELECT CAST(CASE WHEN i = 0 THEN 'gdpr' ELSE 'cookie' END
+                    AS consenttype),
+               (ARRAY['strictly_necessary', 'preferences', 'statistics',
+                      'marketing'])[i % 4 + 1],
+               CAST(CASE WHEN i % 2 = 0 THEN 'accepted' ELSE 'rejected' END
+                    AS consentstatus),
+               now() - (10 - i) * interval '1 day', id
+        FROM "user", generate_series(0, 9) AS i
+        WHERE email LIKE 'consent%'
+        ORDER BY 4"""
+    )
+    consents.rebuild()
+    session.execute("ANALYZE consent")
+    session.execute("ANALYZE current_consent")
+    return session.execute(
+        """SELECT id FROM "user" WHERE email = 'consent50000@example.com'"""
+    ).scalar()
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        consents.current_consents,
+        consents.latest_consents,
+        grouped_latest_consents,
+    ],
+    ids=["current", "distinct_on", "grouped"],
+)
+def test_latest_consents(user_id, benchmark, query):
+    consents = benchmark(lambda: query(user_id).all())
+    assert len(consents) == 5
@@ -0,0 +1,47 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for password hashing.
+
+The time per hash is the latency a login adds, and its inverse the logins per
+second a single hashing thread can sustain. Use `flask calibrate-hasher` to
+find the settings for a latency budget.
+"""
+
+import pytest
+
+from iam import hasher
+
+
+pytest.importorskip("pytest_benchmark")
+
+SETTINGS = [
+    ("pbkdf2_sha256", {"iterations": 50000}),
+    ("pbkdf2_sha256", {"iterations": 100000}),
+    ("pbkdf2_sha256", {"iterations": 200000}),
+    ("scrypt", {"n": 2 ** 14}),
+    ("scrypt", {"n": 2 ** 15}),
+]
+
+
+@pytest.mark.parametrize("algorithm, parameters", SETTINGS)
+def test_encode(benchmark, algorithm, parameters):
+    benchmark(hasher.encode, "hunter2", algorithm=algorithm, **parameters)
+
+
+@pytest.mark.parametrize("algorithm, parameters", SETTINGS)
+def test_verify(benchmark, algorithm, parameters):
+    encoded = hasher.encode("hunter2", algorithm=algorithm, **parameters)
+    assert benchmark(hasher.verify, "hunter2", encoded)
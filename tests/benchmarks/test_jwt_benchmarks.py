@@ -0,0 +1,74 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for JWT claims encodings.
+
+Run with `pytest tests/benchmarks --benchmark-columns=mean,rounds`. The token
+size of each case is reported in the `extra_info` of the benchmark results
+(`--benchmark-json`).
+"""
+
+import json
+import random
+
+import pytest
+
+from iam.jwt import decode_project_claims, encode_project_claims
+
+
+pytest.importorskip("pytest_benchmark")
+
+
+def project_claims(count):
+    """Return claims to `count` projects with random roles."""
+    rng = random.Random(count)
+    project_ids = rng.sample(range(1, count * 10), count)
+    return {
+        project_id: rng.choice(["admin", "write", "read"])
+        for project_id in project_ids
+    }
+
+
+def decode_json_claims(app, token):
+    """Decode a token with a JSON object of project claims, as decode_jwt."""
+    claims = app.extensions["jwt_verifier"].verify(token)
+    claims["prj"] = {int(key): value for key, value in claims["prj"].items()}
+    return claims
+
+
+def decode_compact_claims(app, token):
+    """Decode a token with compact project claims, as decode_jwt."""
+    claims = app.extensions["jwt_verifier"].verify(token)
+    claims["prj"] = decode_project_claims(claims.pop("prjc"))
+    return claims
+
+
+@pytest.mark.parametrize("count", [10, 1000, 10000])
+def test_json_claims(app, benchmark, count):
+    claims = {"usr": 1, "prj": project_claims(count)}
+    token = app.extensions["jwt_signer"].sign(claims)
+    benchmark.extra_info["token_size"] = len(token)
+    benchmark.extra_info["claim_size"] = len(json.dumps(claims["prj"]))
+    assert benchmark(decode_json_claims, app, token)["prj"] == claims["prj"]
+
+
+@pytest.mark.parametrize("count", [10, 1000, 10000])
+def test_compact_claims(app, benchmark, count):
+    prj = project_claims(count)
+    claims = {"usr": 1, "prjc": encode_project_claims(prj)}
+    token = app.extensions["jwt_signer"].sign(claims)
+    benchmark.extra_info["token_size"] = len(token)
+    benchmark.extra_info["claim_size"] = len(claims["prjc"])
+    assert benchmark(decode_compact_claims, app, token)["prj"] == prj
@@ -0,0 +1,46 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the request middleware on endpoints which do not use claims.
+
+Every round sends a token which is not in the cache of verified tokens, as
+with many clients sending distinct tokens.
+"""
+
+import time
+
+import pytest
+
+
+pytest.importorskip("pytest_benchmark")
+
+
+@pytest.mark.parametrize("path", ["/healthz", "/metrics"])
+@pytest.mark.parametrize("authorization", [False, True])
+def test_request(app, client, session, benchmark, path, authorization):
+    headers = {}
+    if authorization:
+        token = app.extensions["jwt_signer"].sign(
+            {"exp": int(time.time()) + 600, "usr": 1, "prj": {1: "read"}}
+        )
+        headers["Authorization"] = f"Bearer {token}"
+
+    def setup():
+        app.extensions["jwt_cache"].clear()
+
+    def request():
+        assert client.get(path, headers=headers).status_code == 200
+
+    benchmark.pedantic(request, setup=setup, rounds=500, warmup_rounds=5)
@@ -0,0 +1,90 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for signing and verifying JWTs.
+
+Compares passing the configured PEM string or JWK dict to python-jose on every
+call with the signer and verifier holding keys parsed once at startup, and the
+supported signing algorithms.
+"""
+
+import ecdsa
+import pytest
+from jose import jwt
+
+from iam.jwt import Signer, Verifier
+from iam.keys import public_jwk
+
+
+pytest.importorskip("pytest_benchmark")
+
+CLAIMS = {"exp": 4102444800, "usr": 1, "prj": {"1": "admin", "2": "read"}}
+
+
+def ed25519_key():
+    """Return a new PEM encoded Ed25519 private key."""
+    serialization = pytest.importorskip(
+        "cryptography.hazmat.primitives.serialization"
+    )
+    ed25519 = pytest.importorskip(
+        "cryptography.hazmat.primitives.asymmetric.ed25519"
+    )
+    return (
+        ed25519.Ed25519PrivateKey.generate()
+        .private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        .decode()
+    )
+
+
+@pytest.fixture(params=["RS512", "ES256", "EdDSA"])
+def key(app, request):
+    """Provide a private key for each supported algorithm."""
+    if request.param == "RS512":
+        private_key = app.config["JWT_KEYS"][0]["key"]
+    elif request.param == "ES256":
+        private_key = ecdsa.SigningKey.generate(ecdsa.NIST256p).to_pem()
+    else:
+        private_key = ed25519_key()
+    return {"kid": request.param, "alg": request.param, "key": private_key}
+
+
+@pytest.fixture
+def rsa_key(app):
+    return app.config["JWT_KEYS"][0]
+
+
+def test_sign_pem(benchmark, rsa_key):
+    benchmark(jwt.encode, CLAIMS, rsa_key["key"], rsa_key["alg"])
+
+
+def test_verify_jwk(benchmark, rsa_key):
+    token = jwt.encode(CLAIMS, rsa_key["key"], rsa_key["alg"])
+    claims = benchmark(jwt.decode, token, public_jwk(rsa_key), rsa_key["alg"])
+    assert claims == CLAIMS
+
+
+def test_sign_prepared(benchmark, key):
+    signer = Signer(key["key"], key["alg"], key["kid"])
+    benchmark(signer.sign, CLAIMS)
+
+
+def test_verify_prepared(benchmark, key):
+    token = Signer(key["key"], key["alg"], key["kid"]).sign(CLAIMS)
+    verifier = Verifier([public_jwk(key)])
+    assert benchmark(verifier.verify, token) == CLAIMS
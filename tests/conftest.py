@@ -16,13 +16,13 @@
 """Provide session level fixtures."""
 
 import pytest
-from jose import jwt
 
 from iam.app import app as app_
 from iam.app import init_app
 from iam.enums import ConsentStatus, ConsentType, CookieConsentCategory
 from iam.models import Consent, Organization, Project, Team, User
 from iam.models import db as db_
+from iam.throttle import RedisTokenBuckets
 
 
 @pytest.fixture(scope="session")
@@ -139,6 +139,12 @@ def session(db_tables, connection):
     transaction.rollback()
     db_.session = flask_sqlalchemy_session
 
+    # Cached claims and grants may refer to data that was rolled back, and
+    # login attempts should not be throttled across tests.
+    for cache in ("claims_cache", "grants_cache", "login_throttle"):
+        if cache in app_.extensions:
+            app_.extensions[cache].clear()
+
 
 @pytest.fixture(scope="function")
 def models(db_fixtures, session):
@@ -155,20 +161,46 @@ def models(db_fixtures, session):
 @pytest.fixture(scope="session")
 def tokens(app):
     """Provide user 1 with read, write and admin JWT claims to project 1."""
+    signer = app.extensions["jwt_signer"]
     return {
-        "read": jwt.encode(
-            {"usr": 1, "prj": {1: "read"}},
-            app.config["RSA_PRIVATE_KEY"],
-            app.config["ALGORITHM"],
-        ),
-        "write": jwt.encode(
-            {"usr": 1, "prj": {1: "write"}},
-            app.config["RSA_PRIVATE_KEY"],
-            app.config["ALGORITHM"],
-        ),
-        "admin": jwt.encode(
-            {"usr": 1, "prj": {1: "admin"}},
-            app.config["RSA_PRIVATE_KEY"],
-            app.config["ALGORITHM"],
-        ),
+        "read": signer.sign({"usr": 1, "prj": {1: "read"}}),
+        "write": signer.sign({"usr": 1, "prj": {1: "write"}}),
+        "admin": signer.sign({"usr": 1, "prj": {1: "admin"}}),
     }
+
+
+class LocalRedis:
+    """Stand-in for a Redis client, storing values in a dict."""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value.encode()
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def register_script(self, script):
+        assert script == RedisTokenBuckets.SCRIPT
+        return self.take_token
+
+    def take_token(self, keys, args):
+        """Run the token bucket script of `RedisTokenBuckets` in Python."""
+        capacity, period, now = args
+        rate = capacity / period
+        tokens, updated = self.values.get(keys[0], (capacity, now))
+        tokens = min(capacity, tokens + max(0, now - updated) * rate)
+        if tokens < 1:
+            return str((1 - tokens) / rate).encode()
+        self.values[keys[0]] = (tokens - 1, now)
+        return b"0"
+
+
+@pytest.fixture(scope="function")
+def local_redis():
+    """Provide a local stand-in for a Redis client used by shared caches."""
+    return LocalRedis()
@@ -14,12 +14,21 @@
 
 """Tests for the database integration."""
 
+import threading
+
+from sqlalchemy.orm import Session
+
 from iam.models import (
+    Organization,
     OrganizationProject,
     OrganizationUser,
+    Project,
     TeamProject,
     TeamUser,
+    User,
     UserProject,
+    UserProjectClaim,
+    db,
 )
 
 
@@ -59,3 +68,62 @@ def test_user_role(session, models):
 
     # Verify that the user has write role for the project
     assert user.claims["prj"][models["project"].id] == "read"
+
+
+def test_concurrent_claims(db_fixtures):
+    """Test refreshing the claims of a user in concurrent transactions."""
+    first, second = Session(bind=db.engine), Session(bind=db.engine)
+    user = first.query(User).filter_by(email="user@name.test").one()
+    project = first.query(Project).one()
+    organization = first.query(Organization).one()
+    errors = []
+
+    def add_membership():
+        # Grant the same project through the organization.
+        try:
+            second.add(
+                OrganizationUser(
+                    organization_id=organization.id,
+                    user_id=user.id,
+                    role="member",
+                )
+            )
+            second.add(
+                OrganizationProject(
+                    organization_id=organization.id,
+                    project_id=project.id,
+                    role="read",
+                )
+            )
+            second.flush()
+        except Exception as error:
+            errors.append(error)
+
+    try:
+        first.add(UserProject(user=user, project=project, role="read"))
+        first.flush()
+        # The second transaction waits for the first to refresh the claims of
+        # the same user.
+        thread = threading.Thread(target=add_membership)
+        thread.start()
+        thread.join(0.5)
+        assert thread.is_alive()
+        first.commit()
+        thread.join()
+        assert errors == []
+        second.commit()
+        claim = second.query(UserProjectClaim).filter_by(user_id=user.id).one()
+        assert claim.project_id == project.id
+    finally:
+        first.rollback()
+        second.rollback()
+        # Delete them through the session, which refreshes the claims again.
+        for membership in (
+            second.query(OrganizationUser).filter_by(user_id=user.id).all()
+            + second.query(UserProject).filter_by(user_id=user.id).all()
+            + second.query(OrganizationProject).all()
+        ):
+            second.delete(membership)
+        second.commit()
+        first.close()
+        second.close()
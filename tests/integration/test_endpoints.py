@@ -18,12 +18,25 @@ import base64
 import json
 from datetime import datetime, timedelta
 from itertools import groupby
+from unittest.mock import Mock
 
 import pytest
+import requests
 from jose import jwt
 from pytz import timezone
 
-from iam.models import Consent, Project, User
+from iam import firebase
+from iam.enums import CookieConsentCategory
+from iam.firebase import FirebaseVerifier, LocalKeyPair
+from iam.jwt import decode_project_claims
+from iam.models import (
+    Consent,
+    OrganizationUser,
+    Project,
+    TeamProject,
+    User,
+    UserProject,
+)
 
 
 def test_openapi_schema(app, client):
@@ -86,13 +99,115 @@ def test_authenticate_success(app, client, session, models):
     assert response.status_code == 200
     raw_jwt_token = json.loads(response.data)["jwt"]
 
-    returned_claims = jwt.decode(
-        raw_jwt_token, app.config["RSA_PUBLIC_KEY"], app.config["ALGORITHM"],
-    )
+    returned_claims = app.extensions["jwt_verifier"].verify(raw_jwt_token)
     del returned_claims["exp"]
     assert user.claims == returned_claims
 
 
+def test_authenticate_rehash(app, client, session, models, monkeypatch):
+    """Test that passwords are rehashed on login when the settings change."""
+    monkeypatch.setitem(app.config, "PASSWORD_HASHER", "scrypt")
+    monkeypatch.setitem(app.config, "PASSWORD_HASHER_PARAMETERS", {"n": 1024})
+    user = models["user"][0]
+    assert user.password.startswith("pbkdf2_sha256$")
+
+    response = client.post(
+        "/authenticate/local",
+        data={"email": user.email, "password": "hunter2"},
+    )
+    assert response.status_code == 200
+    session.refresh(user)
+    assert user.password.startswith("scrypt$1024$")
+    assert user.check_password("hunter2")
+
+
+def test_authenticate_throttled(app, client, session, models, monkeypatch):
+    """Test that bursts of login attempts are rejected before hashing."""
+    monkeypatch.setitem(
+        app.config, "LOGIN_THROTTLE_EMAIL", (2, timedelta(minutes=1))
+    )
+    user = models["user"][0]
+    data = {"email": user.email, "password": "wrong"}
+    assert client.post("/authenticate/local", data=data).status_code == 401
+    assert client.post("/authenticate/local", data=data).status_code == 401
+
+    check_password = Mock()
+    monkeypatch.setattr(User, "check_password", check_password)
+    response = client.post("/authenticate/local", data=data)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "30"
+    check_password.assert_not_called()
+
+
+def test_authenticate_firebase(app, client, session, models, monkeypatch):
+    """Test Firebase authentication with tokens signed by a local test key."""
+    with open("keys/rsa") as file_:
+        key_pair = LocalKeyPair(file_.read())
+    verifier = FirebaseVerifier("iam-test", key_pair)
+    monkeypatch.setitem(app.config, "FEAT_TOGGLE_FIREBASE", True)
+    monkeypatch.setitem(app.extensions, "firebase_verifier", verifier)
+
+    token = verifier.create_token("firebase-uid", "firebase@example.com")
+    response = client.post(
+        "/authenticate/firebase", data={"uid": "firebase-uid", "token": token}
+    )
+    assert response.status_code == 200
+    user = User.query.filter_by(firebase_uid="firebase-uid").one()
+    assert user.email == "firebase@example.com"
+    returned_claims = app.extensions["jwt_verifier"].verify(
+        json.loads(response.data)["jwt"]
+    )
+    assert returned_claims["usr"] == user.id
+
+    response = client.post(
+        "/authenticate/firebase",
+        data={"uid": "firebase-uid", "token": token[:-4] + "AAAA"},
+    )
+    assert response.status_code == 401
+
+
+def test_authenticate_firebase_invalid(
+    app, client, session, models, monkeypatch
+):
+    """Test rejecting Firebase logins as other users or without email."""
+    with open("keys/rsa") as file_:
+        key_pair = LocalKeyPair(file_.read())
+    verifier = FirebaseVerifier("iam-test", key_pair)
+    monkeypatch.setitem(app.config, "FEAT_TOGGLE_FIREBASE", True)
+    monkeypatch.setitem(app.extensions, "firebase_verifier", verifier)
+
+    # A valid token of one user must not log in another.
+    token = verifier.create_token("attacker-uid", "attacker@example.com")
+    response = client.post(
+        "/authenticate/firebase", data={"uid": "victim-uid", "token": token}
+    )
+    assert response.status_code == 401
+
+    claims = verifier.verify(verifier.create_token("uid", "a@b.c"))
+    del claims["email"]
+    response = client.post(
+        "/authenticate/firebase",
+        data={"uid": "uid", "token": key_pair.sign(claims)},
+    )
+    assert response.status_code == 401
+    assert User.query.filter_by(firebase_uid="uid").count() == 0
+
+
+def test_authenticate_firebase_unavailable(app, client, monkeypatch):
+    """Test Firebase authentication while Google's certificates are down."""
+    verifier = FirebaseVerifier("iam-test", firebase.GoogleCertificates())
+    monkeypatch.setitem(app.config, "FEAT_TOGGLE_FIREBASE", True)
+    monkeypatch.setitem(app.extensions, "firebase_verifier", verifier)
+    get = Mock(side_effect=requests.ConnectionError("Failed to connect"))
+    monkeypatch.setattr(firebase.requests, "get", get)
+
+    response = client.post(
+        "/authenticate/firebase", data={"uid": "uid", "token": "token"}
+    )
+    assert response.status_code == 503
+    get.assert_called_once()
+
+
 def test_authenticate_refresh(app, client, session, models):
     """Test the token refresh endpoint."""
     user = models["user"][0]
@@ -122,9 +237,7 @@ def test_authenticate_refresh(app, client, session, models):
 
     # Expect that the new claims are equal to the user claims, except for the
     # expiry which will have refreshed
-    refresh_claims = jwt.decode(
-        raw_jwt_token, app.config["RSA_PUBLIC_KEY"], app.config["ALGORITHM"],
-    )
+    refresh_claims = app.extensions["jwt_verifier"].verify(raw_jwt_token)
     del refresh_claims["exp"]
     assert user.claims == refresh_claims
 
@@ -135,6 +248,138 @@ def test_authenticate_refresh(app, client, session, models):
     assert response.status_code == 401
 
 
+def test_hierarchical_claims(app, client, session, models, monkeypatch):
+    """Test authorization with organization grants instead of project ids."""
+    monkeypatch.setitem(app.config, "FEAT_TOGGLE_HIERARCHICAL_CLAIMS", True)
+    user = models["user"][0]
+    OrganizationUser(
+        organization=models["organization"], user=user, role="owner"
+    )
+    TeamProject(team=models["team"], project=models["project"], role="read")
+    session.commit()
+
+    response = client.post(
+        "/authenticate/local",
+        data={"email": user.email, "password": "hunter2"},
+    )
+    raw_jwt_token = response.json["jwt"]
+    claims = app.extensions["jwt_verifier"].verify(raw_jwt_token)
+    assert claims["org"] == {str(models["organization"].id): "owner"}
+    assert claims["prj"] == {}
+
+    # Owners are admins of the team project, so may delete it.
+    response = client.get(
+        "/projects", headers={"Authorization": f"Bearer {raw_jwt_token}"}
+    )
+    assert [project["id"] for project in response.json] == [
+        models["project"].id
+    ]
+    response = client.delete(
+        f"/projects/{models['project'].id}",
+        headers={"Authorization": f"Bearer {raw_jwt_token}"},
+    )
+    assert response.status_code == 204
+
+
+def test_compact_claims(app, client, session, models, monkeypatch):
+    """Test authorization with compact project claims."""
+    monkeypatch.setitem(app.config, "FEAT_TOGGLE_COMPACT_CLAIMS", True)
+    user = models["user"][0]
+    UserProject(user=user, project=models["project"], role="read")
+    session.commit()
+
+    response = client.post(
+        "/authenticate/local",
+        data={"email": user.email, "password": "hunter2"},
+    )
+    raw_jwt_token = response.json["jwt"]
+    claims = app.extensions["jwt_verifier"].verify(raw_jwt_token)
+    assert "prj" not in claims
+    assert decode_project_claims(claims["prjc"]) == {
+        models["project"].id: "read"
+    }
+
+    response = client.get(
+        f"/projects/{models['project'].id}",
+        headers={"Authorization": f"Bearer {raw_jwt_token}"},
+    )
+    assert response.status_code == 200
+    # Read access is not sufficient to modify the project.
+    response = client.put(
+        f"/projects/{models['project'].id}",
+        json={"name": "Changed"},
+        headers={"Authorization": f"Bearer {raw_jwt_token}"},
+    )
+    assert response.status_code == 403
+
+
+def test_authorize_batch(client, session, models, tokens):
+    """Check access to multiple projects with a JWT."""
+    checks = [
+        {"project_id": 1, "level": "read"},
+        {"project_id": 1, "level": "write"},
+        {"project_id": 2, "level": "read"},
+    ]
+    response = client.post(
+        "/authorize/batch",
+        json={"checks": checks},
+        headers={"Authorization": f"Bearer {tokens['read']}"},
+    )
+    assert response.status_code == 200
+    assert response.json["results"] == [
+        {"project_id": 1, "level": "read", "allowed": True},
+        {"project_id": 1, "level": "write", "allowed": False},
+        {"project_id": 2, "level": "read", "allowed": False},
+    ]
+
+    response = client.post("/authorize/batch", json={"checks": checks})
+    assert response.status_code == 401
+
+    response = client.post(
+        "/authorize/batch",
+        json={"checks": [{"project_id": 1, "level": "owner"}]},
+        headers={"Authorization": f"Bearer {tokens['read']}"},
+    )
+    assert response.status_code == 422
+
+
+def test_authorize_batch_trusted(app, client, session, models, tokens):
+    """Check access to multiple projects of a user as a trusted caller."""
+    user = models["user"][1]
+    UserProject(user=user, project=models["project"], role="write")
+    session.commit()
+    payload = {
+        "user_id": user.id,
+        "checks": [
+            {"project_id": models["project"].id, "level": "write"},
+            {"project_id": models["project"].id, "level": "admin"},
+        ],
+    }
+    credentials = base64.b64encode(
+        f'{app.config["BASIC_AUTH_USERNAME"]}:'
+        f'{app.config["BASIC_AUTH_PASSWORD"]}'.encode()
+    ).decode()
+
+    response = client.post(
+        "/authorize/batch",
+        json=payload,
+        headers={"Authorization": f"Basic {credentials}"},
+    )
+    assert response.status_code == 200
+    assert [result["allowed"] for result in response.json["results"]] == [
+        True,
+        False,
+    ]
+
+    # Users may not check the access of other users.
+    response = client.post(
+        "/authorize/batch",
+        json=payload,
+        headers={"Authorization": f"Bearer {tokens['admin']}"},
+    )
+    assert response.status_code == 401
+
+
 def test_create_project(client, session, tokens):
     """Create a new project."""
     response = client.post(
@@ -161,6 +406,49 @@ def test_get_projects(client, session, models, tokens):
     assert len(response.json) > 0
 
 
+def test_get_projects_paginated(app, client, session):
+    """List projects page by page, filtered by name."""
+    projects = [Project(name=f"Page {i}") for i in range(5)]
+    projects.append(Project(name="Other_"))
+    session.add_all(projects)
+    session.flush()
+    token = app.extensions["jwt_signer"].sign(
+        {"usr": 1, "prj": {p.id: "read" for p in projects}}
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+
+    listed = []
+    url = "/projects?name=Page&limit=2&count=true"
+    while url:
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        assert response.headers["X-Total-Count"] == "5"
+        listed.extend(project["id"] for project in response.json)
+        link = response.headers.get("Link")
+        url = link[1 : link.index(">")] if link else None
+    assert listed == [p.id for p in projects[:5]]
+
+    # Prefix wildcards are matched literally.
+    response = client.get("/projects?name=Other_", headers=headers)
+    assert [p["name"] for p in response.json] == ["Other_"]
+    response = client.get("/projects?name=Page_", headers=headers)
+    assert response.json == []
+    response = client.get(
+        f"/projects?after={projects[4].id}&limit=10", headers=headers
+    )
+    assert [p["id"] for p in response.json] == [projects[5].id]
+    assert "Link" not in response.headers
+
+
+def test_get_projects_invalid_limit(client, session, tokens):
+    """Reject page sizes out of range."""
+    response = client.get(
+        "/projects?limit=0",
+        headers={"Authorization": f"Bearer {tokens['read']}"},
+    )
+    assert response.status_code == 422
+
+
 def test_get_project(client, session, models, tokens):
     """Retrieve single models."""
     response = client.get(
@@ -203,6 +491,10 @@ def test_keys(app, client):
     response = client.get("/keys")
     assert response.status_code == 200
     assert len(response.json["keys"]) > 0
+    assert [key["kid"] for key in response.json["keys"]] == [
+        key["kid"] for key in app.config["JWT_KEYS"]
+    ]
+    assert all("d" not in key for key in response.json["keys"])
 
 
 def test_user(app, client, session, models, tokens):
@@ -213,9 +505,7 @@ def test_user(app, client, session, models, tokens):
     assert response.status_code == 200
 
     # Verify returned data against the database
-    user_id = jwt.decode(
-        tokens["read"], app.config["RSA_PUBLIC_KEY"], app.config["ALGORITHM"],
-    )["usr"]
+    user_id = app.extensions["jwt_verifier"].verify(tokens["read"])["usr"]
     user = User.query.filter(User.id == user_id).one()
     assert user.first_name == response.json["first_name"]
     assert user.last_name == response.json["last_name"]
@@ -304,6 +594,54 @@ def test_create_consent_fail_on_incorrect_type(client, session, tokens):
     assert response.status_code == 422
 
 
+def test_create_consents_batch(client, session, tokens):
+    """Create a consent for each cookie category at once."""
+    consents = [
+        {"type": "cookie", "category": category.name, "status": "accepted"}
+        for category in CookieConsentCategory
+    ]
+    response = client.post(
+        "/consent/batch",
+        json={"consents": consents},
+        headers={"Authorization": f"Bearer {tokens['write']}"},
+    )
+    assert response.status_code == 201
+    ids = response.json["ids"]
+    assert [Consent.query.get(id_).category for id_ in ids] == [
+        consent["category"] for consent in consents
+    ]
+    response = client.get(
+        "/consent", headers={"Authorization": f"Bearer {tokens['read']}"}
+    )
+    current = {consent["category"]: consent for consent in response.json}
+    assert all(current[c["category"]]["status"] == "accepted" for c in consents)
+
+
+def test_create_consents_batch_fail_on_invalid_item(client, session, tokens):
+    """Fail to create any consent if one of them is invalid."""
+    count = Consent.query.count()
+    response = client.post(
+        "/consent/batch",
+        json={
+            "consents": [
+                {
+                    "type": "cookie",
+                    "category": "marketing",
+                    "status": "accepted",
+                },
+                {
+                    "type": "cookie",
+                    "category": "fumctiomal",
+                    "status": "accepted",
+                },
+            ]
+        },
+        headers={"Authorization": f"Bearer {tokens['write']}"},
+    )
+    assert response.status_code == 422
+    assert Consent.query.count() == count
+
+
 def test_get_consent(app, client, session, models, tokens):
     """Retrieve user consent data based on given token."""
     response = client.get(
@@ -319,9 +657,7 @@ def test_get_consent_returns_unique_consents(
     response = client.get(
         "/consent", headers={"Authorization": f"Bearer {tokens['read']}"}
     )
-    user_id = jwt.decode(
-        tokens["read"], app.config["RSA_PUBLIC_KEY"], app.config["ALGORITHM"],
-    )["usr"]
+    user_id = app.extensions["jwt_verifier"].verify(tokens["read"])["usr"]
     # Get expected consents - Consents with most recent timestamp value
     # for each group of consents that have identical combination of user_id,
     # type, and category
@@ -353,9 +689,7 @@ def test_get_consent_returns_latest_consents(
     response = client.get(
         "/consent", headers={"Authorization": f"Bearer {tokens['read']}"}
     )
-    user_id = jwt.decode(
-        tokens["read"], app.config["RSA_PUBLIC_KEY"], app.config["ALGORITHM"],
-    )["usr"]
+    user_id = app.extensions["jwt_verifier"].verify(tokens["read"])["usr"]
     # Get expected consents - Consents with most recent timestamp value
     # for each group of consents that have identical combination of user_id,
     # type, and category
@@ -406,9 +740,7 @@ def test_password_reset_expired_token(app, client, models):
         "exp": int(datetime.timestamp(datetime.now() - timedelta(minutes=1))),
         "usr": user.id,
     }
-    encoded_token = jwt.encode(
-        claims, app.config["RSA_PRIVATE_KEY"], app.config["ALGORITHM"]
-    )
+    encoded_token = app.extensions["jwt_signer"].sign(claims)
     new_password = "password"
     response = client.post(
         f"/password/reset/{encoded_token}", json={"password": new_password}
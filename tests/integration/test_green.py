@@ -0,0 +1,54 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test cooperative database I/O with gevent."""
+
+import gevent
+import pytest
+from psycopg2 import extensions
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+
+from iam import green
+
+
+@pytest.fixture
+def patched():
+    """Install the wait callback for the duration of a test."""
+    green.patch_psycopg()
+    yield
+    extensions.set_wait_callback(None)
+
+
+def test_slow_query_does_not_block(app, client, patched):
+    """Test that requests are served while a slow query is waiting."""
+    # Connections are only cooperative if opened after patching.
+    engine = create_engine(
+        app.config["SQLALCHEMY_DATABASE_URI"], poolclass=NullPool
+    )
+    finished = []
+
+    def slow_query():
+        engine.execute("SELECT pg_sleep(1)")
+        finished.append("slow")
+
+    def healthz():
+        assert client.get("/healthz").status_code == 200
+        finished.append("healthz")
+
+    slow = gevent.spawn(slow_query)
+    # Let the slow query start first.
+    gevent.sleep(0.1)
+    gevent.joinall([slow, gevent.spawn(healthz)], raise_error=True)
+    assert finished == ["healthz", "slow"]
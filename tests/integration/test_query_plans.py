@@ -0,0 +1,244 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test that the queries of the API resources are served by indexes."""
+
+import base64
+import json
+
+import pytest
+from sqlalchemy import event
+
+from iam.firebase import FirebaseVerifier, LocalKeyPair
+from iam.models import Project, UserProject, db
+
+
+# Statements which may scan tables: `INSERT` statements without a query.
+STATEMENTS = ("SELECT", "UPDATE", "DELETE", "WITH")
+
+
+@pytest.fixture
+def seeded(session, models):
+    """
+    Seed the tables with enough rows to make sequential scans costly.
+
+    The seeded users are members of the seeded organizations and teams, and
+    have access to the seeded projects. The users of `models` are not.
+    """
+    for statement in (
+        """INSERT INTO "user" (email, first_name, last_name, firebase_uid)
+        SELECT 'seed' || i || '@example.com', 'Seed', 'User', 'seed' || i
+        FROM generate_series(1, 2000) AS i""",
+        """INSERT INTO organization (name)
+        SELECT 'SeedOrg' || i FROM generate_series(1, 100) AS i""",
+        """INSERT INTO team (name, organization_id)
+        SELECT 'SeedTeam' || i, id FROM organization, generate_series(1, 2) AS i
+        WHERE name LIKE 'SeedOrg%'""",
+        """INSERT INTO project (name)
+        SELECT 'SeedProject' || i FROM generate_series(1, 2000) AS i""",
+        """CREATE TEMPORARY TABLE seed ON COMMIT DROP AS
+        WITH users AS (
+            SELECT array_agg(id ORDER BY id) AS ids FROM "user"
+            WHERE email LIKE 'seed%'
+        ), projects AS (
+            SELECT array_agg(id ORDER BY id) AS ids FROM project
+            WHERE name LIKE 'SeedProject%'
+        ), organizations AS (
+            SELECT array_agg(id ORDER BY id) AS ids FROM organization
+            WHERE name LIKE 'SeedOrg%'
+        ), teams AS (
+            SELECT array_agg(id ORDER BY id) AS ids FROM team
+            WHERE name LIKE 'SeedTeam%'
+        )
+        SELECT users.ids[i] AS user_id, projects.ids[i] AS project_id,
+               organizations.ids[i % 100 + 1] AS organization_id,
+               teams.ids[i % 200 + 1] AS team_id
+        FROM users, projects, organizations, teams,
+             generate_series(1, 2000) AS i""",
+        """INSERT INTO organization_user (organization_id, user_id, role)
+        SELECT organization_id, user_id, 'member' FROM seed""",
+        """INSERT INTO team_user (team_id, user_id, role)
+        SELECT team_id, user_id, 'member' FROM seed""",
+        """INSERT INTO organization_project (organization_id, project_id, role)
+        SELECT organization_id, project_id, 'read' FROM seed""",
+        """INSERT INTO team_project (team_id, project_id, role)
+        SELECT team_id, project_id, 'write' FROM seed""",
+        """INSERT INTO user_project (user_id, project_id, role)
+        SELECT user_id, project_id, 'admin' FROM seed""",
+        """INSERT INTO user_project_claim (user_id, project_id, role)
+        SELECT user_id, project_id, 'admin' FROM seed""",
+        """INSERT INTO consent (type, category, status, timestamp, user_id)
+        SELECT 'cookie', 'statistics', 'accepted', now() - i * interval '1h',
+               user_id
+        FROM seed, generate_series(1, 5) AS i""",
+        """INSERT INTO current_consent (user_id, type, category, consent_id)
+        SELECT DISTINCT ON (user_id) user_id, type, category, id
+        FROM consent WHERE user_id IN (SELECT user_id FROM seed)
+        ORDER BY user_id, timestamp DESC""",
+        """INSERT INTO refresh_token (token, expiry, user_id)
+        SELECT md5(user_id || '-' || i), now(), user_id
+        FROM seed, generate_series(1, 5) AS i""",
+        # Update the statistics the planner uses to choose between scans.
+        "ANALYZE",
+    ):
+        session.execute(statement)
+    user = models["user"][0]
+    project = Project(name="Seeded")
+    db.session.add(UserProject(user=user, project=project, role="admin"))
+    db.session.flush()
+    return user, project
+
+
+@pytest.fixture
+def plans(connection):
+    """Collect the query plans of the statements executed in a block."""
+
+    class Plans:
+        def __init__(self):
+            self.statements = []
+
+        def __enter__(self):
+            event.listen(connection, "before_cursor_execute", self.capture)
+            return self
+
+        def __exit__(self, *exc_info):
+            event.remove(connection, "before_cursor_execute", self.capture)
+
+        def capture(self, conn, cursor, statement, parameters, *args):
+            if statement.lstrip().upper().startswith(STATEMENTS):
+                self.statements.append((statement, parameters))
+
+        def sequential_scans(self):
+            """Return the statements scanning whole tables or indexes."""
+            cursor = connection.connection.cursor()
+            scans = []
+            for statement, parameters in self.statements:
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+                ((plan,),) = cursor.fetchall()
+                if any(is_full_scan(node) for node in nodes(plan[0]["Plan"])):
+                    scans.append(f"{statement}\n{json.dumps(plan, indent=2)}")
+            return scans
+
+    return Plans()
+
+
+def nodes(plan):
+    """Yield the nodes of the given query plan."""
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from nodes(child)
+
+
+def is_full_scan(node):
+    """Return whether a plan node reads a whole table or index."""
+    if node["Node Type"] == "Seq Scan":
+        return True
+    # Index scans without a condition are used to read rows in index order.
+    return node["Node Type"] in ("Index Scan", "Index Only Scan") and not (
+        "Index Cond" in node
+    )
+
+
+def login(client, user):
+    """Return the JWT and refresh token of the given user."""
+    response = client.post(
+        "/authenticate/local", data={"email": user.email, "password": "hunter2"}
+    )
+    assert response.status_code == 200
+    tokens = json.loads(response.data)
+    return tokens["jwt"], tokens["refresh_token"]["val"]
+
+
+def test_authenticate(client, seeded, plans):
+    """Test the queries of a local login."""
+    user, project = seeded
+    with plans:
+        login(client, user)
+    assert plans.statements
+    assert plans.sequential_scans() == []
+
+
+def test_refresh(client, seeded, plans):
+    """Test the queries of refreshing a JWT."""
+    user, project = seeded
+    _, refresh_token = login(client, user)
+    with plans:
+        response = client.post(
+            "/refresh", data={"refresh_token": refresh_token}
+        )
+    assert response.status_code == 200
+    assert plans.sequential_scans() == []
+
+
+def test_authenticate_firebase(app, client, seeded, plans, monkeypatch):
+    """Test the queries of a Firebase login."""
+    with open("keys/rsa") as file_:
+        verifier = FirebaseVerifier("iam-test", LocalKeyPair(file_.read()))
+    monkeypatch.setitem(app.config, "FEAT_TOGGLE_FIREBASE", True)
+    monkeypatch.setitem(app.extensions, "firebase_verifier", verifier)
+    for uid, email in (("seed1", "other@example.com"), ("new", "new@a.b")):
+        token = verifier.create_token(uid, email)
+        with plans:
+            response = client.post(
+                "/authenticate/firebase", data={"uid": uid, "token": token}
+            )
+        assert response.status_code == 200
+    assert plans.sequential_scans() == []
+
+
+def test_authorize_batch(app, client, seeded, plans):
+    """Test the queries of checking access for a trusted caller."""
+    user, project = seeded
+    credentials = base64.b64encode(
+        f"{app.config['BASIC_AUTH_USERNAME']}:"
+        f"{app.config['BASIC_AUTH_PASSWORD']}".encode()
+    ).decode()
+    with plans:
+        response = client.post(
+            "/authorize/batch",
+            json={
+                "user_id": user.id,
+                "checks": [{"project_id": project.id, "level": "read"}],
+            },
+            headers={"Authorization": f"Basic {credentials}"},
+        )
+    assert response.status_code == 200
+    assert plans.sequential_scans() == []
+
+
+@pytest.mark.parametrize(
+    "method, path",
+    [
+        ("get", "/user"),
+        ("get", "/projects"),
+        ("get", "/projects?name=Seed&limit=10&count=true"),
+        ("get", "/projects/{project_id}"),
+        ("put", "/projects/{project_id}"),
+        ("delete", "/projects/{project_id}"),
+        ("get", "/consent"),
+    ],
+)
+def test_resources(client, seeded, plans, method, path):
+    """Test the queries of the resources for an authenticated user."""
+    user, project = seeded
+    token, _ = login(client, user)
+    with plans:
+        response = getattr(client, method)(
+            path.format(project_id=project.id),
+            headers={"Authorization": f"Bearer {token}"},
+            json={"name": "Renamed"},
+        )
+    assert response.status_code < 300
+    assert plans.statements
+    assert plans.sequential_scans() == []
@@ -0,0 +1,120 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test routing read-only resources to a read replica."""
+
+from datetime import datetime, timedelta
+
+import pytest
+from flask import g
+from sqlalchemy import create_engine, event
+
+from iam.models import RefreshToken, db
+from iam.replica import Replica
+
+
+@pytest.fixture
+def replica(app, monkeypatch):
+    """
+    Provide a read replica, which is the test database itself.
+
+    Statements executed on the replica are recorded in its `statements`.
+    """
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"])
+    replica = Replica(engine, max_lag=5)
+    replica.statements = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def record(conn, cursor, statement, *args):
+        replica.statements.append(statement)
+
+    monkeypatch.setitem(app.extensions, "db_replica", replica)
+    yield replica
+    # The app context outlives requests in tests. Return the connection to the
+    # replica and read from the primary outside of requests.
+    db.session.remove()
+    g.pop("db_replica", None)
+    g.pop("db_replica_engine", None)
+    replica.dispose()
+
+
+def test_read_from_replica(client, db_fixtures, replica, tokens):
+    """Test that read-only resources read from the replica."""
+    response = client.get(
+        "/user", headers={"Authorization": f"Bearer {tokens['read']}"}
+    )
+    assert response.status_code == 200
+    assert any('FROM "user"' in s for s in replica.statements)
+
+
+def test_write_to_primary(client, session, models, replica, tokens):
+    """Test that resources writing to the database use the primary."""
+    response = client.post(
+        "/consent",
+        json={"type": "cookie", "category": "marketing", "status": "accepted"},
+        headers={"Authorization": f"Bearer {tokens['write']}"},
+    )
+    assert response.status_code == 201
+    response = client.get(
+        "/consent", headers={"Authorization": f"Bearer {tokens['read']}"}
+    )
+    assert response.status_code == 200
+    # The consent is not committed outside the test session, so the replica
+    # did not see it.
+    assert not any("INSERT" in s for s in replica.statements)
+    assert "marketing" not in [c["category"] for c in response.json]
+
+
+def test_lagging_replica(client, db_fixtures, replica, tokens):
+    """Test falling back to the primary while the replica lags behind."""
+    replica.max_lag = -1
+    response = client.get(
+        "/user", headers={"Authorization": f"Bearer {tokens['read']}"}
+    )
+    assert response.status_code == 200
+    assert all(
+        "FROM" not in s or "pg_last_xact" in s for s in replica.statements
+    )
+
+
+def test_refresh_recent_token(client, session, models, replica):
+    """Test refreshing a token which has not reached the replica yet."""
+    user = models["user"][0]
+    token = RefreshToken(
+        user=user, token="recent", expiry=datetime.now() + timedelta(hours=1)
+    )
+    session.add(token)
+    session.flush()
+    response = client.post("/refresh", data={"refresh_token": token.token})
+    assert response.status_code == 200
+    assert any("FROM refresh_token" in s for s in replica.statements)
+
+
+def test_failing_replica(app, client, db_fixtures, tokens, monkeypatch):
+    """Test retrying reads on the primary after the replica failed."""
+    engine = create_engine("postgresql://postgres:@localhost:1/iam")
+    replica = Replica(engine, max_lag=5)
+    # The replica fails after its check.
+    monkeypatch.setattr(replica, "_check", lambda: True)
+    monkeypatch.setitem(app.extensions, "db_replica", replica)
+    response = client.get(
+        "/user", headers={"Authorization": f"Bearer {tokens['read']}"}
+    )
+    assert response.status_code == 200
+    # Reads go to the primary until the next check.
+    assert not replica.available()
+    db.session.remove()
+    g.pop("db_replica", None)
+    g.pop("db_replica_engine", None)
+    replica.dispose()
@@ -25,3 +25,24 @@ def test_app(app):
 def test_mode(app):
     """Ensure that the app is in testing mode."""
     assert app.testing
+
+
+def test_calibrate_hasher(app):
+    """Test the hasher calibration command."""
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["calibrate-hasher", "--algorithm", "md5"])
+    assert result.exit_code != 0
+    assert "Unknown hasher" in result.output
+    result = runner.invoke(
+        args=["calibrate-hasher", "--budget", "0", "--rounds", "1"]
+    )
+    assert result.exit_code != 0
+    assert "No pbkdf2_sha256 setting hashes within 0.0 ms" in result.output
+
+
+def test_firebase_token(app):
+    """Test that test tokens are only created with a local test key."""
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["firebase-token", "uid", "user@example.com"])
+    assert result.exit_code != 0
+    assert "FIREBASE_TEST_KEY is not set" in result.output
@@ -0,0 +1,57 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the cache module."""
+
+import json
+
+from iam.cache import LRUCache, RedisCache
+
+
+def test_lru_eviction():
+    """Test that the least recently used entry is evicted."""
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_lru_expiry():
+    """Test that expired entries are not returned."""
+    cache = LRUCache()
+    cache.set("a", 1, ttl=-1)
+    cache.set("b", 2, ttl=60)
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    cache.delete("b")
+    assert cache.get("b") is None
+
+
+def test_redis_cache(local_redis):
+    """Test storing values as JSON in a shared cache."""
+    client = local_redis
+    cache = RedisCache(client, prefix="test:")
+    cache.set("a", {"version": 1, "prj": {1: "admin"}}, ttl=60)
+    assert json.loads(client.values["test:a"]) == {
+        "version": 1,
+        "prj": {"1": "admin"},
+    }
+    assert cache.get("a") == {"version": 1, "prj": {"1": "admin"}}
+    cache.delete("a")
+    assert cache.get("a") is None
@@ -0,0 +1,305 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the claims module."""
+
+import random
+
+import pytest
+
+from iam import claims
+from iam.cache import RedisCache
+from iam.models import (
+    Organization,
+    OrganizationProject,
+    OrganizationUser,
+    Project,
+    Team,
+    TeamProject,
+    TeamUser,
+    User,
+    UserProject,
+    UserProjectClaim,
+)
+
+
+def reference_claims(user):
+    """Compute claims by walking the relationships of the given user."""
+
+    def add_claim(id, role):
+        """Add claims, if there is no existing higher claim."""
+        if id in project_claims:
+            if role == "read" and project_claims[id] in ("admin", "write"):
+                return
+            if role == "write" and project_claims[id] == "admin":
+                return
+
+        project_claims[id] = role
+
+    project_claims = {}
+
+    for user_role in user.organizations:
+        if user_role.role == "owner":
+            # Add admin role for all projects in the organization
+            for project_role in user_role.organization.projects:
+                add_claim(project_role.project.id, "admin")
+
+            # Add admin role for all projects in organization teams
+            for team in user_role.organization.teams:
+                for team_role in team.projects:
+                    add_claim(team_role.project.id, "admin")
+        else:
+            # Add the assigned role for all projects in the organization
+            for org_role in user_role.organization.projects:
+                add_claim(org_role.project.id, org_role.role)
+
+    # Add the assigned role for all projects in the users' team
+    for user_role in user.teams:
+        for team_role in user_role.team.projects:
+            add_claim(team_role.project.id, team_role.role)
+
+    # Add projects owned by user
+    for user_role in user.projects:
+        add_claim(user_role.project.id, user_role.role)
+
+    return {"usr": user.id, "prj": project_claims}
+
+
+def random_pairs(rng, left, right):
+    """Return a random subset of distinct pairs from the given sequences."""
+    pairs = [(a, b) for a in left for b in right]
+    return rng.sample(pairs, rng.randint(0, len(pairs)))
+
+
+def test_owner_claims(session, models):
+    """Test that owners are granted admin on organization and team projects."""
+    user = models["user"][0]
+    team_project = Project(name="TeamProject")
+    OrganizationUser(
+        organization=models["organization"], user=user, role="owner"
+    )
+    OrganizationProject(
+        organization=models["organization"],
+        project=models["project"],
+        role="read",
+    )
+    TeamProject(team=models["team"], project=team_project, role="read")
+    session.add(team_project)
+
+    assert claims.user_claims(user.id) == user.claims
+    assert claims.user_claims(user.id)["prj"] == {
+        models["project"].id: "admin",
+        team_project.id: "admin",
+    }
+
+
+def test_highest_role_wins(session, models):
+    """Test that the highest role granted through any path is materialized."""
+    user = models["user"][0]
+    UserProject(user=user, project=models["project"], role="read")
+    TeamUser(team=models["team"], user=user, role="member")
+    TeamProject(team=models["team"], project=models["project"], role="write")
+    session.flush()
+    assert claims.user_claims(user.id)["prj"] == {models["project"].id: "write"}
+
+    # Changing the role of the team is reflected for its members.
+    models["team"].projects[0].role = "read"
+    assert claims.user_claims(user.id)["prj"] == {models["project"].id: "read"}
+
+
+def test_revoked_claims(session, models):
+    """Test that removing access rules removes the materialized claims."""
+    user, other_user = models["user"]
+    OrganizationUser(
+        organization=models["organization"], user=user, role="member"
+    )
+    OrganizationUser(
+        organization=models["organization"], user=other_user, role="member"
+    )
+    organization_project = OrganizationProject(
+        organization=models["organization"],
+        project=models["project"],
+        role="write",
+    )
+    session.flush()
+    assert claims.user_claims(other_user.id)["prj"] == {
+        models["project"].id: "write"
+    }
+
+    session.delete(organization_project)
+    assert claims.user_claims(user.id)["prj"] == {}
+    assert claims.user_claims(other_user.id)["prj"] == {}
+
+
+def test_deleted_project(session, models):
+    """Test that deleting a project removes the materialized claims."""
+    user = models["user"][0]
+    UserProject(user=user, project=models["project"], role="admin")
+    session.flush()
+    session.delete(models["project"])
+    assert claims.user_claims(user.id)["prj"] == {}
+
+
+def test_moved_team(session, models):
+    """Test that moving a team updates the claims of both organizations."""
+    user, other_user = models["user"]
+    team = models["team"]
+    other_organization = Organization(name="OtherOrganization")
+    OrganizationUser(organization=team.organization, user=user, role="owner")
+    OrganizationUser(
+        organization=other_organization, user=other_user, role="owner"
+    )
+    TeamProject(team=team, project=models["project"], role="read")
+    session.flush()
+    assert claims.user_claims(user.id)["prj"] == {models["project"].id: "admin"}
+    versions = (user.authorization_version, other_user.authorization_version)
+
+    team.organization = other_organization
+    session.flush()
+    session.expire_all()
+    assert claims.user_claims(user.id)["prj"] == {}
+    assert claims.user_claims(other_user.id)["prj"] == {
+        models["project"].id: "admin"
+    }
+    assert claims.find_inconsistencies() == []
+    assert user.authorization_version > versions[0]
+    assert other_user.authorization_version > versions[1]
+
+
+def test_deleted_team(session, models):
+    """Test that deleting a team revokes the claims of its owners."""
+    user = models["user"][0]
+    team = models["team"]
+    OrganizationUser(organization=team.organization, user=user, role="owner")
+    team_project = TeamProject(
+        team=team, project=models["project"], role="read"
+    )
+    session.flush()
+    for team_user in team.users:
+        session.delete(team_user)
+    session.delete(team_project)
+    session.delete(team)
+    session.flush()
+    assert claims.user_claims(user.id)["prj"] == {}
+    assert claims.find_inconsistencies() == []
+
+
+def test_rebuild(session, models):
+    """Test detecting and repairing inconsistent materialized claims."""
+    user = models["user"][0]
+    UserProject(user=user, project=models["project"], role="admin")
+    session.flush()
+    assert claims.find_inconsistencies() == []
+
+    UserProjectClaim.query.filter_by(user_id=user.id).update({"role": "read"})
+    assert claims.find_inconsistencies() == [user.id]
+
+    claims.rebuild()
+    assert claims.find_inconsistencies() == []
+    assert claims.user_claims(user.id) == user.claims
+
+
+def test_hierarchical_claims(app, session, models):
+    """Test that owners are granted access through their organization."""
+    user = models["user"][0]
+    OrganizationUser(
+        organization=models["organization"], user=user, role="owner"
+    )
+    TeamProject(team=models["team"], project=models["project"], role="read")
+    session.flush()
+
+    hierarchical = claims.hierarchical_user_claims(user.id)
+    assert hierarchical == {
+        "usr": user.id,
+        "org": {models["organization"].id: "owner"},
+        "team": {},
+        "prj": {},
+    }
+    assert claims.resolve_grants(hierarchical) == {
+        models["project"].id: "admin"
+    }
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_resolve_claims_random_graph(session, seed):
+    """Test that the resolved claims match the relationship rules."""
+    rng = random.Random(seed)
+    project_roles = ["admin", "write", "read"]
+    organizations = [Organization(name=f"Org{i}") for i in range(3)]
+    teams = [
+        Team(name=f"Team{i}", organization=rng.choice(organizations))
+        for i in range(4)
+    ]
+    users = [User(email=f"user{i}@random.test") for i in range(5)]
+    projects = [Project(name=f"Project{i}") for i in range(8)]
+    for organization, user in random_pairs(rng, organizations, users):
+        role = rng.choice(["owner", "member"])
+        OrganizationUser(organization=organization, user=user, role=role)
+    for team, user in random_pairs(rng, teams, users):
+        role = rng.choice(["maintainer", "member"])
+        TeamUser(team=team, user=user, role=role)
+    for organization, project in random_pairs(rng, organizations, projects):
+        role = rng.choice(project_roles)
+        OrganizationProject(
+            organization=organization, project=project, role=role
+        )
+    for team, project in random_pairs(rng, teams, projects):
+        TeamProject(team=team, project=project, role=rng.choice(project_roles))
+    for user, project in random_pairs(rng, users, projects):
+        UserProject(user=user, project=project, role=rng.choice(project_roles))
+    session.add_all(organizations + teams + users + projects)
+    session.flush()
+
+    for user in users:
+        expected = reference_claims(user)
+        assert claims.resolve_claims(user.id) == expected
+        assert claims.user_claims(user.id) == expected
+        hierarchical = claims.hierarchical_user_claims(user.id)
+        assert claims.resolve_grants(hierarchical) == expected["prj"]
+
+
+def test_cached_user_claims(app, session, models):
+    """Test that cached claims are invalidated by the authorization version."""
+    user = models["user"][0]
+    version = user.authorization_version
+    assert claims.cached_user_claims(user.id, version)["prj"] == {}
+
+    UserProject(user=user, project=models["project"], role="read")
+    session.flush()
+    # The cached entry is returned as long as the version is unchanged.
+    assert claims.cached_user_claims(user.id, version)["prj"] == {}
+
+    session.refresh(user)
+    assert user.authorization_version > version
+    assert claims.cached_user_claims(user.id, user.authorization_version)[
+        "prj"
+    ] == {models["project"].id: "read"}
+
+
+def test_cached_user_claims_shared(
+    app, session, models, local_redis, monkeypatch
+):
+    """Test that claims read back from a shared cache have integer ids."""
+    monkeypatch.setitem(app.extensions, "claims_cache", RedisCache(local_redis))
+    user = models["user"][0]
+    UserProject(user=user, project=models["project"], role="write")
+    session.flush()
+    session.refresh(user)
+    expected = {"usr": user.id, "prj": {models["project"].id: "write"}}
+    assert claims.cached_user_claims(user.id, user.authorization_version) == (
+        expected
+    )
+    assert claims.cached_user_claims(user.id, user.authorization_version) == (
+        expected
+    )
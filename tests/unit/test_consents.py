@@ -0,0 +1,114 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the consents module."""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from iam import consents
+from iam.enums import ConsentType
+from iam.models import Consent, CurrentConsent
+
+
+@pytest.fixture
+def add_consent(session):
+    """Provide a function adding a cookie consent."""
+
+    def add_consent(user, category, status, timestamp):
+        consent = Consent(
+            type=ConsentType.cookie,
+            category=category,
+            status=status,
+            timestamp=timestamp,
+            user=user,
+        )
+        session.add(consent)
+        session.flush()
+        return consent
+
+    return add_consent
+
+
+def cookie_consents(query):
+    """Return the cookie consents of the given query by category."""
+    consents = query.all()
+    assert len(consents) == len({(c.type, c.category) for c in consents})
+    return {c.category: c for c in consents if c.type is ConsentType.cookie}
+
+
+def test_latest_consents(session, models, add_consent):
+    """Test that the latest consent per type and category is current."""
+    user, other_user = models["user"]
+    now = datetime.now(timezone.utc)
+    older = add_consent(user, "marketing", "accepted", now - timedelta(days=1))
+    # Consents given in the past do not replace later ones.
+    add_consent(user, "marketing", "rejected", now - timedelta(days=2))
+    # Of consents with the same timestamp, the last one added wins.
+    add_consent(user, "preferences", "accepted", now)
+    tied = add_consent(user, "preferences", "rejected", now)
+    add_consent(other_user, "marketing", "rejected", now)
+
+    for query in (consents.current_consents, consents.latest_consents):
+        latest = cookie_consents(query(user.id))
+        assert latest["marketing"] is older
+        assert latest["preferences"] is tied
+
+
+def test_rebuild(session, models, add_consent):
+    """Test recomputing the current consents from the consent log."""
+    user = models["user"][0]
+    add_consent(user, "marketing", "accepted", datetime.now(timezone.utc))
+    expected = consents.current_consents(user.id).all()
+    assert expected == consents.latest_consents(user.id).all()
+
+    CurrentConsent.query.delete()
+    assert consents.current_consents(user.id).all() == []
+    consents.rebuild()
+    assert consents.current_consents(user.id).all() == expected
+
+
+def test_add_consents(session, models, add_consent):
+    """Test adding several consents in one statement."""
+    user = models["user"][0]
+    now = datetime.now(timezone.utc)
+    later = add_consent(user, "marketing", "accepted", now + timedelta(days=1))
+    ids = consents.add_consents(
+        user.id,
+        [
+            {"type": "cookie", "category": "statistics", "status": "accepted"},
+            {
+                "type": "cookie",
+                "category": "marketing",
+                "status": "rejected",
+                "timestamp": now,
+            },
+            {"type": "gdpr", "category": "newsletter", "status": "accepted"},
+        ],
+    )
+    assert ids == sorted(ids)
+    added = {c.id: c for c in Consent.query.filter(Consent.id.in_(ids))}
+    assert [(added[i].type.name, added[i].category) for i in ids] == [
+        ("cookie", "statistics"),
+        ("cookie", "marketing"),
+        ("gdpr", "newsletter"),
+    ]
+    current = cookie_consents(consents.current_consents(user.id))
+    assert current["statistics"].id == ids[0]
+    # Consents with an earlier timestamp do not replace later ones.
+    assert current["marketing"] is later
+    assert consents.current_consents(user.id).all() == (
+        consents.latest_consents(user.id).all()
+    )
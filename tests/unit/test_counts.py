@@ -0,0 +1,60 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the counts module."""
+
+import os
+
+import pytest
+
+from iam import counts
+from iam.metrics import PROJECT_COUNT, USER_COUNT
+from iam.models import Project, User, db
+
+
+def gauge_value(gauge):
+    return gauge.labels("iam", os.environ["ENVIRONMENT"])._value.get()
+
+
+@pytest.mark.parametrize("estimate", [False, True])
+def test_refresh(app, db_fixtures, estimate):
+    """Test setting the gauges to the committed counts."""
+    entity_counts = counts.EntityCounts(app, 60, estimate)
+    if estimate:
+        # Analyze on a connection of its own, which does not keep the locks
+        # of the analyzed tables after the test.
+        with db.engine.connect() as connection:
+            connection.execute("ANALYZE")
+    entity_counts.refresh()
+    assert gauge_value(USER_COUNT) == User.query.count()
+    assert gauge_value(PROJECT_COUNT) == Project.query.count()
+
+
+def test_start(app, monkeypatch):
+    """Test starting the refresh once, without waiting for the counts."""
+    threads = []
+
+    class Thread:
+        def __init__(self, target, daemon):
+            threads.append(target)
+
+        def start(self):
+            pass
+
+    monkeypatch.setattr(counts.threading, "Thread", Thread)
+    entity_counts = counts.EntityCounts(app, 60)
+    monkeypatch.setattr(entity_counts, "refresh", pytest.fail)
+    entity_counts.start()
+    entity_counts.start()
+    assert len(threads) == 1
@@ -16,7 +16,7 @@
 
 from datetime import datetime
 
-from iam.domain import create_firebase_user, sign_claims
+from iam.domain import resolve_firebase_user, sign_claims
 from iam.models import User
 
 
@@ -31,10 +31,30 @@ def test_sign_claims(app, models):
     assert datetime.now() + app.config["REFRESH_TOKEN_VALIDITY"] >= expiry
 
 
-def test_create_firebase_user(session):
-    """Test creating a Firebase user."""
-    user = create_firebase_user(
-        "foo_token", {"name": "Foo Bar", "email": "foo@bar.dk"}
+def test_resolve_firebase_user(session, models):
+    """Test creating and looking up Firebase users."""
+    user_id, version = resolve_firebase_user(
+        "foo_uid", {"name": "Foo Bar", "email": "foo@bar.dk"}
     )
-    assert isinstance(user, User)
+    user = User.query.get(user_id)
+    assert (user.first_name, user.last_name) == ("Foo", "Bar")
+    assert user.firebase_uid == "foo_uid"
+    assert version == 0
     assert len(user.claims["prj"].keys()) == 0
+
+    # Users are found by uid, even if their email changed.
+    assert resolve_firebase_user("foo_uid", {"email": "new@bar.dk"}) == (
+        user_id,
+        version,
+    )
+    # Users who signed up with another provider are found by email.
+    existing = models["user"][0]
+    assert resolve_firebase_user("bar_uid", {"email": existing.email}) == (
+        existing.id,
+        existing.authorization_version,
+    )
+    # The user with the uid is preferred over the one with the email.
+    assert resolve_firebase_user("foo_uid", {"email": existing.email}) == (
+        user_id,
+        version,
+    )
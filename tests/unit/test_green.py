@@ -0,0 +1,48 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the green module."""
+
+import pytest
+from psycopg2 import extensions
+
+from iam import green
+
+
+@pytest.fixture
+def patched(monkeypatch):
+    """Pretend gevent has patched the socket module."""
+    monkeypatch.setattr(
+        green.gevent.monkey, "is_module_patched", lambda name: True
+    )
+    yield
+    extensions.set_wait_callback(None)
+
+
+def test_check_unpatched(patched):
+    """Test failing loudly without the wait callback."""
+    with pytest.raises(RuntimeError):
+        green.check()
+
+
+def test_check_patched(patched):
+    """Test passing with the wait callback installed."""
+    green.patch_psycopg()
+    assert extensions.get_wait_callback() is green.wait_callback
+    green.check()
+
+
+def test_check_without_gevent():
+    """Test that the callback is not required without gevent."""
+    green.check()
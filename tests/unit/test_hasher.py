@@ -14,6 +14,11 @@
 
 """Unit tests for the hasher module."""
 
+import threading
+
+import prometheus_client
+import pytest
+
 from iam import hasher
 
 
@@ -46,3 +51,83 @@ def test_str_bytes():
     assert hasher.verify(
         password_bytes, hasher.encode(password_bytes, iterations=iterations)
     )
+
+
+def test_executor():
+    """Test hashing passwords in a thread pool."""
+    labels = {"service": "iam", "environment": "testing"}
+
+    def waits():
+        value = prometheus_client.REGISTRY.get_sample_value(
+            "decaf_hasher_wait_seconds_count", labels
+        )
+        return value or 0
+
+    waits_before = waits()
+    executor = hasher.Executor(2)
+    encoded = executor.run(hasher.encode, "foo", iterations=50)
+    assert executor.run(hasher.verify, "foo", encoded)
+    assert not executor.run(hasher.verify, "bar", encoded)
+    assert waits() == waits_before + 3
+    assert (
+        prometheus_client.REGISTRY.get_sample_value(
+            "decaf_hasher_queue_depth", labels
+        )
+        == 0
+    )
+
+
+def test_executor_inline():
+    """Test that a pool size of 0 runs hashing in the calling thread."""
+    executor = hasher.Executor(0)
+    assert executor.run(threading.get_ident) == threading.get_ident()
+
+
+def test_legacy_encoding():
+    """Test that passwords encoded without the algorithm still verify."""
+    encoded = "50$bar$U+VEsGGDzIMous1MVHae57lLIi4F3JYHWhS9maRCUgI="
+    assert hasher.decode(encoded) == (
+        "pbkdf2_sha256",
+        {"iterations": 50},
+        "bar",
+        "U+VEsGGDzIMous1MVHae57lLIi4F3JYHWhS9maRCUgI=",
+    )
+    assert hasher.verify("foo", encoded)
+    assert not hasher.verify("bar", encoded)
+    assert hasher.encode("foo", "bar", iterations=50) == (
+        "pbkdf2_sha256$50$bar$U+VEsGGDzIMous1MVHae57lLIi4F3JYHWhS9maRCUgI="
+    )
+
+
+def test_scrypt():
+    """Test encoding passwords with scrypt."""
+    encoded = hasher.encode("foo", algorithm="scrypt", n=1024)
+    assert encoded.startswith("scrypt$1024$8$1$")
+    assert hasher.verify("foo", encoded)
+    assert not hasher.verify("bar", encoded)
+
+
+def test_needs_rehash():
+    """Test detecting passwords encoded with other settings."""
+    encoded = hasher.encode("foo", iterations=50)
+    assert not hasher.needs_rehash(encoded, "pbkdf2_sha256", iterations=50)
+    assert hasher.needs_rehash(encoded, "pbkdf2_sha256")
+    assert hasher.needs_rehash(encoded, "scrypt", n=1024)
+    assert hasher.needs_rehash("50$bar$hash", "pbkdf2_sha256", iterations=50)
+
+
+@pytest.mark.parametrize(
+    "encoded", ["md5$bar$hash", "scrypt$1024$bar$hash", "pbkdf2_sha256$bar"]
+)
+def test_decode_invalid(encoded):
+    """Test that unknown and malformed encodings are rejected."""
+    with pytest.raises(ValueError):
+        hasher.decode(encoded)
+
+
+def test_calibrate():
+    """Test that calibration stops at the first setting over the budget."""
+    timings = hasher.calibrate("pbkdf2_sha256", 0, rounds=1)
+    assert timings == [({"iterations": 12500}, timings[0][1])]
+    assert timings[0][1] > 0
+    assert hasher.throughput("scrypt", {"n": 1024}, threads=2) > 0
@@ -0,0 +1,142 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the jwt module."""
+
+import random
+import time
+from unittest.mock import Mock
+
+import ecdsa
+import prometheus_client
+import pytest
+from jose import jwt
+
+import iam.cache
+from iam.jwt import (
+    Signer,
+    Verifier,
+    decode_project_claims,
+    encode_project_claims,
+)
+from iam.keys import public_jwk
+
+
+@pytest.mark.parametrize(
+    "project_claims",
+    [
+        {},
+        {1: "read"},
+        {1: "admin", 2: "write", 3: "read", 100000: "admin"},
+        {
+            project_id: random.Random(project_id).choice(
+                ["admin", "write", "read"]
+            )
+            for project_id in range(1, 10000, 3)
+        },
+    ],
+)
+def test_compact_project_claims(project_claims):
+    """Test encoding and decoding compact project claims."""
+    encoded = encode_project_claims(project_claims)
+    assert "=" not in encoded
+    assert decode_project_claims(encoded) == project_claims
+
+
+def test_compact_project_claims_malformed():
+    """Test that truncated compact project claims are rejected."""
+    encoded = encode_project_claims({1: "admin", 300: "read"})
+    with pytest.raises(ValueError):
+        decode_project_claims(encoded[:-2])
+
+
+@pytest.fixture
+def key_ring(app):
+    """Provide an RSA and an ECDSA key, signing with the latter."""
+    ec_key = ecdsa.SigningKey.generate(ecdsa.NIST256p).to_pem().decode()
+    return [{"kid": "ec", "alg": "ES256", "key": ec_key}] + app.config[
+        "JWT_KEYS"
+    ]
+
+
+def test_signer_verifier(key_ring):
+    """Test that the verifier selects the key by the `kid` header."""
+    verifier = Verifier([public_jwk(key) for key in key_ring])
+    claims = {"usr": 1, "prj": {"1": "admin"}}
+    for key in key_ring:
+        token = Signer(key["key"], key["alg"], key["kid"]).sign(claims)
+        assert jwt.get_unverified_header(token)["kid"] == key["kid"]
+        assert verifier.verify(token) == claims
+
+    # Tokens signed before key ids were introduced
+    rsa_key = key_ring[1]
+    assert verifier.verify(jwt.encode(claims, rsa_key["key"], "RS512")) == (
+        claims
+    )
+
+
+@pytest.mark.parametrize(
+    "kid, alg, key",
+    [("unknown", "ES256", 0), ("rsa", "ES256", 0), (None, "HS256", "secret"),],
+)
+def test_verifier_invalid(key_ring, kid, alg, key):
+    """Test that tokens not signed with a key of the ring are rejected."""
+    verifier = Verifier([public_jwk(key_ring[1])])
+    if isinstance(key, int):
+        key = key_ring[key]["key"]
+    token = jwt.encode({"usr": 1}, key, alg, {"kid": kid} if kid else None)
+    with pytest.raises(jwt.JWTError):
+        verifier.verify(token)
+
+
+def test_verified_token_cache(app, client, session, monkeypatch):
+    """Test that verified tokens are cached until they expire."""
+    verifier = app.extensions["jwt_verifier"]
+    verify = Mock(wraps=verifier.verify)
+    monkeypatch.setattr(verifier, "verify", verify)
+    token = app.extensions["jwt_signer"].sign(
+        {"exp": int(time.time()) + 60, "usr": 1, "prj": {1: "read"}}
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def hits():
+        labels = {"service": "iam", "environment": "testing"}
+        value = prometheus_client.REGISTRY.get_sample_value(
+            "decaf_jwt_cache_hits_total", labels
+        )
+        return value or 0
+
+    assert client.get("/user", headers=headers).status_code == 200
+    hits_before = hits()
+    assert client.get("/user", headers=headers).status_code == 200
+    assert verify.call_count == 1
+    assert hits() == hits_before + 1
+
+    # Once the token expires, the cache entry is gone.
+    now = time.monotonic() + 61
+    monkeypatch.setattr(iam.cache.time, "monotonic", lambda: now)
+    assert client.get("/user", headers=headers).status_code == 200
+    assert verify.call_count == 2
+
+
+def test_lazy_claims(app, client, monkeypatch):
+    """Test that tokens are only verified for endpoints using the claims."""
+    verifier = app.extensions["jwt_verifier"]
+    verify = Mock(wraps=verifier.verify)
+    monkeypatch.setattr(verifier, "verify", verify)
+    headers = {"Authorization": "Bearer invalid"}
+    assert client.get("/keys", headers=headers).status_code == 200
+    assert verify.call_count == 0
+    assert client.get("/user", headers=headers).status_code == 401
+    assert verify.call_count == 1
@@ -0,0 +1,61 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the keys module."""
+
+import pytest
+from jose import jwk, jwt
+
+from iam.keys import public_jwk, read_keys
+
+
+def test_read_keys(tmp_path):
+    """Test reading a key ring specification."""
+    (tmp_path / "new").write_text("new key")
+    (tmp_path / "old").write_text("old key")
+    assert read_keys("new:ES256, old:RS512", tmp_path) == [
+        {"kid": "new", "alg": "ES256", "key": "new key"},
+        {"kid": "old", "alg": "RS512", "key": "old key"},
+    ]
+
+
+def test_ed25519_key():
+    """Test signing and verifying with an Ed25519 key."""
+    serialization = pytest.importorskip(
+        "cryptography.hazmat.primitives.serialization"
+    )
+    ed25519 = pytest.importorskip(
+        "cryptography.hazmat.primitives.asymmetric.ed25519"
+    )
+    private_key = (
+        ed25519.Ed25519PrivateKey.generate()
+        .private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        .decode()
+    )
+    public_key = public_jwk({"kid": "ed", "alg": "EdDSA", "key": private_key})
+    assert public_key["kty"] == "OKP"
+    assert "d" not in public_key
+
+    token = jwt.encode({"usr": 1}, private_key, "EdDSA")
+    assert jwt.decode(token, public_key, "EdDSA") == {"usr": 1}
+    # The public key survives a round trip through its JWK.
+    assert jwk.construct(public_key, "EdDSA").to_dict() == {
+        key: public_key[key] for key in ("alg", "kty", "crv", "x")
+    }
+    with pytest.raises(jwt.JWTError):
+        jwt.decode(token[:-4] + "AAAA", public_key, "EdDSA")
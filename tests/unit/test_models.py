@@ -15,7 +15,6 @@
 """Unit tests for the models module."""
 
 import pytest
-from jose import jwt
 from sqlalchemy.exc import DataError
 
 from iam.models import Consent, db
@@ -25,9 +24,7 @@ def test_reset_token(app, models):
     """Test the get_reset_token method."""
     user = models["user"][0]
     encoded_token = user.get_reset_token()
-    decoded_token = jwt.decode(
-        encoded_token, app.config["RSA_PRIVATE_KEY"], app.config["ALGORITHM"]
-    )
+    decoded_token = app.extensions["jwt_verifier"].verify(encoded_token)
     assert decoded_token["usr"] == user.id
 
 
@@ -0,0 +1,67 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the pool module."""
+
+import os
+
+from sqlalchemy import create_engine
+
+from iam.metrics import DB_POOL_CHECKED_OUT, DB_POOL_OVERFLOW, DB_POOL_WAIT_TIME
+from iam.models import db
+from iam.pool import MeteredQueuePool
+
+
+def metric(gauge):
+    return gauge.labels(
+        "iam", os.environ["ENVIRONMENT"], "primary"
+    )._value.get()
+
+
+def checkouts():
+    labels = DB_POOL_WAIT_TIME.labels(
+        "iam", os.environ["ENVIRONMENT"], "primary"
+    )
+    return sum(bucket.get() for bucket in labels._buckets)
+
+
+def test_app_engine(app):
+    """Test that the app's engine uses the configured pool."""
+    pool = db.get_engine(app).pool
+    assert isinstance(pool, MeteredQueuePool)
+    options = app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+    assert pool.size() == options["pool_size"]
+    assert pool._timeout == options["pool_timeout"]
+
+
+def test_metrics(app):
+    """Test exporting the pool usage."""
+    engine = create_engine(
+        app.config["SQLALCHEMY_DATABASE_URI"],
+        poolclass=MeteredQueuePool,
+        pool_size=1,
+        max_overflow=1,
+    )
+    count = checkouts()
+    first = engine.connect()
+    second = engine.connect()
+    assert metric(DB_POOL_CHECKED_OUT) == 2
+    assert metric(DB_POOL_OVERFLOW) == 1
+    second.close()
+    assert metric(DB_POOL_CHECKED_OUT) == 1
+    assert metric(DB_POOL_OVERFLOW) == 1
+    first.close()
+    assert metric(DB_POOL_CHECKED_OUT) == 0
+    assert checkouts() == count + 2
+    engine.dispose()
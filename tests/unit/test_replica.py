@@ -0,0 +1,143 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the replica module."""
+
+import time
+
+import pytest
+from sqlalchemy import create_engine
+
+from iam import replica
+
+
+def test_available(app, monkeypatch):
+    """Test checking the lag of the replica at most every interval."""
+    clock = [0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    # Postgres reports no lag for a database which is not a replica.
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"])
+    replica_ = replica.Replica(engine, max_lag=5)
+    assert replica_.available()
+
+    checks = []
+    monkeypatch.setattr(replica_, "_check", lambda: checks.append(1))
+    assert replica_.available()
+    clock[0] += replica_.check_interval
+    assert not replica_.available()
+    assert len(checks) == 1
+    replica_.dispose()
+
+
+@pytest.fixture
+def standby(app, monkeypatch):
+    """
+    Provide an engine for a simulated standby and a function to set its state.
+
+    The functions and views reporting the replication state are shadowed by
+    ones in the `standby` schema, which the check searches before
+    `pg_catalog`.
+    """
+    with create_engine(app.config["SQLALCHEMY_DATABASE_URI"]).begin() as setup:
+        setup.execute(
+            """
+            CREATE SCHEMA standby;
+            CREATE TABLE standby.state (
+                received pg_lsn, replayed pg_lsn, replayed_at timestamptz,
+                status text
+            );
+            INSERT INTO standby.state VALUES (NULL, NULL, NULL, NULL);
+            CREATE FUNCTION standby.pg_is_in_recovery() RETURNS boolean
+                AS 'SELECT true' LANGUAGE sql;
+            CREATE FUNCTION standby.pg_last_wal_receive_lsn() RETURNS pg_lsn
+                AS 'SELECT received FROM standby.state' LANGUAGE sql;
+            CREATE FUNCTION standby.pg_last_wal_replay_lsn() RETURNS pg_lsn
+                AS 'SELECT replayed FROM standby.state' LANGUAGE sql;
+            CREATE FUNCTION standby.pg_last_xact_replay_timestamp()
+                RETURNS timestamptz
+                AS 'SELECT replayed_at FROM standby.state' LANGUAGE sql;
+            CREATE VIEW standby.pg_stat_wal_receiver AS
+                SELECT status FROM standby.state WHERE status IS NOT NULL;
+            """
+        )
+    # The search path is set in the check's transaction, rather than with the
+    # `options` startup parameter, which PgBouncer rejects.
+    monkeypatch.setattr(
+        replica,
+        "LAG_QUERY",
+        "SET LOCAL search_path = standby, pg_catalog; " + replica.LAG_QUERY,
+    )
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"])
+
+    def set_state(received, replayed, replayed_seconds_ago, status):
+        engine.execute(
+            "UPDATE standby.state SET received = %s, replayed = %s, "
+            "replayed_at = now() - %s * interval '1 second', status = %s",
+            received,
+            replayed,
+            replayed_seconds_ago,
+            status,
+        )
+
+    yield engine, set_state
+    engine.dispose()
+    with create_engine(app.config["SQLALCHEMY_DATABASE_URI"]).begin() as setup:
+        setup.execute("DROP SCHEMA standby CASCADE")
+
+
+@pytest.mark.parametrize(
+    "received, replayed, replayed_seconds_ago, status, available",
+    [
+        # Caught up with the primary, which has not been written to since.
+        ("0/3000000", "0/3000000", 60, "streaming", True),
+        # Disconnected from the primary, which may have been written to since.
+        ("0/3000000", "0/3000000", 60, None, False),
+        ("0/3000000", "0/3000000", 60, "stopping", False),
+        ("0/3000000", "0/3000000", 1, None, True),
+        # Replaying WAL which was received from the primary.
+        ("0/3000100", "0/3000000", 60, "streaming", False),
+        ("0/3000100", "0/3000000", 1, "streaming", True),
+        # Nothing replayed yet.
+        (None, None, None, None, False),
+    ],
+)
+def test_lag(
+    standby, received, replayed, replayed_seconds_ago, status, available
+):
+    """Test measuring the lag of a standby."""
+    engine, set_state = standby
+    set_state(received, replayed, replayed_seconds_ago, status)
+    replica_ = replica.Replica(engine, max_lag=5)
+    assert replica_.available() is available
+    replica_.dispose()
+
+
+def test_unreachable(app):
+    """Test that an unreachable replica is not available."""
+    engine = create_engine("postgresql://postgres:@localhost:1/iam")
+    assert not replica.Replica(engine, max_lag=5).available()
+
+
+def test_fail(app, monkeypatch):
+    """Test skipping a failed replica until its next check."""
+    clock = [0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"])
+    replica_ = replica.Replica(engine, max_lag=5)
+    assert replica_.available()
+    replica_.fail()
+    assert not replica_.available()
+    clock[0] += replica_.check_interval
+    assert replica_.available()
+    replica_.dispose()
@@ -0,0 +1,59 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the throttle module."""
+
+import time
+
+import pytest
+
+from iam.throttle import MemoryTokenBuckets, RedisTokenBuckets
+
+
+@pytest.fixture(params=["memory", "redis"])
+def buckets(request, local_redis, monkeypatch):
+    """Provide each token bucket backend with a controllable clock."""
+    clock = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(time, "time", lambda: clock[0])
+    if request.param == "memory":
+        return MemoryTokenBuckets(), clock
+    return RedisTokenBuckets(local_redis), clock
+
+
+def test_token_bucket(buckets):
+    """Test that bursts are limited to the capacity and tokens refill."""
+    buckets, clock = buckets
+    assert [buckets.take("key", 3, 60) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take("key", 3, 60) == pytest.approx(20)
+    # Other keys have their own bucket.
+    assert buckets.take("other", 3, 60) == 0
+
+    clock[0] += 10
+    assert buckets.take("key", 3, 60) == pytest.approx(10)
+    clock[0] += 10
+    assert buckets.take("key", 3, 60) == 0
+    assert buckets.take("key", 3, 60) == pytest.approx(20)
+
+    # The bucket does not fill up beyond its capacity.
+    clock[0] += 3600
+    assert [buckets.take("key", 3, 60) for _ in range(4)][-1] > 0
+
+
+def test_shared_buckets(local_redis):
+    """Test that buckets are shared between processes through Redis."""
+    first = RedisTokenBuckets(local_redis)
+    second = RedisTokenBuckets(local_redis)
+    assert first.take("key", 1, 60) == 0
+    assert second.take("key", 1, 60) > 0